@@ -0,0 +1,140 @@
+-- DDL for a range-partitioned variant of the SureChEMBL schema (see sc_data.sql), for PostgreSQL 12 or later.
+-- See sc_data_partitioned.osql for Oracle.
+--
+-- The document tables are partitioned by document ID. IDs below 100,000,000 come from the schembl_document_id
+-- sequence, as usual, and are kept in the *_front partitions. Each backfile year loaded with
+-- 'update.py --year YYYY --partition_swap' gets its own block of 10,000,000 IDs, starting at
+-- 100,000,000 + (YYYY - 1960) * 10,000,000, and its own partitions (e.g. schembl_document_y2013), which are
+-- created and replaced by the swap. The chemical tables aren't partitioned.
+--
+-- Unique indexes on a partitioned table must include the partition key, so document SCPNs are only unique within
+-- each partition; the partition swap checks that a year's documents aren't found in any other partition, and the
+-- loader looks for each new document in all partitions before inserting it.
+--
+-- For wide mappings, partition schembl_document_chemistry_wide in the same way, and create the view from
+-- sc_data_wide.sql.
+
+/*** Drop statements (for convenience only)
+
+DROP TABLE schembl_document_chemistry ;
+DROP TABLE schembl_document_class ;
+DROP TABLE schembl_document_title ;
+DROP TABLE schembl_chemical_structure ;
+DROP TABLE schembl_chemical ;
+DROP TABLE schembl_document ;
+DROP SEQUENCE schembl_document_id ;
+
+***/
+
+-- -----------------------------------------------------
+-- Table schembl_document
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_document (
+  id INTEGER NOT NULL,
+  scpn VARCHAR(50) NOT NULL,
+  published DATE NULL,
+  life_sci_relevant SMALLINT NULL,
+  assign_applic VARCHAR(4000),
+  family_id INTEGER NULL,
+  PRIMARY KEY (id))
+  PARTITION BY RANGE (id);
+
+CREATE INDEX scpn_idx ON schembl_document (scpn ASC);
+
+CREATE TABLE schembl_document_front PARTITION OF schembl_document FOR VALUES FROM (MINVALUE) TO (100000000);
+
+CREATE UNIQUE INDEX scpn_front_unique ON schembl_document_front (scpn ASC);
+
+CREATE SEQUENCE schembl_document_id MAXVALUE 99999999;
+
+
+-- -----------------------------------------------------
+-- Table schembl_document_class
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_document_class (
+  schembl_doc_id INTEGER NOT NULL,
+  class VARCHAR(100) NOT NULL,
+  system SMALLINT NOT NULL,
+  PRIMARY KEY (schembl_doc_id, class, system),
+  CONSTRAINT fk_docclass_to_doc
+    FOREIGN KEY (schembl_doc_id)
+    REFERENCES schembl_document (id))
+  PARTITION BY RANGE (schembl_doc_id);
+
+CREATE TABLE schembl_document_class_front PARTITION OF schembl_document_class FOR VALUES FROM (MINVALUE) TO (100000000);
+
+
+-- -----------------------------------------------------
+-- Table schembl_document_title
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_document_title (
+  schembl_doc_id INTEGER NOT NULL,
+  lang VARCHAR(10) NOT NULL,
+  text TEXT NULL,
+  PRIMARY KEY (schembl_doc_id, lang),
+  CONSTRAINT fk_doctitle_to_doc
+    FOREIGN KEY (schembl_doc_id)
+    REFERENCES schembl_document (id))
+  PARTITION BY RANGE (schembl_doc_id);
+
+CREATE TABLE schembl_document_title_front PARTITION OF schembl_document_title FOR VALUES FROM (MINVALUE) TO (100000000);
+
+
+-- -----------------------------------------------------
+-- Table schembl_chemical
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_chemical (
+  id INTEGER NOT NULL,
+  mol_weight FLOAT NULL,
+  logp FLOAT NULL,
+  med_chem_alert SMALLINT NULL,
+  is_relevant SMALLINT NULL,
+  donor_count SMALLINT NULL,
+  acceptor_count SMALLINT NULL,
+  ring_count SMALLINT NULL,
+  rot_bond_count SMALLINT NULL,
+  corpus_count INTEGER NULL,
+  PRIMARY KEY (id));
+
+
+-- -----------------------------------------------------
+-- Table schembl_chemical_structure
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_chemical_structure (
+  schembl_chem_id INTEGER NOT NULL,
+  smiles TEXT NULL,
+  std_inchi TEXT NULL,
+  std_inchikey VARCHAR(27) NULL,
+  PRIMARY KEY (schembl_chem_id),
+  CONSTRAINT fk_chemstruct_to_chem
+    FOREIGN KEY (schembl_chem_id)
+    REFERENCES schembl_chemical (id));
+
+
+-- -----------------------------------------------------
+-- Table schembl_document_chemistry
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_document_chemistry (
+  schembl_doc_id INTEGER NOT NULL,
+  schembl_chem_id INTEGER NOT NULL,
+  field SMALLINT NOT NULL,
+  frequency INTEGER NULL,
+  PRIMARY KEY (schembl_doc_id, schembl_chem_id, field),
+  CONSTRAINT fk_docchem_to_doc
+    FOREIGN KEY (schembl_doc_id)
+    REFERENCES schembl_document (id),
+  CONSTRAINT fk_docchem_to_chem
+    FOREIGN KEY (schembl_chem_id)
+    REFERENCES schembl_chemical (id))
+  PARTITION BY RANGE (schembl_doc_id);
+
+-- Lookups by document use the (partition-local) primary key
+CREATE INDEX fk_docchem_chemid_idx ON schembl_document_chemistry (schembl_chem_id ASC);
+
+CREATE TABLE schembl_document_chemistry_front PARTITION OF schembl_document_chemistry FOR VALUES FROM (MINVALUE) TO (100000000);
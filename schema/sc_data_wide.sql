@@ -0,0 +1,94 @@
+-- DDL for the wide variant of the document/chemistry mappings, used when loading with --wide_mappings.
+--
+-- Run after sc_data.sql. The narrow schembl_document_chemistry table, with one row per document, chemical and field,
+-- is replaced by schembl_document_chemistry_wide, with one row per document/chemical pair and a count column for
+-- each field, plus a view of the old name that presents the wide table in the narrow shape.
+--
+-- Designed for Oracle, PostgreSQL and MySQL.
+
+/*** Drop statements (for convenience only)
+
+DROP VIEW schembl_document_chemistry ;
+DROP TABLE schembl_document_chemistry_wide ;
+
+***/
+
+-- -----------------------------------------------------
+-- Table schembl_document_chemistry_wide
+-- -----------------------------------------------------
+
+CREATE TABLE schembl_document_chemistry_wide (
+  schembl_doc_id INTEGER NOT NULL,
+  schembl_chem_id INTEGER NOT NULL,
+  title_count INTEGER NULL,
+  abstract_count INTEGER NULL,
+  claims_count INTEGER NULL,
+  description_count INTEGER NULL,
+  image_count INTEGER NULL,
+  attachment_count INTEGER NULL,
+  PRIMARY KEY (schembl_doc_id, schembl_chem_id),
+  CONSTRAINT fk_docchemw_to_doc
+    FOREIGN KEY (schembl_doc_id)
+    REFERENCES schembl_document (id),
+  CONSTRAINT fk_docchemw_to_chem
+    FOREIGN KEY (schembl_chem_id)
+    REFERENCES schembl_chemical (id));
+
+-- Lookups by document use the primary key
+CREATE INDEX fk_docchemw_chemid_idx ON schembl_document_chemistry_wide (schembl_chem_id ASC);
+
+
+-- -----------------------------------------------------
+-- Conversion of existing mappings (optional)
+-- -----------------------------------------------------
+
+/*** Comment-in to copy the mappings of an existing database into the wide table, before the narrow table is dropped
+
+INSERT INTO schembl_document_chemistry_wide
+  SELECT schembl_doc_id, schembl_chem_id,
+         SUM(CASE WHEN field = 4 THEN frequency ELSE 0 END),
+         SUM(CASE WHEN field = 3 THEN frequency ELSE 0 END),
+         SUM(CASE WHEN field = 2 THEN frequency ELSE 0 END),
+         SUM(CASE WHEN field = 1 THEN frequency ELSE 0 END),
+         SUM(CASE WHEN field = 5 THEN frequency ELSE 0 END),
+         SUM(CASE WHEN field = 6 THEN frequency ELSE 0 END)
+  FROM schembl_document_chemistry
+  GROUP BY schembl_doc_id, schembl_chem_id;
+
+***/
+
+DROP TABLE schembl_document_chemistry ;
+
+
+-- -----------------------------------------------------
+-- View schembl_document_chemistry
+-- -----------------------------------------------------
+
+-- Presents the wide table with the columns of the narrow one; field values are those of DocumentField
+-- (1 description, 2 claims, 3 abstract, 4 title, 5 images, 6 attachments). Counts of zero are left out, as with
+-- sparse narrow mappings, so the view has no more rows than the fields that actually mention each chemical. Read-only.
+
+CREATE VIEW schembl_document_chemistry AS
+  SELECT schembl_doc_id, schembl_chem_id, CAST(4 AS SMALLINT) AS field, title_count AS frequency
+    FROM schembl_document_chemistry_wide
+    WHERE title_count > 0
+  UNION ALL
+  SELECT schembl_doc_id, schembl_chem_id, CAST(3 AS SMALLINT) AS field, abstract_count AS frequency
+    FROM schembl_document_chemistry_wide
+    WHERE abstract_count > 0
+  UNION ALL
+  SELECT schembl_doc_id, schembl_chem_id, CAST(2 AS SMALLINT) AS field, claims_count AS frequency
+    FROM schembl_document_chemistry_wide
+    WHERE claims_count > 0
+  UNION ALL
+  SELECT schembl_doc_id, schembl_chem_id, CAST(1 AS SMALLINT) AS field, description_count AS frequency
+    FROM schembl_document_chemistry_wide
+    WHERE description_count > 0
+  UNION ALL
+  SELECT schembl_doc_id, schembl_chem_id, CAST(5 AS SMALLINT) AS field, image_count AS frequency
+    FROM schembl_document_chemistry_wide
+    WHERE image_count > 0
+  UNION ALL
+  SELECT schembl_doc_id, schembl_chem_id, CAST(6 AS SMALLINT) AS field, attachment_count AS frequency
+    FROM schembl_document_chemistry_wide
+    WHERE attachment_count > 0;
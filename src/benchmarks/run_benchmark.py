@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmark harness for the DataLoader: generates synthetic data files, loads them into a scratch database, and
+reports throughput, peak memory and time for each phase as JSON, so that runs can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+from datetime import datetime
+from sqlalchemy import create_engine, select, func
+
+from src.scripts.data_loader import DataLoader
+from src.scripts.chem_workers import ChemLoaderPool
+from src.scripts.id_store import dict_memory_bytes
+from src.benchmarks.synthetic_data import write_biblio, write_chemicals
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+
+    parser = argparse.ArgumentParser( description='Benchmark loading of synthetic SureChEMBL data')
+    parser.add_argument('--docs',          metavar='n', type=int, help='Number of documents to generate',        default=10000)
+    parser.add_argument('--chems_per_doc', metavar='c', type=int, help='Average chemicals per document',         default=10)
+    parser.add_argument('--chem_pool',     metavar='k', type=int, help='Number of distinct chemicals',           default=100000)
+    parser.add_argument('--seed',          metavar='s', type=int, help='Random seed for data generation',        default=1)
+    parser.add_argument('--gzip',          help='Generate gzipped data files',                                   action="store_true")
+    parser.add_argument('--db_url',        metavar='u', type=str, help='SQL Alchemy URL of a SCRATCH database; all SureChEMBL tables are dropped and recreated. Defaults to a SQLite file in the working directory')
+    parser.add_argument('--working_dir',   metavar='w', type=str, help='Directory for generated files; defaults to a temporary directory, removed afterwards')
+    parser.add_argument('--chunksize',     metavar='k', type=int, help='Loader chunk size',                      default=1000)
+    parser.add_argument('--workers',       metavar='n', type=int, help='Worker processes for loading chemicals', default=1)
+    parser.add_argument('--preload_bib_ids', help='Preload document IDs when loading biblio data',               action="store_true")
+    parser.add_argument('--pg_copy',       help='Use COPY FROM STDIN for bulk inserts (PostgreSQL only)',        action="store_true")
+    parser.add_argument('--columnar',      help='Parse chemical files into columnar batches with pandas/NumPy',  action="store_true")
+    parser.add_argument('--supp',          help='Also reload the chemicals as a supplementary (update) file',    action="store_true")
+    parser.add_argument('--output',        metavar='o', type=str, help='File to write the JSON report to; defaults to stdout')
+    parser.add_argument('--verbose',       help='Show loader logging',                                           action="store_true")
+
+    args = parser.parse_args()
+
+    logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s',
+                         level=logging.INFO if args.verbose else logging.WARN)
+
+    working_dir = args.working_dir or tempfile.mkdtemp(prefix='schembl_bench_')
+    if not os.path.isdir(working_dir):
+        os.makedirs(working_dir)
+
+    try:
+        report = run_benchmark(args, working_dir)
+    finally:
+        if args.working_dir is None:
+            shutil.rmtree(working_dir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+def run_benchmark(args, working_dir):
+    """
+    Run all benchmark phases.
+    :return: Report dict, suitable for JSON serialization.
+    """
+
+    db_url = args.db_url or "sqlite:///{}".format( os.path.join(working_dir, 'bench.db') )
+    db = create_engine(db_url)
+
+    suffix = ".gz" if args.gzip else ""
+    biblio_file = os.path.join(working_dir, "bench.biblio.json" + suffix)
+    chem_file = os.path.join(working_dir, "bench.chemicals.tsv" + suffix)
+
+    phases = []
+    generated = {}
+
+    def generate():
+        scpns = write_biblio(biblio_file, args.docs, seed=args.seed)
+        generated['scpns'] = scpns
+        generated['chem_rows'] = write_chemicals(chem_file, scpns, args.chems_per_doc, args.chem_pool, seed=args.seed)
+        return len(scpns) + generated['chem_rows']
+
+    phases.append( timed_phase('generate', generate) )
+
+    loader = DataLoader(db, pg_copy=args.pg_copy, columnar_chems=args.columnar)
+
+    def create_schema():
+        metadata = loader.db_metadata()
+        metadata.drop_all(db)
+        metadata.create_all(db)
+        return 0
+
+    phases.append( timed_phase('create_schema', create_schema) )
+
+    def load_biblio():
+        loader.load_biblio(biblio_file, preload_ids=args.preload_bib_ids, chunksize=args.chunksize)
+        return args.docs
+
+    phases.append( timed_phase('load_biblio', load_biblio, loader.metrics) )
+
+    def load_chems():
+        if args.workers > 1:
+            pool = ChemLoaderPool(loader, args.workers, chunksize=args.chunksize)
+            pool.submit(chem_file, False)
+            pool.join()
+        else:
+            loader.load_chems(chem_file, False, chunksize=args.chunksize)
+        return generated['chem_rows']
+
+    phases.append( timed_phase('load_chems', load_chems, loader.metrics) )
+
+    if args.supp:
+        def load_supp():
+            loader.load_chems(chem_file, True, chunksize=args.chunksize)
+            return generated['chem_rows']
+
+        phases.append( timed_phase('load_supp', load_supp, loader.metrics) )
+
+    loader.close()
+
+    table_counts = {}
+    for table in loader.db_metadata().sorted_tables:
+        table_counts[table.name] = db.execute( select([func.count()]).select_from(table) ).scalar()
+
+    return {
+        'started'      : phases[0]['started'],
+        'config'       : dict( (key, value) for key, value in vars(args).items() if key not in ('output', 'verbose') ),
+        'environment'  : { 'python'   : platform.python_version(),
+                           'platform' : platform.platform(),
+                           'dialect'  : db.dialect.name,
+                           'driver'   : db.dialect.driver },
+        'phases'       : phases,
+        'total_secs'   : sum(phase['secs'] for phase in phases),
+        'peak_rss_kb'  : peak_rss_kb(),
+        'doc_id_map'   : doc_id_map_memory(loader, generated['scpns']),
+        'table_counts' : table_counts }
+
+
+def timed_phase(name, run, metrics=None):
+    """
+    Run a benchmark phase, timing it.
+    :param run: Function that runs the phase, returning the number of input rows that it processed.
+    :param metrics: Optional loader Metrics object, to report the loader's own breakdown of the phase from.
+    :return: Dict of phase results.
+    """
+
+    logger.info("Starting benchmark phase [{}]".format(name))
+
+    before = metrics.summary() if metrics is not None else None
+
+    started = datetime.now()
+    start = time.time()
+    rows = run()
+    secs = time.time() - start
+
+    result = { 'name'        : name,
+               'started'     : started.isoformat(),
+               'secs'        : round(secs, 3),
+               'rows'        : rows,
+               'rows_per_sec': round(rows / secs, 1) if secs > 0 and rows > 0 else None,
+               'peak_rss_kb' : peak_rss_kb() }
+
+    if metrics is not None:
+        result['loader_metrics'] = metrics_delta(before, metrics.summary())
+
+    return result
+
+
+def metrics_delta(before, after):
+    """
+    Work out what a benchmark phase added to the loader's metrics.
+    :param before: Metrics summary taken before the phase.
+    :param after: Metrics summary taken after the phase.
+    :return: Dict of the time and operation count of each loader phase (parse, doc_insert, mapping_insert etc.),
+             and the changed counters.
+    """
+
+    def key(entry):
+        return entry['name'], tuple(sorted(entry['labels'].items()))
+
+    previous = dict( (key(entry), entry) for entry in before['histograms'] )
+    phases = {}
+    for entry in after['histograms']:
+        if entry['name'] != 'phase_seconds':
+            continue
+        old = previous.get( key(entry), {'sum': 0, 'count': 0} )
+        if entry['count'] > old['count']:
+            phases[ entry['labels'].get('phase') ] = { 'secs'  : round(entry['sum'] - old['sum'], 3),
+                                                       'count' : entry['count'] - old['count'] }
+
+    previous = dict( (key(entry), entry['value']) for entry in before['counters'] )
+    counters = []
+    for entry in after['counters']:
+        value = entry['value'] - previous.get(key(entry), 0)
+        if value != 0:
+            counters.append( dict(entry, value=value) )
+
+    return { 'phases': phases, 'counters': counters }
+
+
+def doc_id_map_memory(loader, scpns):
+    """
+    Compare the memory held by the loader's document ID map with that of an equivalent dict.
+    :param scpns: SCPNs of the generated documents.
+    :return: Dict of memory results.
+    """
+
+    doc_ids = dict( (scpn, loader.doc_id_map[scpn]) for scpn in scpns if scpn in loader.doc_id_map )
+    map_bytes = loader.doc_id_map.memory_bytes()
+    dict_bytes = dict_memory_bytes(doc_ids)
+
+    return { 'entries'    : len(loader.doc_id_map),
+             'bytes'      : map_bytes,
+             'dict_bytes' : dict_bytes,
+             'dict_ratio' : round(float(dict_bytes) / map_bytes, 2) }
+
+
+def peak_rss_kb():
+    """Peak resident memory so far, in KB, of this process and (separately) its largest child process"""
+    return { 'self'    : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss }
+
+
+if __name__ == '__main__':
+    main()
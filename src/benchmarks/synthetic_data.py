@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Generators for synthetic SureChEMBL data files, in the same formats as the biblio and chemicals files on the FTP
+site, for benchmarking the DataLoader. Output is deterministic for a given seed.
+"""
+
+import sys
+import json
+import gzip
+import random
+import argparse
+
+from src.scripts.data_loader import DataLoader, DocumentClass
+
+# Classification codes to draw from; about half are life-science relevant by default
+CLASS_CODES = sorted(DocumentClass.default_relevant_set) + ['B29C', 'B32B', 'C22C', 'E04B', 'F16K', 'G06F', 'H01L',
+                                                           'H04L', 'H04W', 'B60R', 'F02D', 'G02B', 'H01M', 'B65D']
+
+TITLE_LANGS = ['EN', 'FR', 'DE', 'ZH', 'JA']
+
+SMILES_ATOMS = ['C', 'C', 'C', 'N', 'O', 'c1ccccc1', 'Cl', 'F', 'S', '(=O)', '(C)']
+
+
+def open_output(file_name):
+    """Open an output file, compressed with gzip if the name ends with .gz"""
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'wb')
+    return open(file_name, 'wb')
+
+
+def doc_scpn(index):
+    """Publication number of the given synthetic document"""
+    return "WO-{}-A1".format(2013000000 + index)
+
+
+def write_biblio(file_name, doc_count, first_doc=0, seed=1):
+    """
+    Write a synthetic biblio file, as a JSON array with one document per line.
+    :param file_name: Output file; gzipped if it ends with .gz.
+    :param doc_count: Number of documents to write.
+    :param first_doc: Index of the first document, so that separate files can hold distinct documents.
+    :param seed: Random seed.
+    :return: List of the SCPNs written.
+    """
+
+    rand = random.Random(seed)
+    scpns = []
+
+    with open_output(file_name) as output:
+        output.write("[\n")
+
+        for index in xrange(first_doc, first_doc + doc_count):
+
+            scpn = doc_scpn(index)
+            scpns.append(scpn)
+
+            langs = rand.sample(TITLE_LANGS, rand.randint(1, 3))
+            record = {
+                'pubnumber'     : [scpn],
+                'pubdate'       : ["2013{:02d}{:02d}".format(rand.randint(1, 12), rand.randint(1, 28))],
+                'family_id'     : [str(40000000 + rand.randint(0, 10000000))],
+                'assign_applic' : ["APPLICANT {}".format(rand.randint(1, 5000))],
+                'title'         : ["SYNTHETIC TITLE {} {}".format(lang, " ".join(rand.sample(CLASS_CODES, 6))) for lang in langs],
+                'title_lang'    : langs }
+
+            for system_key in DocumentClass.bib_dict:
+                record[system_key] = ["{} {}/{}".format(code, rand.randint(1, 99), rand.randint(0, 999))
+                                      for code in rand.sample(CLASS_CODES, rand.randint(0, 4))]
+
+            if index > first_doc:
+                output.write(",\n")
+            output.write( json.dumps(record) )
+
+        output.write("\n]")
+
+    return scpns
+
+
+def write_chemicals(file_name, scpns, chems_per_doc=10, chem_pool=100000, first_chem_id=1000, seed=1):
+    """
+    Write a synthetic chemicals file, with a header row and one row per document/chemical pair. Chemicals are drawn
+    from a pool with a skewed distribution, so that common chemicals appear in many documents, as in real data.
+    :param file_name: Output file; gzipped if it ends with .gz.
+    :param scpns: Publication numbers of the documents to write chemicals for.
+    :param chems_per_doc: Average number of chemicals per document.
+    :param chem_pool: Number of distinct chemicals to draw from.
+    :param first_chem_id: Lowest chemical ID in the pool.
+    :param seed: Random seed.
+    :return: Number of rows written, excluding the header.
+    """
+
+    rand = random.Random(seed)
+    rows = 0
+
+    with open_output(file_name) as output:
+        output.write( "\t".join(DataLoader.CHEM_HEADER_ROW) + "\n" )
+
+        for scpn in scpns:
+
+            chem_ids = set()
+            for _ in xrange( rand.randint(1, 2 * chems_per_doc - 1) ):
+                # Squaring the uniform value skews the choice towards low (common) chemical IDs
+                chem_ids.add( first_chem_id + int(chem_pool * rand.random() ** 2) )
+
+            for chem_id in sorted(chem_ids):
+                output.write( "\t".join(_chem_row(rand, scpn, chem_id)) + "\n" )
+                rows += 1
+
+    return rows
+
+
+def _chem_row(rand, scpn, chem_id):
+    """Build a chemicals row; chemical properties are derived from the ID, so they're consistent across rows"""
+
+    chem_rand = random.Random(chem_id)
+    smiles = "".join( chem_rand.choice(SMILES_ATOMS) for _ in xrange(chem_rand.randint(5, 40)) )
+    key = "".join( chem_rand.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in xrange(25) )
+
+    return [scpn,
+            str(chem_id),
+            smiles,
+            "InChI=1S/{}/c{}".format(smiles, chem_id),
+            "{}-{}-N".format(key[:14], key[14:24]),
+            "chemical {}".format(chem_id),
+            "{:.3f}".format(chem_rand.uniform(50, 1500)),                  # Mol Weight
+            str(chem_rand.randint(1, 100000)),                             # Chemical Corpus Count
+            str(chem_rand.randint(0, 1)),                                  # Med Chem Alert
+            str(chem_rand.randint(0, 1)),                                  # Is Relevant
+            "{:.3f}".format(chem_rand.uniform(-5, 10)),                    # LogP
+            str(chem_rand.randint(0, 10)),                                 # Donor Count
+            str(chem_rand.randint(0, 20)),                                 # Acceptor Count
+            str(chem_rand.randint(0, 8)),                                  # Ring Count
+            str(chem_rand.randint(0, 15)),                                 # Rotatable Bond Count
+            str(rand.randint(0, 2)),                                       # Title Count
+            str(rand.randint(0, 3)),                                       # Abstract Count
+            str(rand.randint(0, 10)),                                      # Claims Count
+            str(rand.randint(0, 50)),                                      # Description Count
+            str(rand.randint(0, 2)),                                       # Image Count
+            str(rand.randint(0, 1))]                                       # Attachment Count
+
+
+def main():
+
+    parser = argparse.ArgumentParser( description='Write synthetic biblio and chemicals files for benchmarking')
+    parser.add_argument('prefix',          metavar='p', type=str, help='Output path prefix, e.g. /tmp/bench/docs_1')
+    parser.add_argument('--docs',          metavar='n', type=int, help='Number of documents',                  default=10000)
+    parser.add_argument('--chems_per_doc', metavar='c', type=int, help='Average chemicals per document',      default=10)
+    parser.add_argument('--chem_pool',     metavar='k', type=int, help='Number of distinct chemicals',        default=100000)
+    parser.add_argument('--seed',          metavar='s', type=int, help='Random seed',                         default=1)
+    parser.add_argument('--gzip',          help='Write gzipped files',                                        action="store_true")
+
+    args = parser.parse_args()
+
+    suffix = ".gz" if args.gzip else ""
+    scpns = write_biblio( "{}.biblio.json{}".format(args.prefix, suffix), args.docs, seed=args.seed )
+    rows = write_chemicals( "{}.chemicals.tsv{}".format(args.prefix, suffix), scpns, args.chems_per_doc, args.chem_pool, seed=args.seed )
+
+    sys.stdout.write( "Wrote {} documents and {} chemical rows\n".format(len(scpns), rows) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import argparse
+
+from update import _get_db_engine
+from scripts.mapping_pruner import prune_zero_mappings
+
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    """
+    Delete the zero-frequency document/chemical mappings from an existing database, before switching to loading
+    with --sparse_mappings. See argparse message for usage.
+    """
+
+    parser = argparse.ArgumentParser(description='Delete zero-frequency rows from schembl_document_chemistry')
+    parser.add_argument('db_user',       metavar='du', type=str,  help='Username for accessing the target database')
+    parser.add_argument('db_pass',       metavar='dp', type=str,  help='Password for accessing the target database')
+    parser.add_argument('--db_type',     metavar='dt', type=str,  help='Database type ("oracle" or "postgres")',  default="oracle")
+    parser.add_argument('--db_host',     metavar='dh', type=str,  help='Host where the database can be found',     default="127.0.0.1")
+    parser.add_argument('--db_port',     metavar='do', type=str,  help='Port over which the database is accessed', default="1521")
+    parser.add_argument('--db_name',     metavar='dn', type=str,  help='Database name (for connection string)',    default="XE")
+    parser.add_argument('--pool_size',   metavar='ps', type=int,  help='Number of database connections kept open by the connection pool', default=5)
+    parser.add_argument('--stmt_cache_size', metavar='sc', type=int, help='Number of prepared statements cached per connection (Oracle only)', default=50)
+    parser.add_argument('--batch_docs',  metavar='b',  type=int,  help='Number of document IDs to prune per transaction', default=10000)
+    parser.add_argument('--start_id',    metavar='s',  type=int,  help='Document ID to start from, e.g. to resume an interrupted prune')
+    parser.add_argument('--end_id',      metavar='e',  type=int,  help='Document ID to stop at')
+    parser.add_argument('--wide_mappings', help='Prune all-zero rows from schembl_document_chemistry_wide instead', action="store_true")
+
+    args = parser.parse_args()
+
+    db = _get_db_engine(args)
+
+    prune_zero_mappings(db, batch_docs=args.batch_docs, start_id=args.start_id, end_id=args.end_id, wide=args.wide_mappings)
+
+
+if __name__ == '__main__':
+    main()
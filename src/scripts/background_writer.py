@@ -0,0 +1,139 @@
+import sys
+import time
+import Queue
+import logging
+import threading
+
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class BackgroundWriter:
+    """
+    Runs database writes on a background thread, with its own connection, so that the next chunk of input can be
+    parsed while the previous one is being written and committed.
+
+    Batchers are created on the writer's connection with batcher(), and their batches are handed to the thread
+    through a bounded queue; the caller only blocks when the queue is full. All operations run one at a time, in
+    the order they were submitted, so e.g. chemicals are still committed before their structures and mappings.
+    Writes on other connections that depend on the queued ones (or vice versa) must call flush() first.
+
+    If an operation fails, the thread stops, and the error is raised in the caller by its next call to the writer
+    or any of its batchers.
+    """
+
+    def __init__(self, db, depth=8, metrics=None, name='db-writer'):
+        """
+        Create a new BackgroundWriter, and start its thread.
+        :param db: SQL Alchemy engine to connect to.
+        :param depth: Maximum number of batches waiting to be written.
+        :param metrics: Optional Metrics object, to record the time spent waiting for the writer in.
+        :param name: Name of the thread.
+        """
+        self.db = db
+        self.conn = None
+        self.queue = Queue.Queue(maxsize=depth)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def batcher(self, factory):
+        """
+        Create a batcher on the writer's connection, whose batches are written in the background.
+        :param factory: Function that creates the batcher (e.g. a DBBatcher), given a DB-API connection.
+        """
+        return QueuedBatcher(self, factory)
+
+    def submit(self, func, *args):
+        """Queue a function call for the writer thread, waiting for room in the queue if necessary"""
+        self._put( (func, args) )
+
+    def flush(self):
+        """Wait until everything queued so far has been written"""
+
+        done = threading.Event()
+        self.submit(done.set)
+
+        with self.metrics.timer('phase_seconds', phase='writer_wait'):
+            while not done.wait(0.1) and self.thread.is_alive():
+                pass
+
+        self._raise_error()
+
+    def close(self):
+        """Wait until everything queued has been written, then stop the thread and close its connection"""
+        self._put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _put(self, item):
+        start = time.time()
+        while True:
+            self._raise_error()
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+
+        waited = time.time() - start
+        if waited > 0.01:
+            self.metrics.observe('phase_seconds', waited, phase='writer_wait')
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _run(self):
+        sql_alc_conn = None
+        try:
+            sql_alc_conn = self.db.connect()
+            self.conn = sql_alc_conn.connection
+
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                func, args = item
+                func(*args)
+
+        except Exception:
+            self.error = sys.exc_info()
+            logger.error( "Background write failed: {}".format(self.error[1]) )
+
+        finally:
+            if sql_alc_conn is not None:
+                sql_alc_conn.close()
+
+
+class QueuedBatcher:
+    """Batcher whose operations are run by a BackgroundWriter; see BackgroundWriter.batcher()"""
+
+    def __init__(self, writer, factory):
+        self.writer = writer
+        self.batcher = None
+        writer.submit(self._create, factory)
+
+    def execute(self, data):
+        """Queue the given operations; the list is copied, so the caller may reuse it"""
+        self.writer.submit(self._execute, list(data))
+
+    def flush(self):
+        """Wait until the queued operations have been performed"""
+        self.writer.flush()
+
+    def close(self):
+        """Queue the clean up of the batcher's resources"""
+        self.writer.submit(self._close)
+
+    def _create(self, factory):
+        self.batcher = factory(self.writer.conn)
+
+    def _execute(self, data):
+        self.batcher.execute(data)
+
+    def _close(self):
+        self.batcher.close()
@@ -0,0 +1,262 @@
+import os
+import json
+import logging
+import threading
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+# Tables that are loaded in bulk, and whose secondary indexes and foreign keys can be set aside while loading.
+# Indexes on schembl_document and schembl_chemical are always kept, as the loader looks records up through them.
+CHILD_TABLES = ('schembl_document_class', 'schembl_document_title', 'schembl_chemical_structure',
+                'schembl_document_chemistry', 'schembl_document_chemistry_wide')
+
+# Tables that are switched to NOLOGGING, for direct-path inserts (Oracle only)
+NOLOGGING_TABLES = CHILD_TABLES + ('schembl_chemical',)
+
+class BulkLoadMode:
+    """
+    Sets aside the secondary (non-unique) indexes and foreign key constraints of the bulk loaded tables, e.g.
+    fk_docchem_docid_idx and fk_docchem_to_doc, so that a cold backfile load doesn't maintain them row by row,
+    then rebuilds them and checks referential integrity once at the end.
+
+    On Oracle, the indexes are marked unusable and the constraints disabled; they're rebuilt in parallel and
+    re-enabled with validation. On PostgreSQL, the indexes and constraints are dropped, then recreated on
+    concurrent connections; constraints are added as NOT VALID and then validated.
+
+    On Oracle, the bulk loaded tables (and schembl_chemical) can also be switched to NOLOGGING, so that direct-path
+    inserts and the index rebuilds generate minimal redo; they're switched back to LOGGING at the end. Data loaded
+    this way can't be recovered from the redo logs, so the database should be backed up afterwards.
+
+    The definitions of everything that was set aside are kept in a state file until they've been restored, so
+    that if a run fails, the next bulk mode run restores them instead.
+    """
+
+    SUPPORTED_DIALECTS = ('oracle', 'postgresql')
+
+    def __init__(self, db, state_file, parallel=4, nologging=False):
+        """
+        Create a new BulkLoadMode.
+        :param db: SQL Alchemy engine.
+        :param state_file: File to keep the definitions of indexes and constraints in, while they're set aside.
+        :param parallel: Degree of parallelism for rebuilding indexes and validating constraints.
+        :param nologging: Flag indicating whether the tables should be NOLOGGING while loading (Oracle only).
+        """
+        if db.dialect.name not in self.SUPPORTED_DIALECTS:
+            raise ValueError("Bulk mode is only supported for Oracle and PostgreSQL, not {}".format(db.dialect.name))
+        if nologging and db.dialect.name != 'oracle':
+            raise ValueError("NOLOGGING is only supported for Oracle, not {}".format(db.dialect.name))
+
+        self.db = db
+        self.state_file = state_file
+        self.parallel = parallel
+        self.nologging = nologging
+        self.oracle = db.dialect.name == 'oracle'
+
+    def disable(self):
+        """Set aside the secondary indexes and foreign keys of the bulk loaded tables, before loading"""
+
+        if os.path.exists(self.state_file):
+            logger.warn( "Bulk mode: indexes and constraints set aside by an earlier run will also be restored, from [{}]".format(self.state_file) )
+        state = self._read_state()
+
+        conn = self.db.connect()
+        try:
+            indexes, constraints = self._find_oracle(conn) if self.oracle else self._find_postgres(conn)
+            logged_tables = self._find_logged_tables(conn) if self.nologging else []
+        finally:
+            conn.close()
+
+        # Definitions saved by a failed run are kept, as they may no longer be found in the database
+        for name, index in indexes.items():
+            state['indexes'].setdefault(name, index)
+        for name, constraint in constraints.items():
+            state['constraints'].setdefault(name, constraint)
+        state['nologging'] = sorted( set(state['nologging']) | set(logged_tables) )
+
+        self._write_state(state)
+
+        logger.info( "Bulk mode: setting aside {} secondary indexes and {} foreign keys".format(len(indexes), len(constraints)) )
+
+        conn = self.db.connect()
+        try:
+            for name, constraint in sorted(constraints.items()):
+                if self.oracle:
+                    conn.execute( text("ALTER TABLE {} DISABLE CONSTRAINT {}".format(constraint['table'], name)) )
+                else:
+                    conn.execute( text("ALTER TABLE {} DROP CONSTRAINT {}".format(constraint['table'], name)) )
+
+            for name in sorted(indexes):
+                if self.oracle:
+                    conn.execute( text("ALTER INDEX {} UNUSABLE".format(name)) )
+                else:
+                    conn.execute( text("DROP INDEX {}".format(name)) )
+
+            for table in logged_tables:
+                conn.execute( text("ALTER TABLE {} NOLOGGING".format(table)) )
+        finally:
+            conn.close()
+
+        if len(logged_tables) > 0:
+            logger.info( "Bulk mode: switched {} tables to NOLOGGING".format(len(logged_tables)) )
+
+    def restore(self):
+        """
+        Rebuild the indexes and re-enable the foreign keys that were set aside, checking referential integrity.
+        :raises RuntimeError: if a constraint is violated by the loaded data; the state file is kept.
+        """
+
+        state = self._read_state()
+        if len(state['indexes']) == 0 and len(state['constraints']) == 0 and len(state['nologging']) == 0:
+            return
+
+        # Indexes are rebuilt without redo as well, if the tables were loaded that way
+        nologging = " NOLOGGING" if len(state['nologging']) > 0 else ""
+
+        logger.info( "Bulk mode: rebuilding {} secondary indexes".format(len(state['indexes'])) )
+
+        index_statements = []
+        for name, index in sorted(state['indexes'].items()):
+            if self.oracle:
+                index_statements.append( ["ALTER INDEX {} REBUILD PARALLEL {}{}".format(name, self.parallel, nologging),
+                                          "ALTER INDEX {} NOPARALLEL{}".format(name, " LOGGING" if nologging else "")] )
+            else:
+                index_statements.append( ["DROP INDEX IF EXISTS {}".format(name), index['definition']] )
+
+        self._run_parallel(index_statements)
+
+        logger.info( "Bulk mode: validating {} foreign keys".format(len(state['constraints'])) )
+
+        constraint_statements = []
+        for name, constraint in sorted(state['constraints'].items()):
+            table = constraint['table']
+            if self.oracle:
+                constraint_statements.append( ["ALTER TABLE {} ENABLE VALIDATE CONSTRAINT {}".format(table, name)] )
+            else:
+                constraint_statements.append( ["ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}".format(table, name),
+                                               "ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID".format(table, name, constraint['definition']),
+                                               "ALTER TABLE {} VALIDATE CONSTRAINT {}".format(table, name)] )
+
+        failures = self._run_parallel(constraint_statements, raise_errors=False)
+        if len(failures) > 0:
+            raise RuntimeError("Integrity check failed after bulk loading: {}".format("; ".join(failures)))
+
+        if len(state['nologging']) > 0:
+            self._run_parallel( [["ALTER TABLE {} LOGGING".format(table) for table in state['nologging']]] )
+            logger.warn( "Bulk mode: {} tables were loaded with NOLOGGING; back up the database, as the loaded data can't be recovered from the redo logs".format(len(state['nologging'])) )
+
+        os.remove(self.state_file)
+        logger.info("Bulk mode: indexes and foreign keys restored")
+
+    def _find_oracle(self, conn):
+        """Find the secondary indexes and foreign keys of the bulk loaded tables, in an Oracle schema"""
+
+        tables = ", ".join("'{}'".format(table.upper()) for table in CHILD_TABLES)
+
+        indexes = {}
+        for name, table in conn.execute( text("SELECT index_name, table_name FROM user_indexes "
+                                              "WHERE uniqueness = 'NONUNIQUE' AND table_name IN ({})".format(tables)) ):
+            indexes[name] = {'table': table}
+
+        constraints = {}
+        for name, table in conn.execute( text("SELECT constraint_name, table_name FROM user_constraints "
+                                              "WHERE constraint_type = 'R' AND table_name IN ({})".format(tables)) ):
+            constraints[name] = {'table': table}
+
+        return indexes, constraints
+
+    def _find_logged_tables(self, conn):
+        """Find the bulk loaded tables that are currently LOGGING, in an Oracle schema"""
+
+        tables = ", ".join("'{}'".format(table.upper()) for table in NOLOGGING_TABLES)
+
+        # NOLOGGING has no effect if the database forces logging, e.g. for a standby database
+        try:
+            if conn.execute( text("SELECT force_logging FROM v$database") ).scalar() == 'YES':
+                logger.warn("Bulk mode: the database is in FORCE LOGGING mode, so tables aren't switched to NOLOGGING")
+                return []
+        except DBAPIError, exc:
+            logger.info( "Bulk mode: unable to check for FORCE LOGGING mode ({})".format(str(exc.orig).strip()) )
+
+        return [row[0] for row in conn.execute( text("SELECT table_name FROM user_tables "
+                                                     "WHERE logging = 'YES' AND table_name IN ({})".format(tables)) )]
+
+    def _find_postgres(self, conn):
+        """Find the secondary indexes and foreign keys of the bulk loaded tables, with their definitions, in PostgreSQL"""
+
+        tables = ", ".join("'{}'".format(table) for table in CHILD_TABLES)
+
+        indexes = {}
+        for name, table, definition in conn.execute( text(
+                "SELECT i.indexname, i.tablename, i.indexdef FROM pg_indexes i "
+                "WHERE i.schemaname = current_schema() AND i.tablename IN ({}) "
+                "AND i.indexdef NOT LIKE 'CREATE UNIQUE %' "
+                "AND i.indexname NOT IN (SELECT conname FROM pg_constraint)".format(tables)) ):
+            indexes[name] = {'table': table, 'definition': definition}
+
+        constraints = {}
+        for name, table, definition in conn.execute( text(
+                "SELECT c.conname, t.relname, pg_get_constraintdef(c.oid) FROM pg_constraint c "
+                "JOIN pg_class t ON t.oid = c.conrelid JOIN pg_namespace n ON n.oid = t.relnamespace "
+                "WHERE c.contype = 'f' AND n.nspname = current_schema() AND t.relname IN ({})".format(tables)) ):
+            constraints[name] = {'table': table, 'definition': definition}
+
+        return indexes, constraints
+
+    def _run_parallel(self, statement_lists, raise_errors=True):
+        """
+        Run lists of statements concurrently, each list in order on its own connection.
+        :param raise_errors: Flag indicating whether database errors should be raised, or returned.
+        :return: List of error messages.
+        """
+
+        errors = []
+        lock = threading.Lock()
+        pending = list(statement_lists)
+
+        def worker():
+            while True:
+                with lock:
+                    if len(pending) == 0:
+                        return
+                    statements = pending.pop(0)
+
+                conn = self.db.connect()
+                try:
+                    for statement in statements:
+                        logger.info( "Bulk mode: {}".format(statement) )
+                        conn.execute( text(statement) )
+                except DBAPIError, exc:
+                    logger.error( "Bulk mode: statement failed: {}".format(exc) )
+                    with lock:
+                        errors.append( str(exc.orig).strip() )
+                finally:
+                    conn.close()
+
+        threads = [ threading.Thread(target=worker, name="bulk-mode-{}".format(i))
+                    for i in xrange(min(self.parallel, len(statement_lists))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if raise_errors and len(errors) > 0:
+            raise RuntimeError("Unable to rebuild indexes after bulk loading: {}".format("; ".join(errors)))
+
+        return errors
+
+    def _read_state(self):
+        if not os.path.exists(self.state_file):
+            return {'indexes': {}, 'constraints': {}, 'nologging': []}
+
+        with open(self.state_file) as state_file:
+            state = json.load(state_file)
+        state.setdefault('nologging', [])
+        return state
+
+    def _write_state(self, state):
+        temp_name = self.state_file + '.tmp'
+        with open(temp_name, 'w') as state_file:
+            json.dump(state, state_file, indent=2, sort_keys=True)
+        os.rename(temp_name, self.state_file)
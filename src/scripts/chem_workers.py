@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import logging
+import tempfile
+import threading
+import multiprocessing
+from array import array
+
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class ChemLoaderPool:
+    """
+    Loads chemical data files in parallel worker processes, each with its own database connection.
+
+    A worker process is forked for each task as it is dispatched, so it inherits a copy-on-write snapshot of the
+    loader's document ID map and known chemicals, as they stand at that point; the map is never pickled or copied
+    up front. Workers share a lock that serializes the "find existing / insert new" step for chemicals, so exactly
+    one worker inserts each new schembl_chemical record, while mappings are parsed and inserted fully in parallel.
+
+    Large, uncompressed chemical files are split into byte ranges that are loaded by separate workers. Each worker
+    writes its metrics to a temporary file when it finishes, and these are merged into the loader's metrics. The IDs
+    that workers learn (e.g. of the chemicals they insert) are merged into the loader's ID structures in the same
+    way, or from the journals of the loader's ID cache, if it has one, so that files loaded later by this process
+    (such as supplementary files) find them.
+    """
+
+    def __init__(self, loader, workers, chunksize=1000, partition_bytes=256 * 1024 * 1024):
+        """
+        Create a new ChemLoaderPool.
+        :param loader: DataLoader to fork workers from; its document ID map must be filled before tasks are submitted.
+        :param workers: Maximum number of concurrent worker processes.
+        :param chunksize: Processing chunk size for each worker (see DataLoader.load_chems); a number, or a chunk
+            sizer such as AdaptiveChunkSize, which each worker adapts a copy of, starting from its current size.
+        :param partition_bytes: Uncompressed files larger than this are split into partitions of this size.
+        """
+
+        self.loader = loader
+        self.workers = workers
+        self.chunksize = chunksize
+        self.partition_bytes = partition_bytes
+
+        self.running = []
+        self.failures = []
+
+        loader.chem_lock = multiprocessing.Lock()
+
+    def submit(self, file_name, update_mappings):
+        """
+        Load a chemical file, in the background, as soon as a worker is free.
+
+        Supplementary files (update_mappings) replace existing mappings, so they are loaded in this process once
+        all running workers have finished, rather than racing with other loads of the same mappings.
+        """
+
+        if update_mappings:
+            self.join()
+            self.loader.load_chems(file_name, True, self.chunksize)
+            return
+
+        for byte_range in self._partitions(file_name):
+            self._wait_for_workers(self.workers - 1)
+            self._start_worker(file_name, byte_range)
+
+    def join(self):
+        """
+        Wait for all running workers to finish.
+        :raise RuntimeError if any worker failed since the last call.
+        """
+
+        self._wait_for_workers(0)
+
+        # Workers with an ID cache journal their IDs there, rather than in their own files
+        if self.loader.id_cache is not None:
+            self.loader.id_cache.replay_journals(self.loader)
+
+        if len(self.failures) > 0:
+            failures = self.failures
+            self.failures = []
+            raise RuntimeError("Chemical loading failed for: {}".format(", ".join(failures)))
+
+    def _partitions(self, file_name):
+        """Split a file into byte ranges for loading, or [None] if it should be loaded whole"""
+
+        if file_name.endswith('.gz'):
+            return [None]
+
+        size = os.path.getsize(file_name)
+        if size <= self.partition_bytes:
+            return [None]
+
+        return [ (start, min(start + self.partition_bytes, size)) for start in xrange(0, size, self.partition_bytes) ]
+
+    def _start_worker(self, file_name, byte_range):
+
+        # Forked workers must open their own connections, rather than share the parent's pooled ones, or the
+        # loader's long-lived connection (and writer thread)
+        self.loader.close()
+        self.loader.db.dispose()
+
+        description = file_name if byte_range is None else "{} [{}:{}]".format(file_name, byte_range[0], byte_range[1])
+
+        handle, metrics_file = tempfile.mkstemp(prefix='schembl_worker_metrics_', suffix='.json')
+        os.close(handle)
+        handle, ids_file = tempfile.mkstemp(prefix='schembl_worker_ids_', suffix='.ids')
+        os.close(handle)
+
+        process = multiprocessing.Process(
+            target=_load_chems_worker,
+            args=(self.loader, file_name, self.chunksize, byte_range, metrics_file, ids_file),
+            name="chem-loader-{}".format(len(self.running)))
+        process.start()
+
+        logger.info( "Started chemical loading worker {} for [{}]".format(process.pid, description) )
+
+        self.running.append( (process, description, metrics_file, ids_file) )
+
+    def _wait_for_workers(self, max_running):
+        """Wait until no more than the given number of workers are running, recording any failures"""
+
+        while len(self.running) > max_running:
+
+            self.running[0][0].join(0.1)
+
+            still_running = []
+            for worker in self.running:
+                process, description, metrics_file, ids_file = worker
+                if process.is_alive():
+                    still_running.append(worker)
+                    continue
+
+                if process.exitcode != 0:
+                    logger.error( "Chemical loading worker {} failed for [{}]".format(process.pid, description) )
+                    self.failures.append(description)
+
+                self._merge_metrics(metrics_file)
+                self._merge_ids(ids_file)
+
+            self.running = still_running
+
+
+    def _merge_metrics(self, metrics_file):
+        """Merge the metrics written by a finished worker into the loader's metrics"""
+        try:
+            if os.path.getsize(metrics_file) > 0:
+                with open(metrics_file) as summary:
+                    self.loader.metrics.merge( json.load(summary) )
+        except (IOError, OSError, ValueError), exc:
+            logger.warn( "Unable to read worker metrics from [{}]: {}".format(metrics_file, exc) )
+        finally:
+            if os.path.exists(metrics_file):
+                os.remove(metrics_file)
+
+    def _merge_ids(self, ids_file):
+        """Merge the IDs written by a finished worker (see _write_ids) into the loader's ID structures"""
+        try:
+            size = os.path.getsize(ids_file)
+            if size > 0:
+                entries = array('l')
+                with open(ids_file, 'rb') as ids:
+                    entries.fromfile(ids, size // entries.itemsize)
+                doc_entries = 3 * entries[0]
+                self.loader.doc_id_map.replay( entries[1:1 + doc_entries] )
+                self.loader.existing_chemicals.update( entries[1 + doc_entries:] )
+        except (IOError, OSError, EOFError), exc:
+            logger.warn( "Unable to read worker IDs from [{}]: {}".format(ids_file, exc) )
+        finally:
+            if os.path.exists(ids_file):
+                os.remove(ids_file)
+
+
+def _write_ids(loader, ids_file):
+    """Write the IDs journalled by a worker's loader: the number of documents, then their entries, then chemical IDs"""
+    doc_journal = loader.doc_id_map.journal
+    with open(ids_file, 'wb') as ids:
+        entries = array('l', [len(doc_journal) // 3])
+        entries.extend(doc_journal)
+        entries.extend(loader.existing_chemicals.journal)
+        entries.tofile(ids)
+
+
+def _load_chems_worker(loader, file_name, chunksize, byte_range, metrics_file, ids_file):
+    """Entry point for worker processes"""
+
+    # Other threads of the parent (e.g. downloads) may have held logging locks when the worker was forked
+    logging._lock = threading.RLock()
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+
+    # Start with empty metrics, so the parent's aren't counted twice when they're merged back
+    loader.metrics = Metrics()
+    if hasattr(chunksize, 'metrics'):
+        chunksize.metrics = loader.metrics
+
+    # Journal the IDs learned, to pass back to the parent; an ID cache journals them itself
+    journal_ids = loader.id_cache is None
+    if journal_ids:
+        loader.doc_id_map.journal = array('l')
+        loader.existing_chemicals.journal = array('l')
+
+    try:
+        loader.load_chems(file_name, False, chunksize, byte_range)
+        loader.close()
+        if journal_ids:
+            _write_ids(loader, ids_file)
+    except Exception:
+        logger.exception( "Chemical loading failed for [{}]".format(file_name) )
+        sys.exit(1)
+    finally:
+        loader.metrics.write_summary(metrics_file)
@@ -0,0 +1,174 @@
+import sys
+import logging
+
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class FixedChunkSize:
+    """Chunk size that never changes; the default for DataLoader.load_biblio and load_chems"""
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Chunk size must be at least 1, not {}".format(size))
+        self.size = size
+
+    def record(self, records, seconds):
+        """Ignore the timing of a processed chunk"""
+        pass
+
+
+class AdaptiveChunkSize:
+    """
+    Chunk size that adapts to the throughput of the database, within limits on the time taken by each chunk (and so
+    on the length of its transactions) and on the memory taken by the records of a chunk.
+
+    The size starts at the initial value, and is doubled for as long as the throughput (records written per second)
+    keeps improving by at least the given tolerance. Once it stops improving, the size goes back to the best one
+    seen, and is held there; growth is re-tried every so many chunks, as the database's performance changes while
+    tables grow. A chunk that takes longer than max_seconds halves the size straight away, and the size is always
+    capped so that the estimated memory of a chunk stays under max_bytes.
+
+    A loader reports each chunk it has processed with record(), and reads the size for its next chunk from size.
+    Every change of size is logged, and the current size is kept as the chunk_size gauge of the run metrics.
+    """
+
+    def __init__(self, name, initial=1000, minimum=100, maximum=50000, max_seconds=30.0, max_bytes=256 * 1024 * 1024,
+                 tolerance=0.1, reprobe=50, metrics=None):
+        """
+        Create a new AdaptiveChunkSize.
+        :param name: Kind of chunks being sized (e.g. "biblio"), for logging and metrics.
+        :param initial: Initial chunk size.
+        :param minimum: Smallest chunk size to use.
+        :param maximum: Largest chunk size to use.
+        :param max_seconds: Processing time per chunk above which the size is reduced.
+        :param max_bytes: Estimated memory per chunk that the size is capped to.
+        :param tolerance: Relative improvement in throughput needed to keep growing the size.
+        :param reprobe: Number of chunks to hold a size for, before trying a larger one again.
+        :param metrics: Optional Metrics object, to keep the current size in.
+        """
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("Chunk sizes must satisfy 1 <= minimum <= initial <= maximum; got {}, {}, {}".format(minimum, initial, maximum))
+
+        self.name = name
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.reprobe = reprobe
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.growing = True         # Whether the size is still being increased
+        self.held = 0               # Number of chunks processed at the held size
+        self.best_size = None       # Size with the highest throughput so far, and that throughput
+        self.best_rate = 0.0
+        self.last_rate = None       # Throughput at the current size, if measured
+        self.record_bytes = None    # Estimated memory per record
+
+        self.metrics.set('chunk_size', self.size, kind=self.name)
+
+    def record(self, records, seconds):
+        """
+        Adjust the chunk size, given a chunk that has been processed.
+        :param records: The records of the chunk (a list, or a DataFrame).
+        :param seconds: Time taken to process the chunk (lookups and database writes).
+        """
+
+        count = len(records)
+        if count == 0:
+            return
+
+        self.record_bytes = estimate_bytes(records) / float(count)
+        memory_limit = max(self.minimum, int(self.max_bytes / self.record_bytes))
+
+        rate = count / max(seconds, 1e-6)
+
+        if seconds > self.max_seconds and self.size > self.minimum:
+            self.growing = False
+            self._resize( self.size // 2, "chunk took {:.1f}s, over the {:.1f}s limit".format(seconds, self.max_seconds), rate )
+
+        elif self.size > memory_limit:
+            self.growing = False
+            self._resize( memory_limit, "chunks would exceed the memory limit of {} MB".format(self.max_bytes // (1024 * 1024)), rate )
+
+        elif count < self.size:
+            # A short (final) chunk says little about the throughput at this size
+            return
+
+        elif self.growing:
+            if rate > self.best_rate:
+                self.best_size, self.best_rate = self.size, rate
+
+            if self.last_rate is None or rate >= self.last_rate * (1 + self.tolerance):
+                if self.size >= min(self.maximum, memory_limit):
+                    self.growing = False
+                    self.held = 0
+                    self.last_rate = rate
+                    return
+                self.last_rate = rate
+                self._resize( min(self.size * 2, self.maximum, memory_limit), "throughput improving", rate )
+            else:
+                self.growing = False
+                self._resize( self.best_size, "throughput no longer improving", rate )
+
+        else:
+            self.held += 1
+            if self.held >= self.reprobe and self.size < min(self.maximum, memory_limit):
+                self.growing = True
+                self.best_size, self.best_rate = self.size, rate
+                self.last_rate = rate
+                self._resize( min(self.size * 2, self.maximum, memory_limit), "trying a larger size", rate )
+
+    def _resize(self, size, reason, rate):
+        """Change the chunk size, and log the change"""
+
+        size = max(self.minimum, min(self.maximum, size))
+        self.held = 0
+
+        if size == self.size:
+            return
+
+        if not self.growing:
+            self.last_rate = None
+
+        logger.info( "Chunk size for {} changed from {} to {} ({}; {:.0f} records/s)".format(self.name, self.size, size, reason, rate) )
+
+        self.size = size
+        self.metrics.set('chunk_size', size, kind=self.name)
+
+
+def chunk_sizer(chunksize):
+    """Return the given chunk sizer, or a FixedChunkSize for a plain number"""
+    if hasattr(chunksize, 'record'):
+        return chunksize
+    return FixedChunkSize(chunksize)
+
+
+def estimate_bytes(records, samples=20):
+    """
+    Estimate the memory taken by a chunk of records, from the sizes of a few of them.
+    :param records: List of records (dicts, lists, tuples and strings, nested in any way), or a DataFrame.
+    :param samples: Maximum number of records to measure.
+    """
+
+    if hasattr(records, 'memory_usage'):
+        return int( records.memory_usage(deep=True).sum() )
+
+    count = len(records)
+    if count == 0:
+        return 0
+
+    step = max(1, count // samples)
+    sample = records[::step][:samples]
+    return int( sum(_deep_size(record) for record in sample) * count / float(len(sample)) )
+
+
+def _deep_size(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key) + _deep_size(value) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(item) for item in obj)
+    return size
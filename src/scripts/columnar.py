@@ -0,0 +1,171 @@
+"""
+Optional columnar parsing of chemical data files, using pandas and NumPy. Each chunk of the file is parsed into
+typed column arrays by pandas' C tokenizer, and the chemical, structure and mapping records are then built with
+array operations rather than row by row. Only used if the DataLoader is created with columnar=True.
+"""
+
+import csv
+import logging
+from itertools import chain
+
+try:
+    import numpy
+    import pandas
+    from pandas.errors import ParserError
+except ImportError:
+    numpy = None
+    pandas = None
+
+logger = logging.getLogger(__name__)
+
+# Column types; see the DataLoader docstring for the column layout. All remaining columns are kept as strings.
+CHEM_COLUMN_TYPES = dict( [(1, 'int64'), (6, 'float64'), (10, 'float64')] +
+                          [(col, 'int64') for col in (7, 8, 9, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20)] +
+                          [(col, 'object') for col in (0, 2, 3, 4, 5)] )
+
+CHEM_RECORD_COLS = len(CHEM_COLUMN_TYPES)
+
+# Column order of chemical and structure records, as inserted by the DataLoader
+CHEM_COLUMNS = [1, 6, 10, 8, 9, 11, 12, 13, 14, 7]
+STRUCTURE_COLUMNS = [1, 2, 3, 4]
+
+# Field count columns, and the DocumentField value for each: title, abstract, claims, description, images,
+# attachments
+COUNT_COLUMNS = [15, 16, 17, 18, 19, 20]
+COUNT_FIELDS = [4, 3, 2, 1, 5, 6]
+
+
+def available():
+    """Check whether pandas and NumPy are installed"""
+    return pandas is not None
+
+
+def read_chem_frames(first_line, chunks, header_row, sizer):
+    """
+    Parse chemical data into DataFrames.
+    :param first_line: The first line of input (UTF-8 encoded); checked against the header row if it is one.
+    :param chunks: Iterator over the rest of the input, as UTF-8 encoded strings (e.g. lines or file blocks).
+    :param header_row: Expected header row.
+    :param sizer: Chunk sizer, giving the number of records for each DataFrame as it is read.
+    :return: Generator of DataFrames, with integer column labels.
+    """
+
+    if first_line.startswith('SCPN\t'):
+        if first_line.rstrip('\r\n').decode('utf-8').split('\t') != header_row:
+            raise RuntimeError("Malformed header detected in chemical data file")
+    elif len(first_line) > 0:
+        chunks = chain([first_line], chunks)
+
+    # The tokenizer takes the number of columns from the first record, and rejects any longer records after it;
+    # shorter records fail type conversion (ValueError)
+    input_file = ChunkReader(chunks)
+    first_record = input_file.peekline()
+    if len(first_record) > 0 and len(next(csv.reader([first_record], delimiter='\t'))) != CHEM_RECORD_COLS:
+        raise RuntimeError("Incorrect number of columns detected in chemical data file")
+
+    reader = pandas.read_csv( input_file, sep='\t', header=None, dtype=CHEM_COLUMN_TYPES, na_filter=False,
+                              float_precision='round_trip', encoding='utf-8', engine='c', iterator=True )
+
+    try:
+        while True:
+            try:
+                frame = reader.get_chunk(sizer.size)
+            except StopIteration:
+                return
+            if frame.shape[1] != CHEM_RECORD_COLS:
+                raise RuntimeError("Incorrect number of columns detected in chemical data file")
+            yield frame
+    except ParserError, exc:
+        logger.error( "Failed to parse chemical data: {}".format(exc) )
+        raise RuntimeError("Incorrect number of columns detected in chemical data file")
+    except pandas.errors.EmptyDataError:
+        return
+
+
+def chem_frame_records(frame, doc_id_map, existing_chemicals, wide=False):
+    """
+    Build insert records from a DataFrame of chemical data.
+    :param doc_id_map: Mapping of SCPNs to document IDs; rows for unknown documents are skipped.
+    :param existing_chemicals: Set of chemical IDs known to exist; records are only built for other chemicals.
+    :param wide: Flag indicating whether to build one mapping record per row, with all six counts, rather than one
+        per field.
+    :return: Tuple of (new chemical records, new structure records, set of new chemical IDs, mapping records, list
+        of SCPNs that weren't found, number of rows skipped for them)
+    """
+
+    # Look up each distinct SCPN once
+    scpn_codes, scpns = pandas.factorize( frame[0].values )
+    doc_ids = numpy.array( [doc_id_map.get(scpn, -1) for scpn in scpns], dtype='int64' )
+
+    row_doc_ids = doc_ids[scpn_codes]
+    found = row_doc_ids >= 0
+    skipped = len(frame) - int(found.sum())
+    missing_scpns = [scpn for scpn, doc_id in zip(scpns, doc_ids) if doc_id < 0]
+
+    if skipped > 0:
+        frame = frame[found]
+        row_doc_ids = row_doc_ids[found]
+
+    # New chemicals, in order of first appearance
+    chem_codes, chem_ids = pandas.factorize( frame[1].values )
+    first_rows = numpy.unique(chem_codes, return_index=True)[1]
+    new = numpy.array( [chem_id not in existing_chemicals for chem_id in chem_ids.tolist()], dtype=bool )
+    new_rows = frame.iloc[ first_rows[new] ]
+
+    new_chems = zip( *[new_rows[col].tolist() for col in CHEM_COLUMNS] )
+    new_chem_structs = zip( *[new_rows[col].tolist() for col in STRUCTURE_COLUMNS] )
+    new_chem_ids = set( chem_ids[new].tolist() )
+
+    if wide:
+        new_mappings = zip( row_doc_ids.tolist(), frame[1].tolist(), *[frame[col].tolist() for col in COUNT_COLUMNS] )
+        return new_chems, new_chem_structs, new_chem_ids, new_mappings, missing_scpns, skipped
+
+    # Six mappings per row, one for each field
+    fields = len(COUNT_FIELDS)
+    new_mappings = zip( numpy.repeat(row_doc_ids, fields).tolist(),
+                        numpy.repeat(frame[1].values, fields).tolist(),
+                        numpy.tile(COUNT_FIELDS, len(frame)).tolist(),
+                        frame[COUNT_COLUMNS].values.ravel().tolist() )
+
+    return new_chems, new_chem_structs, new_chem_ids, new_mappings, missing_scpns, skipped
+
+
+class ChunkReader:
+    """Read-only binary file object over an iterator of strings, as required by pandas.read_csv"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def peekline(self):
+        """Return the first line of the remaining input, without consuming it"""
+        while '\n' not in self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return self.buffer
+            self.buffer += chunk
+        return self.buffer[:self.buffer.index('\n') + 1]
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(parts)
+        if size < 0 or length <= size:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def __iter__(self):
+        if len(self.buffer) > 0:
+            yield self.buffer
+            self.buffer = ''
+        for chunk in self.chunks:
+            yield chunk
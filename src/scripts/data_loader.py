@@ -4,12 +4,26 @@ import json
 import csv
 import re
 import time
+import gzip
+import subprocess
+from distutils.spawn import find_executable
 from datetime import datetime
-from sqlalchemy import MetaData, Table, ForeignKey, Column, Sequence, Integer, Float, SmallInteger, Date, Text, select, bindparam, String
+from itertools import islice
+from cStringIO import StringIO
+from .id_store import ChemicalIdSet, DocumentIdMap
+from .metrics import Metrics
+from .temp_tables import TempTable
+from .chunk_sizing import chunk_sizer
+from .background_writer import BackgroundWriter
+from . import columnar
+from sqlalchemy import MetaData, Table, ForeignKey, Column, Sequence, Integer, Float, SmallInteger, BigInteger, Date, Text, select, String, text, event, DDL
 # from sqlalchemy import String as _String
 
 logger = logging.getLogger(__name__)
 
+# External decompressor for gzipped data files, used through a pipe when available
+PIGZ_PATH = find_executable('pigz')
+
 # Behaviour of the SQLAlchemy data type String is modified here for the case of Oracle
 # database. Without this modification you'll end up with full table scans for queries
 # associated with VARCHAR Oracle column type, even if indexes are presented for such
@@ -44,6 +58,21 @@ class DocumentField:
     IMAGES      = 5
     ATTACHMENTS = 6
 
+# Count columns of the wide document/chemistry table, in the order of the chemical data file columns, with the
+# field each one corresponds to in the narrow table
+WIDE_MAPPING_COLUMNS = [('title_count',       DocumentField.TITLE),
+                        ('abstract_count',    DocumentField.ABSTRACT),
+                        ('claims_count',      DocumentField.CLAIMS),
+                        ('description_count', DocumentField.DESCRIPTION),
+                        ('image_count',       DocumentField.IMAGES),
+                        ('attachment_count',  DocumentField.ATTACHMENTS)]
+
+# Compatibility view, presenting the non-zero counts of the wide table in the shape of the narrow one (see
+# schema/sc_data_wide.sql)
+WIDE_MAPPING_VIEW_SQL = "CREATE VIEW schembl_document_chemistry AS " + " UNION ALL ".join(
+    "SELECT schembl_doc_id, schembl_chem_id, CAST({1} AS SMALLINT) AS field, {0} AS frequency "
+    "FROM schembl_document_chemistry_wide WHERE {0} > 0".format(column, field) for column, field in WIDE_MAPPING_COLUMNS)
+
 class DocumentClass:
     """Contains constants and helper methods for document classification"""
 
@@ -109,7 +138,15 @@ class DataLoader:
                  load_titles=True,
                  load_classifications=True,
                  overwrite=False,
-                 allow_doc_dups=True):
+                 allow_doc_dups=True,
+                 pg_copy=False,
+                 metrics=None,
+                 columnar_chems=False,
+                 async_writes=False,
+                 sparse_mappings=False,
+                 wide_mappings=False,
+                 table_suffix='',
+                 direct_path=False):
         """
         Create a new DataLoader.
         :param db: SQL Alchemy database connection.
@@ -119,6 +156,22 @@ class DataLoader:
         :param overwrite Flag indicating if existing documents should be overwritten - results in all existing 
             titles, classifications, and mappings being replaced for the document!
         :param allow_doc_dups: Flag indicating whether duplicate documents should be ignored
+        :param pg_copy: Flag indicating whether bulk inserts should use COPY FROM STDIN (PostgreSQL only)
+        :param metrics: Optional Metrics object that receives timings and counts for each loading phase.
+        :param columnar_chems: Flag indicating whether chemical files should be parsed into columnar batches with
+            pandas and NumPy (which must be installed), rather than row by row.
+        :param async_writes: Flag indicating whether titles, classifications, chemicals, structures and mappings
+            should be written by a background thread, on its own connection, while the next chunk is parsed.
+        :param sparse_mappings: Flag indicating whether document/chemical mappings with a frequency of zero should be
+            left out, rather than written for every field.
+        :param wide_mappings: Flag indicating whether document/chemical mappings should be written to the wide
+            table, schembl_document_chemistry_wide, with one row per document/chemical pair and a column for each
+            field, rather than one row per field.
+        :param table_suffix: Suffix for the names of the document tables (documents, titles, classifications and
+            mappings) and the document ID sequence, e.g. to load a year into standalone staging tables that are
+            swapped in as a partition afterwards (see PartitionSwap). The chemical tables are shared.
+        :param direct_path: Flag indicating whether chemicals, structures, mappings, titles and classifications
+            should be inserted by direct path, with the APPEND_VALUES hint (Oracle only; see DirectPathBatcher).
         """
 
         logger.info( "Life-sci relevant classes: {}".format(relevant_classes) )
@@ -130,32 +183,77 @@ class DataLoader:
         self.load_classifications = load_classifications
         self.overwrite            = overwrite
         self.allow_document_dups  = allow_doc_dups
+        self.pg_copy              = pg_copy
+        self.metrics              = metrics if metrics is not None else Metrics()
+        self.columnar_chems       = columnar_chems
+        self.async_writes         = async_writes
+        self.sparse_mappings      = sparse_mappings
+        self.wide_mappings        = wide_mappings
+        self.table_suffix         = table_suffix
+        self.direct_path          = direct_path
+
+        if pg_copy and db.dialect.name != 'postgresql':
+            raise ValueError("COPY based loading is only supported for PostgreSQL, not {}".format(db.dialect.name))
+
+        if direct_path and db.dialect.name != 'oracle':
+            raise ValueError("Direct-path inserts are only supported for Oracle, not {}".format(db.dialect.name))
+
+        if columnar_chems and not columnar.available():
+            raise ValueError("Columnar parsing of chemical files requires pandas and NumPy, which aren't installed")
+
+        if async_writes and db.dialect.name == 'sqlite' and db.url.database in (None, '', ':memory:'):
+            raise ValueError("Asynchronous writes need a second connection to the database, which in-memory SQLite databases don't allow")
 
         self.relevant_regex = re.compile( '|'.join(relevant_classes) )
+        self.paramstyle = db.dialect.paramstyle
+        self.batch_errors = db.dialect.driver == 'cx_oracle'
+
+        # Mappings from supplementary files are merged into place with a single statement per chunk where the
+        # database supports it, rather than deleted and re-inserted one by one
+        self.merge_mappings = db.dialect.name in ('oracle', 'postgresql') or \
+            (db.dialect.name == 'sqlite' and db.dialect.dbapi.sqlite_version_info >= (3, 24, 0))
 
         self.metadata = MetaData()
-        self.doc_id_map = dict()
-        self.existing_chemicals = set()
+        self.doc_id_map = DocumentIdMap()
+        self.existing_chemicals = ChemicalIdSet()
+
+        # Optional lock, shared by processes that load chemicals in parallel (see ChemLoaderPool)
+        self.chem_lock = None
+
+        # Optional persistent cache of the above IDs, updated after every commit (see IdCache)
+        self.id_cache = None
+
+        # Whether the document table is partitioned, so that SCPNs are only unique within each partition; found on
+        # first use (see _documents_partitioned)
+        self.docs_partitioned = None
+
+        # Long-lived connection, background writer, and batcher for each operation (with its cursor and prepared
+        # statement), reused by all load_biblio and load_chems calls until close()
+        self.sql_alc_conn = None
+        self.writer = None
+        self.batchers = {}
 
         # This SQL Alchemy schema is a very useful programmatic tool for manipulating and querying the SureChEMBL data.
         # It's mostly used for testing, except for document insertion where 'inserted_primary_key' is used to
         # avoid costly querying of document IDs
 
-        self.docs = Table('schembl_document', self.metadata,
-                     Column('id',                Integer,       Sequence('schembl_document_id'), primary_key=True),
+        doc_id_ref = 'schembl_document{}.id'.format(table_suffix)
+
+        self.docs = Table('schembl_document' + table_suffix, self.metadata,
+                     Column('id',                Integer,       Sequence('schembl_document_id' + table_suffix), primary_key=True),
                      Column('scpn',              String(50),    unique=True),
                      Column('published',         Date()),
                      Column('life_sci_relevant', SmallInteger()),
                      Column('assign_applic',     String(1000)),                     
                      Column('family_id',         Integer))
 
-        self.titles = Table('schembl_document_title', self.metadata,
-                     Column('schembl_doc_id',    Integer,       ForeignKey('schembl_document.id'), primary_key=True),
+        self.titles = Table('schembl_document_title' + table_suffix, self.metadata,
+                     Column('schembl_doc_id',    Integer,       ForeignKey(doc_id_ref), primary_key=True),
                      Column('lang',              String(10),    primary_key=True),
                      Column('text',              Text()))
 
-        self.classes = Table('schembl_document_class', self.metadata,
-                     Column('schembl_doc_id',    Integer,        ForeignKey('schembl_document.id'), primary_key=True),
+        self.classes = Table('schembl_document_class' + table_suffix, self.metadata,
+                     Column('schembl_doc_id',    Integer,        ForeignKey(doc_id_ref), primary_key=True),
                      Column('class',             String(100),    primary_key=True),
                      Column('system',            SmallInteger(), primary_key=True))
 
@@ -177,20 +275,59 @@ class DataLoader:
                      Column('std_inchi',         Text()),
                      Column('std_inchikey',      String(27)))
 
-        self.chem_mapping = Table('schembl_document_chemistry', self.metadata,
-                     Column('schembl_doc_id',   Integer,      ForeignKey('schembl_document.id'), primary_key=True),
+        if wide_mappings:
+
+            # The narrow table is replaced by a view of the same name, created along with the wide table
+            self.chem_mapping = Table('schembl_document_chemistry_wide' + table_suffix, self.metadata,
+                     Column('schembl_doc_id',   Integer,      ForeignKey(doc_id_ref), primary_key=True),
+                     Column('schembl_chem_id',  Integer,      ForeignKey('schembl_chemical.id'), primary_key=True, index=True),
+                     *[Column(column,           Integer) for column, _ in WIDE_MAPPING_COLUMNS])
+
+            if not table_suffix:
+                event.listen(self.chem_mapping, 'after_create', DDL(WIDE_MAPPING_VIEW_SQL))
+                event.listen(self.chem_mapping, 'before_drop', DDL("DROP VIEW schembl_document_chemistry"))
+
+            self.mapping_keys = ('schembl_doc_id', 'schembl_chem_id')
+            self.mapping_values = tuple(column for column, _ in WIDE_MAPPING_COLUMNS)
+
+            # Distinct from the narrow staging table, which may persist (as an Oracle global temporary table)
+            self.mapping_staging = 'schembl_doc_chem_wide_merge'
+
+        else:
+
+            self.chem_mapping = Table('schembl_document_chemistry' + table_suffix, self.metadata,
+                     Column('schembl_doc_id',   Integer,      ForeignKey(doc_id_ref), primary_key=True),
                      Column('schembl_chem_id',  Integer,      ForeignKey('schembl_chemical.id'), primary_key=True),
                      Column('field',            SmallInteger, primary_key=True),
                      Column('frequency',        Integer))
 
-        # Define types for chemical structure inserts
+            self.mapping_keys = ('schembl_doc_id', 'schembl_chem_id', 'field')
+            self.mapping_values = ('frequency',)
+            self.mapping_staging = 'schembl_doc_chem_merge'
+
+        # Temporary tables for set-based lookups and overwrites of documents and chemicals, instead of IN lists,
+        # so that chunk sizes aren't limited by the number of literals a statement can hold (see TempTable)
+        self.doc_lookup = TempTable(db, 'schembl_tmp_doc_lookup',
+                     Column('scpn',              String(50),    primary_key=True))
+
+        self.chem_lookup = TempTable(db, 'schembl_tmp_chem_lookup',
+                     Column('id',                BigInteger,    primary_key=True))
+
+        self.doc_overwrite = TempTable(db, 'schembl_tmp_doc_overwrite',
+                     Column('id',                Integer,       primary_key=True),
+                     Column('published',         Date()),
+                     Column('life_sci_relevant', SmallInteger()),
+                     Column('assign_applic',     String(1000)),
+                     Column('family_id',         Integer))
+
+        # Define the LOB bind type for long structures and titles (see LobBatcher)
         if ("cx_oracle" in str(db.dialect)):
-            logger.info( "cx_oracle dialect detected, setting CLOB input types for structure INSERT statements."\
-                         " (required for long strings inserted as part of executemany operations)" )
+            logger.info( "cx_oracle dialect detected, binding structures and titles over {} bytes as CLOBs."\
+                         " (required for long strings inserted as part of executemany operations)".format(LobBatcher.STRING_BIND_LIMIT) )
             import cx_Oracle
-            self.chem_struc_types = (None, cx_Oracle.CLOB, cx_Oracle.CLOB, None)
+            self.lob_type = cx_Oracle.CLOB
         else:
-            self.chem_struc_types = None
+            self.lob_type = None
 
 
     def db_metadata(self):
@@ -201,29 +338,94 @@ class DataLoader:
         """Accessor for the list of classifications to treat as relevant"""
         return self.relevant_classes
 
+    def close(self):
+        """
+        Release the loader's connection, background writer and cached batchers. They're opened again if the loader
+        is used after this; it must be called before forking processes that use the loader.
+        """
+
+        batchers, self.batchers = self.batchers, {}
+        writer, self.writer = self.writer, None
+        sql_alc_conn, self.sql_alc_conn = self.sql_alc_conn, None
+
+        try:
+            for batcher in batchers.values():
+                batcher.close()
+            if writer is not None:
+                writer.close()
+        finally:
+            if sql_alc_conn is not None:
+                sql_alc_conn.close()
+
+    def _connection(self):
+        """Return the loader's connection, opening it on first use"""
+        if self.sql_alc_conn is None:
+            self.sql_alc_conn = self.db.connect()
+        return self.sql_alc_conn
+
+    def _batcher(self, name, factory):
+        """
+        Return the batcher for the named operation, creating it on first use, on the loader's connection, or on the
+        background writer's if asynchronous writes are enabled.
+        :param factory: Function that creates the batcher, given a DB-API connection.
+        """
+
+        batcher = self.batchers.get(name)
+        if batcher is not None:
+            return batcher
+
+        if self.async_writes:
+            if self.writer is None:
+                self.writer = BackgroundWriter(self.db, metrics=self.metrics)
+            batcher = self.writer.batcher(factory)
+        else:
+            batcher = factory(self._connection().connection)
+
+        self.batchers[name] = batcher
+        return batcher
+
+    def _insert_batcher(self, db_api_conn, table, columns, phase, types=None):
+        """Create a batcher for bulk insertion into the given table, using COPY or direct path if enabled"""
+        if self.pg_copy:
+            return CopyBatcher(db_api_conn, table, columns, metrics=self.metrics, phase=phase)
+        if self.direct_path:
+            return DirectPathBatcher(db_api_conn, self._insert_sql(table, columns), types, metrics=self.metrics, phase=phase)
+        return DBBatcher(db_api_conn, self._insert_sql(table, columns), types, batch_errors=self.batch_errors,
+                         metrics=self.metrics, phase=phase)
+
+    def _lob_insert_batcher(self, db_api_conn, table, columns, phase, lob_columns):
+        """Create an insert batcher for a table with CLOB columns, binding only oversized values as LOBs on Oracle"""
+        if self.lob_type is None:
+            return self._insert_batcher(db_api_conn, table, columns, phase)
+        lob_types = tuple(self.lob_type if i in lob_columns else None for i in range(len(columns)))
+        return LobBatcher(self._insert_batcher(db_api_conn, table, columns, phase),
+                          self._insert_batcher(db_api_conn, table, columns, phase, lob_types),
+                          lob_columns, metrics=self.metrics, phase=phase)
+
+    def _insert_sql(self, table, columns):
+        """Build a DB-API insert statement for the given table and columns, using the dialect's bind style"""
+        return 'insert into {} ({}) values ({})'.format(
+            table, ', '.join(columns), ', '.join(bind_params(self.paramstyle, len(columns))))
+
 
     def load_biblio(self, file_name, preload_ids=False, chunksize=1000):
         """
         Load bibliographic data into the database. Identifiers for new documents will be retained
-        for reference by the load_chems method.
-        :param file_name: JSON biblio file to import.
-        :param chunksize: Processing chunk size, affecting bulk insertion of some records.
+        for reference by the load_chems method. The input file is streamed one record at a time (twice, if
+        IDs are preloaded), so memory usage depends on the chunk size rather than the file size.
+        :param file_name: JSON biblio file to import; may be gzipped (.gz).
+        :param chunksize: Processing chunk size, affecting bulk insertion of some records; a number, or a chunk
+            sizer such as AdaptiveChunkSize.
         """
 
-        logger.info( "Loading biblio data from [{}], with chunk size {}. Preload IDs? {}".format(file_name, chunksize, preload_ids) )
+        sizer = chunk_sizer(chunksize)
 
-        input_file = codecs.open(file_name, 'r', 'utf-8')
-        biblio = json.load(input_file)
+        logger.info( "Loading biblio data from [{}], with chunk size {}. Preload IDs? {}".format(file_name, sizer.size, preload_ids) )
 
-        sql_alc_conn = self.db.connect()
-        db_api_conn = sql_alc_conn.connection
+        sql_alc_conn = self._connection()
 
-        if ("cx_oracle" in str(self.db.dialect)):
-            title_ins = DBBatcher(db_api_conn, 'insert into schembl_document_title (schembl_doc_id, lang, text) values (:1, :2, :3)')
-            classes_ins = DBBatcher(db_api_conn, 'insert into schembl_document_class (schembl_doc_id, class, system) values (:1, :2, :3)')
-        else:
-            title_ins = DBBatcher(db_api_conn, 'insert into schembl_document_title (schembl_doc_id, lang, text) values (%s, %s, %s)')
-            classes_ins = DBBatcher(db_api_conn, 'insert into schembl_document_class (schembl_doc_id, class, system) values (%s, %s, %s)')
+        title_ins = self._batcher('title_insert', lambda conn: self._lob_insert_batcher(conn, self.titles.name, ('schembl_doc_id', 'lang', 'text'), 'title_insert', (2,)))
+        classes_ins = self._batcher('class_insert', lambda conn: self._insert_batcher(conn, self.classes.name, ('schembl_doc_id', 'class', 'system'), 'class_insert'))
 
 
         ########################################################################
@@ -234,7 +436,12 @@ class DataLoader:
 
         if self.overwrite or preload_ids:
 
-            for chunk in chunks(biblio, chunksize):
+            input_count = 0
+            input_file = open_data_file(file_name, self.metrics)
+
+            for chunk in self.metrics.timed_iter(chunks(iter_biblio(input_file), sizer), 'phase_seconds', exclude=timed_reader(input_file), phase='parse'):
+
+                input_count += len(chunk[1])
 
                 # Loop over all biblio entries in this chunk
                 doc_nums = set()
@@ -253,31 +460,34 @@ class DataLoader:
                     continue
 
                 self._fill_doc_id_map(doc_nums, sql_alc_conn, extant_docs)
+                self._flush_id_cache()
+
+            input_file.close()
 
-            logger.info( "Discovered {} existing IDs for {} input documents".format( len(extant_docs),len(biblio)) )
+            logger.info( "Discovered {} existing IDs for {} input documents".format( len(extant_docs),input_count) )
 
 
         ########################################################
         # STEP 2: Main biblio record processing loop (chunked) #
         ########################################################
 
-        for chunk in chunks(biblio, chunksize):
+        input_file = open_data_file(file_name, self.metrics)
+
+        for chunk in self.metrics.timed_iter(chunks(iter_biblio(input_file), sizer), 'phase_seconds', exclude=timed_reader(input_file), phase='parse'):
 
             logger.debug( "Processing {} biblio records, up to index {}".format(len(chunk[1]), chunk[0]) )
 
-            new_doc_mappings = dict()   # Collection IDs for totally new document 
+            chunk_start = time.time()
+
+            new_doc_records  = []       # Document records for bulk insertion
             overwrite_docs   = []       # Document records for overwriting
             duplicate_docs   = set()    # Set of duplicates to read IDs for
             known_count      = 0        # Count of known documents
+            detail_docs      = []       # (bib, pubnumber, known doc ID) for title/class extraction
 
             new_titles = []
             new_classes = []        
 
-            doc_insert_time = 0
-
-
-            transaction = sql_alc_conn.begin()
-
             for bib in chunk[1]:
 
                 ########################################
@@ -293,7 +503,8 @@ class DataLoader:
                 # Step 2.2 Overwrite or Insert the document record #
                 ####################################################
 
-                if pubnumber in extant_docs:
+                # With an ID cache, documents in the ID map are known to exist, as if their IDs had been preloaded
+                if pubnumber in extant_docs or (self.id_cache is not None and pubnumber in self.doc_id_map):
 
                     known_count += 1
 
@@ -301,11 +512,12 @@ class DataLoader:
                         # Create an overwrite record
                         doc_id = self.doc_id_map[pubnumber]                    
                         overwrite_docs.append({
-                            'extant_id'             : doc_id,
-                            'new_published'         : pubdate,
-                            'new_family_id'         : family_id,
-                            'new_life_sci_relevant' : life_sci_relevant,
-                            'new_assign_applic'     : assign_applic })
+                            'id'                : doc_id,
+                            'published'         : pubdate,
+                            'family_id'         : family_id,
+                            'life_sci_relevant' : int(life_sci_relevant),
+                            'assign_applic'     : assign_applic })
+                        detail_docs.append( (bib, pubnumber, doc_id) )
                     else:
                         # The document is known, and we're not overwriting: skip
                         continue
@@ -313,49 +525,33 @@ class DataLoader:
                 else:
                     
                     # Create a new record for the document
-                    record = {
+                    new_doc_records.append({
                         'scpn'              : pubnumber,
                         'published'         : pubdate,
                         'family_id'         : family_id,
                         'assign_applic'     : assign_applic,
-                        'life_sci_relevant' : int(life_sci_relevant) }
-                    
-                    try:
-
-                        start = time.time()
-                        result = sql_alc_conn.execute( self.docs.insert(), record )
-                        end = time.time()
-
-                        doc_insert_time += (end-start)
-
-                    except Exception, exc:
-
-                        if exc.__class__.__name__ != "IntegrityError":
-                            raise
-
-                        elif self.allow_document_dups:
+                        'life_sci_relevant' : int(life_sci_relevant) })
+                    detail_docs.append( (bib, pubnumber, None) )
 
-                            # It's an integrity error, and duplicates are allowed.
-                            known_count += 1
-                            duplicate_docs.add(pubnumber)                    
-                            continue             
-
-                        else:
-
-                            raise RuntimeError(
-                                "An Integrity error was detected when inserting document {}. This "\
-                                "indicates insertion of an existing document, but duplicates have been disallowed".format(pubnumber))
+            # Insert the new document records in bulk, then update the in-memory mapping with the new IDs
+            start = time.time()
+            new_doc_mappings = self._insert_documents(sql_alc_conn, new_doc_records, duplicate_docs)
+            doc_insert_time = time.time() - start
 
+            self.metrics.observe('phase_seconds', doc_insert_time, phase='document_insert')
+            self.metrics.incr('documents_total', len(new_doc_mappings), status='new')
+            self.metrics.incr('documents_total', known_count + len(duplicate_docs), status='known')
 
-                    doc_id = result.inserted_primary_key[0] # Single PK
-                    new_doc_mappings[pubnumber] = doc_id
+            known_count += len(duplicate_docs)
+            self.doc_id_map.update(new_doc_mappings)
 
+            for bib, pubnumber, doc_id in detail_docs:
+                if doc_id is None:
+                    if pubnumber not in new_doc_mappings:
+                        continue
+                    doc_id = new_doc_mappings[pubnumber]
                 self._extract_detailed_biblio(bib, doc_id, new_classes, new_titles, pubnumber)
 
-            # Commit the new document records, then update the in-memory mapping with the new IDs
-            transaction.commit()
-            self.doc_id_map.update(new_doc_mappings)
-
             logger.info("Processed {} document records: {} new, {} duplicates. DB insertion time = {:.3f}".format( len(chunk[1]), len(new_doc_mappings), known_count, doc_insert_time))
 
 
@@ -365,31 +561,34 @@ class DataLoader:
 
             if len(overwrite_docs) > 0:
 
-                transaction = sql_alc_conn.begin()
+                overwrite_start = time.time()
 
-                # Update the master record for the document that's being overwritten
-                stmt = self.docs.update().\
-                    where(self.docs.c.id == bindparam('extant_id')).\
-                    values(published=bindparam('new_published'), 
-                           family_id=bindparam('new_family_id'), 
-                           life_sci_relevant=bindparam('new_life_sci_relevant'),
-                           assign_applic=bindparam('new_assign_applic'))
+                # Titles and classes queued for earlier chunks must be written before they can be deleted
+                if self.writer is not None:
+                    self.writer.flush()
 
-                sql_alc_conn.execute(stmt, overwrite_docs)
+                # The new master record values are loaded into a temporary table, so that the documents can be
+                # updated, and their other records deleted, with one statement per table
+                # A document that appears more than once is overwritten with its last record, as by separate updates
+                overwrite_records = dict( (record['id'], record) for record in overwrite_docs ).values()
 
-                # Clean out ALL other references to the document, for re-insertion
-                delete_ids = [record['extant_id'] for record in overwrite_docs]
+                with self.doc_overwrite.loaded(sql_alc_conn, overwrite_records) as overwrites:
 
-                stmt = self.titles.delete().where( self.titles.c.schembl_doc_id.in_( delete_ids ) )
-                sql_alc_conn.execute( stmt )
+                    # Update the master record for the document that's being overwritten
+                    stmt = self.docs.update().\
+                        where(self.docs.c.id.in_( select([overwrites.c.id]) )).\
+                        values(dict( (column, select([overwrites.c[column]]).where(overwrites.c.id == self.docs.c.id).as_scalar())
+                                     for column in ('published', 'family_id', 'life_sci_relevant', 'assign_applic') ))
 
-                stmt = self.classes.delete().where( self.classes.c.schembl_doc_id.in_( delete_ids ) )
-                sql_alc_conn.execute( stmt )
+                    sql_alc_conn.execute(stmt)
 
-                stmt = self.chem_mapping.delete().where( self.chem_mapping.c.schembl_doc_id.in_( delete_ids ) )
-                sql_alc_conn.execute( stmt )
+                    # Clean out ALL other references to the document, for re-insertion
+                    for table in (self.titles, self.classes, self.chem_mapping):
+                        stmt = table.delete().where( table.c.schembl_doc_id.in_( select([overwrites.c.id]) ) )
+                        sql_alc_conn.execute( stmt )
 
-                transaction.commit()
+                self.metrics.observe('phase_seconds', time.time() - overwrite_start, phase='document_overwrite')
+                self.metrics.incr('documents_total', len(overwrite_docs), status='overwritten')
 
                 logger.info("Overwrote {} duplicate documents (master doc record updated, all other references deleted)".format(len(overwrite_docs)))
 
@@ -412,16 +611,174 @@ class DataLoader:
                 classes_ins.execute(new_classes)
                 logger.debug("Insertion of {} classification completed".format(len(new_classes)) )
 
+            self._flush_id_cache()
+
+            sizer.record(chunk[1], time.time() - chunk_start)
+
         # END of main biblio processing loop
 
-        # Clean up resources
-        title_ins.close()
-        classes_ins.close()
-        sql_alc_conn.close()
+        # Wait for any queued writes; the connection and batchers are kept for the next file
+        if self.writer is not None:
+            self.writer.flush()
         input_file.close()
 
+        self.metrics.incr('files_loaded_total', kind='biblio')
+
         logger.info("Biblio import completed" )
 
+    def _insert_documents(self, sql_alc_conn, records, duplicate_docs):
+        """
+        Insert a chunk of new document records in bulk, and return a map of SCPN to the new document IDs.
+
+        On Oracle and PostgreSQL, a block of IDs is allocated from the document sequence in a single query and
+        the records are inserted with a single executemany. Elsewhere the records are inserted with executemany
+        and the generated IDs are read back with a single query. If the bulk insertion hits an integrity error,
+        the chunk is rolled back and re-inserted one record at a time to isolate the duplicates. If the document
+        table is partitioned, existing documents are looked up before insertion instead.
+        :param records: New document records; updated in place with their allocated IDs (where pre-allocated).
+        :param duplicate_docs: Set that receives the SCPNs of any documents found to be duplicates.
+        """
+
+        if len(records) == 0:
+            return dict()
+
+        # Duplicates within the chunk would fail the bulk insert; treat repeats like existing documents
+        unique_records = []
+        seen = set()
+        for record in records:
+            if record['scpn'] in seen:
+                if not self.allow_document_dups:
+                    raise self._duplicate_error(record['scpn'])
+                duplicate_docs.add(record['scpn'])
+                continue
+            seen.add(record['scpn'])
+            unique_records.append(record)
+
+        # A partitioned document table can't reject documents that already exist in other partitions, so look for
+        # them first, and treat any found as duplicates
+        if self._documents_partitioned(sql_alc_conn):
+            existing = self._read_doc_ids(seen, sql_alc_conn)
+            if len(existing) > 0:
+                if not self.allow_document_dups:
+                    raise self._duplicate_error( sorted(existing)[0] )
+                duplicate_docs.update(existing)
+                seen.difference_update(existing)
+                unique_records = [record for record in unique_records if record['scpn'] in seen]
+                if len(unique_records) == 0:
+                    return dict()
+
+        preallocate = self.db.dialect.name in ('oracle', 'postgresql')
+
+        transaction = sql_alc_conn.begin()
+
+        try:
+
+            if preallocate:
+                for record, doc_id in zip(unique_records, self._allocate_doc_ids(sql_alc_conn, len(unique_records))):
+                    record['id'] = doc_id
+
+            sql_alc_conn.execute( self.docs.insert(), unique_records )
+
+        except Exception, exc:
+
+            if exc.__class__.__name__ != "IntegrityError":
+                raise
+
+            transaction.rollback()
+            logger.info("Integrity error detected during bulk document insertion; inserting records individually")
+
+            return self._insert_documents_singly(sql_alc_conn, unique_records, duplicate_docs)
+
+        if preallocate:
+            new_doc_mappings = dict( (record['scpn'], record['id']) for record in unique_records )
+        else:
+            new_doc_mappings = self._read_doc_ids(seen, sql_alc_conn)
+
+        transaction.commit()
+
+        return new_doc_mappings
+
+    def _insert_documents_singly(self, sql_alc_conn, records, duplicate_docs):
+        """Insert document records one at a time, recording duplicates. Returns a map of SCPN to new document ID"""
+
+        new_doc_mappings = dict()
+
+        transaction = sql_alc_conn.begin()
+
+        for record in records:
+
+            try:
+
+                result = sql_alc_conn.execute( self.docs.insert(), record )
+
+            except Exception, exc:
+
+                if exc.__class__.__name__ != "IntegrityError":
+                    raise
+
+                elif self.allow_document_dups:
+
+                    # It's an integrity error, and duplicates are allowed.
+                    duplicate_docs.add(record['scpn'])
+                    continue
+
+                else:
+
+                    raise self._duplicate_error(record['scpn'])
+
+            new_doc_mappings[record['scpn']] = result.inserted_primary_key[0] # Single PK
+
+        transaction.commit()
+
+        return new_doc_mappings
+
+    def _duplicate_error(self, scpn):
+        """Create the error for an existing document, when duplicates are disallowed"""
+        return RuntimeError(
+            "An Integrity error was detected when inserting document {}. This "\
+            "indicates insertion of an existing document, but duplicates have been disallowed".format(scpn))
+
+    def _documents_partitioned(self, sql_alc_conn):
+        """
+        Check whether the document table is partitioned, on first use. Only PostgreSQL is checked: Oracle's
+        partitioned schema keeps SCPNs unique with a global index (see schema/sc_data_partitioned.osql).
+        """
+
+        if self.docs_partitioned is None:
+
+            if self.db.dialect.name == 'postgresql':
+                found = sql_alc_conn.execute( text("select count(*) from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+                                                   "where c.relname = :name and c.relkind = 'p' and n.nspname = current_schema()"),
+                                              name=self.docs.name ).scalar()
+            else:
+                found = 0
+
+            self.docs_partitioned = found > 0
+            if self.docs_partitioned:
+                logger.info( "Document table {} is partitioned; new documents are looked for in all partitions before insertion".format(self.docs.name) )
+
+        return self.docs_partitioned
+
+    def _allocate_doc_ids(self, sql_alc_conn, count):
+        """Allocate a block of new document IDs from the document sequence, with a single query"""
+
+        seq_name = self.docs.c.id.default.name
+
+        if self.db.dialect.name == 'oracle':
+            stmt = text("select {}.nextval from dual connect by level <= :n".format(seq_name))
+        else:
+            stmt = text("select nextval('{}') from generate_series(1, :n)".format(seq_name))
+
+        return [row[0] for row in sql_alc_conn.execute(stmt, n=count)]
+
+    def _read_doc_ids(self, pub_nums, sql_alc_conn):
+        """Read the IDs of the given documents from the DB, as a map of SCPN to document ID"""
+
+        # Join against a temporary table of the publication numbers, rather than listing them
+        rows = self.doc_lookup.lookup(sql_alc_conn, pub_nums, self.docs.c.scpn, [self.docs.c.scpn, self.docs.c.id])
+
+        return dict( (row[0], row[1]) for row in rows )
+
     def _fill_doc_id_map(self, pub_nums, sql_alc_conn, extant_docs=None):
 
         logger.debug( "Retrieving primary key IDs for {} existing publication numbers".format( len(pub_nums)) )
@@ -429,21 +786,23 @@ class DataLoader:
         found_docs_count = 0
 
         # Hit the DB for the chosen pub numbers
-        sel = select( [self.docs.c.scpn, self.docs.c.id] )\
-              .where( (self.docs.c.scpn.in_(pub_nums)) )
-
-        result = sql_alc_conn.execute(sel)
-        result_rows = result.fetchall()
+        with self.metrics.timer('phase_seconds', phase='id_lookup'):
+            found_docs = self._read_doc_ids(pub_nums, sql_alc_conn)
 
         # Add any discovered document IDs to the global map;
-        for found_doc in result_rows:
-            self.doc_id_map[ found_doc[0] ] = found_doc[1]
+        for scpn, doc_id in found_docs.iteritems():
+            self.doc_id_map[ scpn ] = doc_id
             found_docs_count += 1
             if extant_docs != None:
-                extant_docs.add( found_doc[0] )
+                extant_docs.add( scpn )
 
         logger.debug( "Found {} documents IDs, total known count: {}".format( found_docs_count, len(self.doc_id_map) ) )        
 
+    def _flush_id_cache(self):
+        """Record any newly known (and committed) IDs in the persistent ID cache, if there is one"""
+        if self.id_cache is not None:
+            self.id_cache.flush(self)
+
 
     def _extract_pubnumber(self, bib):
         """Retrieve and parse the publication number"""
@@ -463,7 +822,7 @@ class DataLoader:
             pubdate = datetime.strptime(bib_scalar(bib, 'pubdate'), '%Y%m%d')
             fam_raw = bib_scalar(bib, 'family_id')
             family_id = int(fam_raw) if fam_raw != None else fam_raw
-            assign_applic_raw = bib.get('assign_applic')
+            assign_applic_raw = bib.get('assign_applic', [])
             assign_applic = '|'.join(assign_applic_raw) if len(assign_applic_raw) > 0 else ""
         except KeyError, exc:
             raise RuntimeError("Document is missing mandatory biblio field (KeyError: {})".format(exc))
@@ -523,120 +882,163 @@ class DataLoader:
 
 
 
-    def load_chems(self, file_name, update_mappings, chunksize=1000):
+    def load_chems(self, file_name, update_mappings, chunksize=1000, byte_range=None):
         """
         Load document chemistry data into the database. Assumes that document IDs for new document-chemistry
         have been made available as part of a previous processing step (by load_biblio)!
-        :param file_name: The SureChEMBL doc-chemistry data file to load, in TSV format
-        :param chunksize: Chunk size; affected processing of input records along with bulk insertion.
+        :param file_name: The SureChEMBL doc-chemistry data file to load, in TSV format; may be gzipped (.gz)
+        :param chunksize: Chunk size; affected processing of input records along with bulk insertion. A number, or
+            a chunk sizer such as AdaptiveChunkSize.
+        :param byte_range: Optional (start, end) byte offsets, to load only the rows that start within that part of
+            the file. Not supported for gzipped files.
         """
 
-        logger.info( "Loading chemicals from [{}]".format(file_name) )
-
         csv.field_size_limit(10000000)
-        input_file = codecs.open(file_name, 'rb', 'utf-8')
-        tsvin = csv.reader(input_file, delimiter='\t')
-
-        sql_alc_conn = self.db.connect()
-        db_api_conn = sql_alc_conn.connection
-
-        chem_ins = DBBatcher(db_api_conn, 'insert into schembl_chemical (id, mol_weight, logp, med_chem_alert, is_relevant, donor_count, acceptor_count, ring_count, rot_bond_count, corpus_count) values (:1, :2, :3, :4, :5, :6, :7, :8, :9, :10)')
-        chem_struc_ins = DBBatcher(db_api_conn, 'insert into schembl_chemical_structure (schembl_chem_id, smiles, std_inchi, std_inchikey) values (:1, :2, :3, :4)', self.chem_struc_types)
-        chem_map_del = DBBatcher(db_api_conn, 'delete from schembl_document_chemistry where schembl_doc_id = :1 and schembl_chem_id = :2 and field = :3 and (:4 > -1)')
-        chem_map_ins = DBBatcher(db_api_conn, 'insert into schembl_document_chemistry (schembl_doc_id, schembl_chem_id, field, frequency) values (:1, :2, :3, :4)')
-        if ("cx_oracle" in str(self.db.dialect)):
-            chem_ins = DBBatcher(db_api_conn, 'insert into schembl_chemical (id, mol_weight, logp, med_chem_alert, is_relevant, donor_count, acceptor_count, ring_count, rot_bond_count, corpus_count) values (:1, :2, :3, :4, :5, :6, :7, :8, :9, :10)')
-            chem_struc_ins = DBBatcher(db_api_conn, 'insert into schembl_chemical_structure (schembl_chem_id, smiles, std_inchi, std_inchikey) values (:1, :2, :3, :4)', self.chem_struc_types)
-            chem_map_del = DBBatcher(db_api_conn, 'delete from schembl_document_chemistry where schembl_doc_id = :1 and schembl_chem_id = :2 and field = :3 and (:4 > -1)')
-            chem_map_ins = DBBatcher(db_api_conn, 'insert into schembl_document_chemistry (schembl_doc_id, schembl_chem_id, field, frequency) values (:1, :2, :3, :4)')
+
+        sizer = chunk_sizer(chunksize)
+
+        if byte_range is None:
+            logger.info( "Loading chemicals from [{}]".format(file_name) )
+        else:
+            logger.info( "Loading chemicals from [{}], bytes {} to {}".format(file_name, byte_range[0], byte_range[1]) )
+
+        if self.columnar_chems:
+            input_file, frames = self._open_chem_frames(file_name, sizer, byte_range)
+            frames = self.metrics.timed_iter(frames, 'phase_seconds', exclude=timed_reader(input_file), phase='parse')
+        elif byte_range is None:
+            input_file = open_data_file(file_name, self.metrics)
+            tsvin = csv.reader(input_file, delimiter='\t')
         else:
-            chem_ins = DBBatcher(db_api_conn, 'insert into schembl_chemical (id, mol_weight, logp, med_chem_alert, is_relevant, donor_count, acceptor_count, ring_count, rot_bond_count, corpus_count) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)')
-            chem_struc_ins = DBBatcher(db_api_conn, 'insert into schembl_chemical_structure (schembl_chem_id, smiles, std_inchi, std_inchikey) values (%s, %s, %s, %s)', self.chem_struc_types)
-            chem_map_del = DBBatcher(db_api_conn, 'delete from schembl_document_chemistry where schembl_doc_id = %s and schembl_chem_id = %s and field = %s and (%s > -1)')
-            chem_map_ins = DBBatcher(db_api_conn, 'insert into schembl_document_chemistry (schembl_doc_id, schembl_chem_id, field, frequency) values (%s, %s, %s, %s)')
+            input_file = open(file_name, 'rb')
+            tsvin = csv.reader(iter_byte_range(input_file, byte_range[0], byte_range[1]), delimiter='\t')
 
+        sql_alc_conn = self._connection()
 
-        chunk = []
+        chem_ins = self._batcher('chemical_insert', lambda conn: self._insert_batcher(conn, 'schembl_chemical', ('id', 'mol_weight', 'logp', 'med_chem_alert', 'is_relevant', 'donor_count', 'acceptor_count', 'ring_count', 'rot_bond_count', 'corpus_count'), 'chemical_insert'))
+        chem_struc_ins = self._batcher('structure_insert', lambda conn: self._lob_insert_batcher(conn, 'schembl_chemical_structure', ('schembl_chem_id', 'smiles', 'std_inchi', 'std_inchikey'), 'structure_insert', (1, 2)))
 
-        # Process input records, in chunks
-        for i, row in enumerate(tsvin):
+        if update_mappings and self.merge_mappings:
+            # Sparse mappings whose frequency has dropped to zero are deleted rather than merged
+            chem_map_del = self._mapping_delete_batcher() if self.sparse_mappings else None
+            chem_map_ins = self._batcher('mapping_merge', lambda conn: MergeBatcher(conn, self.db.dialect.name, self.chem_mapping.name, self.mapping_keys, self.mapping_values, self.mapping_staging, self.paramstyle, pg_copy=self.pg_copy, metrics=self.metrics, phase='mapping_merge'))
+        else:
+            chem_map_del = self._mapping_delete_batcher()
+            chem_map_ins = self._batcher('mapping_insert', lambda conn: self._insert_batcher(conn, self.chem_mapping.name, self.mapping_keys + self.mapping_values, 'mapping_insert'))
 
-            if (i == 0) and row[0] == 'SCPN':
-                if row != self.CHEM_HEADER_ROW:
-                    raise RuntimeError("Malformed header detected in chemical data file")
-                continue
+        if self.columnar_chems:
 
-            if (i % chunksize == 0 and i > 0):
-                logger.debug( "Processing chem-mapping data to index {}".format(i) )
-                self._process_chem_rows(sql_alc_conn, update_mappings, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, chunk)
-                del chunk[:]
+            # Process input records, one columnar chunk at a time
+            for frame in frames:
+                chunk_start = time.time()
+                self._process_chem_frame(sql_alc_conn, update_mappings, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, frame)
+                sizer.record(frame, time.time() - chunk_start)
 
-            chunk.append(row)
+        else:
 
-        logger.debug( "Processing chem-mapping data to index {} (final)".format(i) )
-        self._process_chem_rows(sql_alc_conn, update_mappings, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, chunk)
+            # Time spent reading (or decompressing) the file is recorded by its TimedReader, so isn't counted again
+            tsvin = self.metrics.timed_iter(tsvin, 'phase_seconds', batch=sizer.size, exclude=timed_reader(input_file), phase='parse')
 
-        # Clean up resources
-        chem_ins.close()
-        chem_struc_ins.close()
-        chem_map_del.close()
-        chem_map_ins.close()
+            chunk = []
+            i = 0
+
+            # Process input records, in chunks
+            for i, row in enumerate(tsvin):
+
+                if (i == 0) and row[0] == 'SCPN':
+                    if row != self.CHEM_HEADER_ROW:
+                        raise RuntimeError("Malformed header detected in chemical data file")
+                    continue
+
+                if len(chunk) >= sizer.size:
+                    logger.debug( "Processing chem-mapping data to index {}".format(i) )
+                    chunk_start = time.time()
+                    self._process_chem_rows(sql_alc_conn, update_mappings, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, chunk)
+                    sizer.record(chunk, time.time() - chunk_start)
+                    del chunk[:]
+
+                chunk.append(row)
+
+            logger.debug( "Processing chem-mapping data to index {} (final)".format(i) )
+            self._process_chem_rows(sql_alc_conn, update_mappings, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, chunk)
+
+        # Wait for any queued writes; the connection and batchers are kept for the next file
+        if self.writer is not None:
+            self.writer.flush()
+            self._flush_id_cache()
 
-        sql_alc_conn.close()
         input_file.close()
 
+        self.metrics.incr('files_loaded_total', kind='chemicals')
+
         logger.info("Chemical import completed" )
 
+    def _mapping_delete_batcher(self):
+        """Return the batcher for deleting document/chemical mappings, given complete (narrow) or key (wide) records"""
+        if self.wide_mappings:
+            sql = 'delete from {} where schembl_doc_id = {} and schembl_chem_id = {}'.format(self.chem_mapping.name, *bind_params(self.paramstyle, 2))
+        else:
+            sql = 'delete from {} where schembl_doc_id = {} and schembl_chem_id = {} and field = {} and ({} > -1)'.format(self.chem_mapping.name, *bind_params(self.paramstyle, 4))
+        return self._batcher('mapping_delete', lambda conn: DBBatcher(conn, sql, batch_errors=self.batch_errors, metrics=self.metrics, phase='mapping_delete'))
 
-    def _process_chem_rows(self, sql_alc_conn, update, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, rows):
-        """Processes a batch of document-chemistry input records"""
+    def _open_chem_frames(self, file_name, sizer, byte_range):
+        """
+        Open a chemical data file for columnar parsing.
+        :param sizer: Chunk sizer, giving the number of records for each DataFrame.
+        :return: Tuple of (file object, generator of DataFrames)
+        """
 
-        logger.debug( "Building set of unknown chemical IDs ({} known)".format(len(self.existing_chemicals)) )
+        if byte_range is None:
+            input_file = open_raw_data_file(file_name, self.metrics)
+            first_line = input_file.readline()
+            chunks = iter(lambda: input_file.read(1048576), '')
+        else:
+            input_file = open(file_name, 'rb')
+            chunks = iter_byte_range(input_file, byte_range[0], byte_range[1], decode=False)
+            first_line = next(chunks, '')
 
-        # Identify chemicals from the batch that we haven't seen before
-        unknown_chem_ids = set()
-        for row in rows:
-            chem_id = int(row[1])
-            if chem_id in self.existing_chemicals:
-                continue
-            unknown_chem_ids.add( chem_id )
+        return input_file, columnar.read_chem_frames(first_line, chunks, self.CHEM_HEADER_ROW, sizer)
 
-        # Search the DB to see if any of those chemicals are known
-        if (len(unknown_chem_ids) > 0):
+    def _process_chem_frame(self, sql_alc_conn, update, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, frame):
+        """Processes a batch of document-chemistry input records, parsed into a DataFrame"""
 
-            logger.debug( "Searching DB for {} unknown chemical IDs".format(len(unknown_chem_ids)) )
-            sel = select(
-                    [self.chemicals.c.id])\
-                  .where(
-                    (self.chemicals.c.id.in_(unknown_chem_ids) ))
+        logger.debug( "Processing chemical mappings / building insert list ({} chemical IDs known)".format(len(self.existing_chemicals)) )
 
-            # Add known chemicals to the set of existing chemicals
-            result = sql_alc_conn.execute(sel)
-            found_chems = result.fetchall()
-            for found_chem in found_chems:
-                self.existing_chemicals.add( found_chem[0] )
+        with self.metrics.timer('phase_seconds', phase='build_records'):
+            new_chems, new_chem_structs, new_chem_ids, new_mappings, missing_scpns, skipped = \
+                columnar.chem_frame_records(frame, self.doc_id_map, self.existing_chemicals, wide=self.wide_mappings)
 
-            logger.debug( "Known chemical IDs now at: {}".format(len(self.existing_chemicals)) )
+        for scpn in missing_scpns:
+            logger.warn("Document ID not found for scpn [{}]; skipping record".format(scpn))
+        if skipped > 0:
+            self.metrics.incr('chemical_rows_total', skipped, status='skipped')
 
-        # Now process all input rows, generating new data records where needed
+        self._write_chem_rows(sql_alc_conn, update, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins,
+                              new_chems, new_chem_structs, new_chem_ids, new_mappings)
+
+    def _process_chem_rows(self, sql_alc_conn, update, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins, rows):
+        """Processes a batch of document-chemistry input records"""
+
+        # Process all input rows, generating mapping records, plus chemical records for any chemicals that
+        # aren't known to exist yet
         new_chems = []
         new_chem_structs = []
         new_mappings = []
 
         new_chem_ids = set()
 
-        logger.debug( "Processing chemical mappings / building insert list" )
+        logger.debug( "Processing chemical mappings / building insert list ({} chemical IDs known)".format(len(self.existing_chemicals)) )
 
         for i, row in enumerate(rows):
 
             if len(row) != self.CHEM_RECORD_COLS:
                 raise RuntimeError("Incorrect number of columns detected in chemical data file")
 
-            if row[0] not in self.doc_id_map:
+            doc_id = self.doc_id_map.get( row[0] )
+            if doc_id is None:
                 logger.warn("Document ID not found for scpn [{}]; skipping record".format(row[0]))
+                self.metrics.incr('chemical_rows_total', status='skipped')
                 continue
 
-            doc_id  = self.doc_id_map[ row[0] ]
             chem_id = int(row[1])
 
             # Add the chemical - if it's new
@@ -648,54 +1050,165 @@ class DataLoader:
                 new_chem_ids.add(chem_id)
 
             # Add the document / chemical mappings
-            new_mappings.append( (doc_id, chem_id, DocumentField.TITLE,       int(row[15]) ) )
-            new_mappings.append( (doc_id, chem_id, DocumentField.ABSTRACT,    int(row[16]) ) )
-            new_mappings.append( (doc_id, chem_id, DocumentField.CLAIMS,      int(row[17]) ) )
-            new_mappings.append( (doc_id, chem_id, DocumentField.DESCRIPTION, int(row[18]) ) )
-            new_mappings.append( (doc_id, chem_id, DocumentField.IMAGES,      int(row[19]) ) )
-            new_mappings.append( (doc_id, chem_id, DocumentField.ATTACHMENTS, int(row[20]) ) )
+            if self.wide_mappings:
+                new_mappings.append( (doc_id, chem_id, int(row[15]), int(row[16]), int(row[17]), int(row[18]), int(row[19]), int(row[20])) )
+            else:
+                new_mappings.append( (doc_id, chem_id, DocumentField.TITLE,       int(row[15]) ) )
+                new_mappings.append( (doc_id, chem_id, DocumentField.ABSTRACT,    int(row[16]) ) )
+                new_mappings.append( (doc_id, chem_id, DocumentField.CLAIMS,      int(row[17]) ) )
+                new_mappings.append( (doc_id, chem_id, DocumentField.DESCRIPTION, int(row[18]) ) )
+                new_mappings.append( (doc_id, chem_id, DocumentField.IMAGES,      int(row[19]) ) )
+                new_mappings.append( (doc_id, chem_id, DocumentField.ATTACHMENTS, int(row[20]) ) )
+
+        self._write_chem_rows(sql_alc_conn, update, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins,
+                              new_chems, new_chem_structs, new_chem_ids, new_mappings)
+
+    def _write_chem_rows(self, sql_alc_conn, update, chem_ins, chem_struc_ins, chem_map_del, chem_map_ins,
+                         new_chems, new_chem_structs, new_chem_ids, new_mappings):
+        """Writes the chemicals, structures and document/chemical mappings built from a batch of input records"""
+
+        self.metrics.incr('chemical_rows_total', len(new_mappings) if self.wide_mappings else len(new_mappings) // 6, status='loaded')
+
+        # Check the DB for the new chemicals, and insert any that are missing. When several processes load
+        # chemicals in parallel, they take turns to do this, so each new chemical is inserted exactly once.
+        if self.chem_lock is not None:
+            with self.metrics.timer('phase_seconds', phase='chemical_lock_wait'):
+                self.chem_lock.acquire()
 
-        # Bulk insertions
-        logger.debug("Performing {} chemical inserts".format(len(new_chems)) )
-        chem_ins.execute(new_chems)
+        try:
 
-        self.existing_chemicals.update( new_chem_ids )
+            if (len(new_chem_ids) > 0):
 
-        logger.debug("Performing {} chemical structure inserts".format(len(new_chem_structs)) )
-        chem_struc_ins.execute( new_chem_structs)
-        
-        if (update):
-            logger.debug("Performing {} mapping deletions (for update)".format(len(new_chem_structs)) )
-            chem_map_del.execute( new_mappings)
+                found_chem_ids = self._find_existing_chemicals(new_chem_ids, sql_alc_conn)
 
-        logger.debug("Performing {} mapping inserts".format(len(new_mappings)) )
-        chem_map_ins.execute( new_mappings)
+                if len(found_chem_ids) > 0:
+                    new_chems = [chem for chem in new_chems if chem[0] not in found_chem_ids]
+                    new_chem_structs = [struct for struct in new_chem_structs if struct[0] not in found_chem_ids]
+
+            # Bulk insertions
+            logger.debug("Performing {} chemical inserts".format(len(new_chems)) )
+            chem_ins.execute(new_chems)
+
+            self.existing_chemicals.update( new_chem_ids )
+
+            logger.debug("Performing {} chemical structure inserts".format(len(new_chem_structs)) )
+            chem_struc_ins.execute( new_chem_structs)
+
+            # Other processes must be able to find the new chemicals once it's their turn
+            if self.async_writes and self.chem_lock is not None:
+                chem_struc_ins.flush()
+
+        finally:
+            if self.chem_lock is not None:
+                self.chem_lock.release()
+
+        # Queued chemicals are only journalled once they've been written (see load_chems)
+        if not self.async_writes or self.chem_lock is not None:
+            self._flush_id_cache()
+
+        # Mappings are built for every field (or pair, if wide); sparse mappings leave out those with a frequency
+        # of zero (or all-zero counts)
+        if self.sparse_mappings:
+            written_mappings = [mapping for mapping in new_mappings if not self._zero_mapping(mapping)]
+        else:
+            written_mappings = new_mappings
+
+        # Updated mappings are either deleted and re-inserted, or merged into place. When merging sparse mappings,
+        # any that have dropped to zero are deleted instead; in either case, no stale non-zero mappings are left.
+        if (update and chem_map_del is not None):
+            if self.merge_mappings:
+                deleted_mappings = [mapping for mapping in new_mappings if self._zero_mapping(mapping)]
+            else:
+                deleted_mappings = new_mappings
+            if self.wide_mappings:
+                deleted_mappings = [mapping[:2] for mapping in deleted_mappings]
+            logger.debug("Performing {} mapping deletions (for update)".format(len(deleted_mappings)) )
+            chem_map_del.execute( deleted_mappings)
+
+        logger.debug("Performing {} mapping inserts".format(len(written_mappings)) )
+        chem_map_ins.execute( written_mappings)
+
+    def _zero_mapping(self, mapping):
+        """Check whether a mapping record has a frequency of zero, for every field if wide"""
+        if self.wide_mappings:
+            return not any(mapping[2:])
+        return mapping[3] == 0
+
+    def _find_existing_chemicals(self, chem_ids, sql_alc_conn):
+        """Search the DB for the given chemical IDs, returning the set of IDs that were found"""
+
+        logger.debug( "Searching DB for {} unknown chemical IDs".format(len(chem_ids)) )
+
+        with self.metrics.timer('phase_seconds', phase='id_lookup'):
+            rows = self.chem_lookup.lookup(sql_alc_conn, chem_ids, self.chemicals.c.id, [self.chemicals.c.id])
+            found_chem_ids = set( found_chem[0] for found_chem in rows )
+
+        logger.debug( "Found {} existing chemical IDs".format(len(found_chem_ids)) )
+
+        return found_chem_ids
 
 
 class DBBatcher:
-    """Convenience wrapper for DB-API functionality"""
+    """
+    Convenience wrapper for DB-API functionality.
+
+    Integrity errors (e.g. duplicate records) are logged and skipped, while the rest of the batch is committed.
+    On cx_Oracle, this uses array DML with batch errors, so failing rows are reported by the driver and the
+    batch still commits in one go. Elsewhere, a failing batch is split in half recursively until the culprit
+    records are isolated.
+    """
+
+    # Oracle error codes that correspond to cx_Oracle.IntegrityError
+    ORA_INTEGRITY_CODES = (1, 1400, 1407, 2290, 2291, 2292)
 
-    def __init__(self, db_api_conn, operation, types=None):
-        """Initialize a DBBatcher, with a given connection and operation"""
+    def __init__(self, db_api_conn, operation, types=None, batch_errors=False, metrics=None, phase='batch'):
+        """
+        Initialize a DBBatcher, with a given connection and operation.
+        :param types: Optional input sizes/types for the operation's bind variables.
+        :param batch_errors: Flag indicating that the connection is a cx_Oracle connection supporting batch errors.
+        :param metrics: Optional Metrics object, to record timings and row counts in.
+        :param phase: Name of the loading phase that this batcher performs, for metrics.
+        """
         self.conn = db_api_conn
         self.cursor = db_api_conn.cursor()
         self.operation = operation
-        if types is not None:
-            self.cursor.setinputsizes(*types)
+        self.retry_operation = operation
+        self.batch_errors = batch_errors
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.phase = phase
+        self.types = types
+        self._set_input_sizes()
+
+    def _set_input_sizes(self):
+        """Apply the input sizes/types, if any, to the cursor; cx_Oracle only keeps them while the statement is unchanged"""
+        if self.types is not None:
+            self.cursor.setinputsizes(*self.types)
 
 
     def execute(self,data):
         """Perform the given operations, in bulk"""
 
-        try:
+        start = time.time()
 
-            start = time.time()
+        if self.batch_errors:
+            self._execute_batch_errors(data)
+        else:
+            self._execute_plain(data)
 
-            self.cursor.executemany(self.operation, data)
+        end = time.time()
+
+        self.metrics.observe('phase_seconds', end-start, phase=self.phase)
+        self.metrics.incr('rows_total', len(data), phase=self.phase)
+
+        logger.info("Operation [{}] took {:.3f} seconds; {} operations processed".format(self.operation, end-start, len(data)))
 
-            end = time.time()
 
-            logger.info("Operation [{}] took {:.3f} seconds; {} operations processed".format(self.operation, end-start, len(data)))
+    def _execute_plain(self, data):
+        """Perform the operations with a single executemany, falling back to batch splitting on integrity errors"""
+
+        try:
+
+            self.cursor.executemany(self.operation, data)
 
         except Exception, exc:
 
@@ -704,41 +1217,593 @@ class DBBatcher:
                 raise
 
             self.conn.rollback()
+            self._execute_bisect(data)
+
+        else:
+            # If all goes well, we just need a single commit
+            self.conn.commit()
 
-            for record in data:
 
-                try:
-                    self.cursor.execute(self.operation, record)
-                    self.conn.commit()
+    def _execute_batch_errors(self, data):
+        """Perform the operations with cx_Oracle batch errors, skipping and logging any rows that fail"""
+
+        try:
+            self.cursor.executemany(self.operation, data, batcherrors=True)
+        except TypeError:
+            # Older versions of cx_Oracle don't support batch errors
+            logger.warn("Batch errors not supported by the DB-API driver; falling back to batch splitting")
+            self.batch_errors = False
+            self._execute_plain(data)
+            return
+
+        errors = self.cursor.getbatcherrors()
+
+        for error in errors:
+            if error.code not in self.ORA_INTEGRITY_CODES:
+                self.conn.rollback()
+                logger.error("Exception [{}] occurred inserting record {}".format(str(error.message).rstrip(), data[error.offset]))
+                logger.error("Operation was: {}".format(self.operation))
+                raise RuntimeError("Batch operation failed: {}".format(str(error.message).rstrip()))
+
+        for error in errors:
+            logger.warn( "Integrity error (\"{}\"); data={}".format(str(error.message).rstrip(), data[error.offset]) )
+            self.metrics.incr('integrity_errors_total', phase=self.phase)
+
+        self.conn.commit()
+
+
+    def _execute_bisect(self, data):
+        """Perform the operations on a batch known to contain integrity errors, by splitting it recursively"""
+
+        if len(data) == 1:
+
+            record = data[0]
+
+            try:
+                self._prepare_retry()
+                self.cursor.execute(self.retry_operation, record)
+                self.conn.commit()
+
+            except Exception, exc:
+
+                # This record is the culprit
+                if exc.__class__.__name__ != "IntegrityError":
+                    logger.error("Exception [{}] occurred inserting record {}".format(exc.message, record))
+                    logger.error("Operation was: {}".format(self.retry_operation))
+                    raise
+
+                self.conn.rollback()
+
+                error_msg = str(exc.message).rstrip()
+                logger.warn( "Integrity error (\"{}\"); data={}".format(error_msg, record) )
+                self.metrics.incr('integrity_errors_total', phase=self.phase)
+
+            return
+
+        mid = len(data) // 2
+
+        for part in (data[:mid], data[mid:]):
+
+            try:
+                self._prepare_retry()
+                self.cursor.executemany(self.retry_operation, part)
+
+            except Exception, exc:
+
+                if exc.__class__.__name__ != "IntegrityError":
+                    raise
+
+                self.conn.rollback()
+                self._execute_bisect(part)
 
-                except Exception, exc:
+            else:
+                self.conn.commit()
 
-                    # This record is the culprit
-                    if exc.__class__.__name__ != "IntegrityError":
-                        logger.error("Exception [{}] occurred inserting record {}".format(exc.message, record))
-                        logger.error("Operation was: {}".format(self.operation))
-                        raise
 
-                    error_msg = str(exc.message).rstrip()
-                    logger.warn( "Integrity error (\"{}\"); data={}".format(error_msg, record) )
+    def _prepare_retry(self):
+        """Re-apply the input sizes before a retry, if it uses a different statement to the original operation"""
+        if self.retry_operation != self.operation:
+            self._set_input_sizes()
+
+    def close(self):
+        """Clean up DBBatcher resources"""
+        self.cursor.close()
+
+
+class DirectPathBatcher(DBBatcher):
+    """
+    DBBatcher for Oracle direct-path array inserts, using the APPEND_VALUES hint. Rows are formatted into new blocks
+    above the table's high water mark, bypassing the buffer cache, with minimal undo (and redo, if the table is
+    NOLOGGING). Oracle silently uses a conventional-path insert instead for tables with enabled foreign keys, so
+    this is best combined with bulk mode.
+
+    A table that has been inserted into by direct path can't be read or written again until the transaction
+    commits, so each batch is committed straight away. Batch errors aren't reported for direct-path inserts, so a
+    batch that fails with integrity errors is rolled back, and inserted again by conventional path, split as
+    DBBatcher does without batch errors; this keeps single-row retries from each taking a new block.
+    """
+
+    def __init__(self, db_api_conn, operation, types=None, metrics=None, phase='batch'):
+        """
+        Initialize a DirectPathBatcher.
+        :param operation: Conventional insert statement (insert into ... values ...), to add the hint to.
+        """
+        if not operation.startswith('insert into '):
+            raise ValueError("Direct-path batches must be inserts, not [{}]".format(operation))
+
+        DBBatcher.__init__(self, db_api_conn, operation.replace('insert into ', 'insert /*+ APPEND_VALUES */ into ', 1),
+                           types, batch_errors=False, metrics=metrics, phase=phase)
+        self.retry_operation = operation
+
+    def _execute_plain(self, data):
+        """Perform the inserts with a single direct-path executemany, retrying by conventional path on integrity errors"""
+
+        try:
+            # The cursor may have been left with the conventional insert by an earlier retry
+            self._set_input_sizes()
+            self.cursor.executemany(self.operation, data)
+
+        except Exception, exc:
+
+            if exc.__class__.__name__ != "IntegrityError":
+                raise
+
+            self.conn.rollback()
+            logger.warn( "Integrity errors in direct-path insert; retrying {} records by conventional path".format(len(data)) )
+            self._execute_bisect(data)
 
         else:
-            # If all goes well, we just need a single commit
             self.conn.commit()
 
 
+class LobBatcher:
+    """
+    Insert batcher for Oracle tables with CLOB columns (chemical structures and document titles). Binding every
+    value as a temporary LOB is expensive, so each batch is split: records whose CLOB column values all fit in a
+    VARCHAR2 bind (STRING_BIND_LIMIT bytes) are inserted with ordinary string binds, and only the rare records with
+    longer values are inserted with CLOB binds, by a second batcher. Keeping long values out of the string batch
+    also avoids them being bound as LONGs, which Oracle rejects in some column orders (ORA-24816).
+    """
+
+    # Largest value, in bytes, that can be bound as a VARCHAR2 in SQL (without extended string sizes)
+    STRING_BIND_LIMIT = 4000
+
+    def __init__(self, string_batcher, lob_batcher, lob_columns, limit=STRING_BIND_LIMIT, metrics=None, phase='batch'):
+        """
+        Initialize a LobBatcher.
+        :param string_batcher: Batcher for records with short values, without input sizes.
+        :param lob_batcher: Batcher for records with long values, with CLOB input sizes for the LOB columns.
+        :param lob_columns: Indexes of the CLOB columns in each record.
+        :param limit: Longest value, in bytes, to bind as a string.
+        :param metrics: Optional Metrics object, to count the records bound as LOBs in.
+        :param phase: Name of the loading phase that this batcher performs, for metrics.
+        """
+        self.string_batcher = string_batcher
+        self.lob_batcher = lob_batcher
+        self.lob_columns = lob_columns
+        self.limit = limit
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.phase = phase
+
+    def execute(self, data):
+        """Perform the inserts, with string binds where possible and LOB binds for oversized records"""
+
+        short_records = []
+        long_records = []
+        for record in data:
+            if any(self._oversized(record[i]) for i in self.lob_columns):
+                long_records.append( self._encode(record) )
+            else:
+                short_records.append(record)
+
+        if short_records or not long_records:
+            self.string_batcher.execute(short_records)
+
+        if long_records:
+            logger.info( "Binding {} of {} records as LOBs".format(len(long_records), len(data)) )
+            self.metrics.incr('lob_rows_total', len(long_records), phase=self.phase)
+            self.lob_batcher.execute(long_records)
+
+    def _oversized(self, value):
+        """Check whether a value is too long to bind as a string; UTF-8 takes up to 4 bytes per character"""
+        if value is None or len(value) * 4 <= self.limit:
+            return False
+        if isinstance(value, unicode):
+            return len(value.encode('utf-8')) > self.limit
+        return len(value) > self.limit
+
+    def _encode(self, record):
+        """Encode unicode LOB values as UTF-8, which CLOB bind variables take (with an AL32UTF8 NLS_LANG)"""
+        return tuple(value.encode('utf-8') if i in self.lob_columns and isinstance(value, unicode) else value
+                     for i, value in enumerate(record))
 
     def close(self):
-        """Clean up DBBatcher resources"""
+        """Clean up the batchers' resources"""
+        self.string_batcher.close()
+        self.lob_batcher.close()
+
+
+class CopyBatcher:
+    """
+    Bulk loader for PostgreSQL, streaming batches of records through an in-memory buffer with COPY FROM STDIN.
+
+    By default, records are copied into a session-local staging table and moved into the target table with
+    INSERT ... ON CONFLICT DO NOTHING (PostgreSQL 9.5+), so duplicate records are skipped rather than failing
+    the batch. The staging table is emptied on commit. Without staging, records are copied straight into the
+    target table, which is fastest but fails the whole batch on any duplicate.
+    """
+
+    def __init__(self, db_api_conn, table, columns, staging=True, metrics=None, phase='batch'):
+        """
+        Initialize a CopyBatcher, for the given connection, target table and column list.
+        :param metrics: Optional Metrics object, to record timings and row counts in.
+        :param phase: Name of the loading phase that this batcher performs, for metrics.
+        """
+        self.conn = db_api_conn
+        self.cursor = db_api_conn.cursor()
+        self.table = table
+        self.columns = ', '.join(columns)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.phase = phase
+
+        if staging:
+            self.copy_table = "{}_staging".format(table)
+            self.cursor.execute("create temporary table if not exists {} (like {} including defaults) on commit delete rows".format(
+                self.copy_table, table))
+            self.conn.commit()
+        else:
+            self.copy_table = table
+
+        self.staging = staging
+        self.copy_sql = "copy {} ({}) from stdin".format(self.copy_table, self.columns)
+
+
+    def execute(self, data):
+        """Copy the given records into the target table, in bulk"""
+
+        if len(data) == 0:
+            return
+
+        start = time.time()
+
+        buf = StringIO( u''.join( copy_text_row(record) for record in data ).encode('utf-8') )
+        self.cursor.copy_expert(self.copy_sql, buf)
+
+        if self.staging:
+            self.cursor.execute("insert into {0} ({1}) select {1} from {2} on conflict do nothing".format(
+                self.table, self.columns, self.copy_table))
+            skipped = len(data) - self.cursor.rowcount
+            if skipped > 0:
+                logger.warn( "Skipped {} duplicate records when copying into {}".format(skipped, self.table) )
+                self.metrics.incr('integrity_errors_total', skipped, phase=self.phase)
+
+        self.conn.commit()
+
+        end = time.time()
+
+        self.metrics.observe('phase_seconds', end-start, phase=self.phase)
+        self.metrics.incr('rows_total', len(data), phase=self.phase)
+
+        logger.info("Copy into [{}] took {:.3f} seconds; {} records processed".format(self.table, end-start, len(data)))
+
+
+    def close(self):
+        """Clean up CopyBatcher resources"""
+        self.cursor.close()
+
+
+class MergeBatcher:
+    """
+    Bulk upsert wrapper, for replacing records with updated versions (e.g. mappings from supplementary files).
+
+    Each batch is loaded into a staging table, then merged into the target table with a single statement: MERGE on
+    Oracle, or INSERT ... ON CONFLICT DO UPDATE on PostgreSQL (9.5+) and SQLite (3.24+). Existing records are
+    updated and new ones inserted, in place of a DELETE and an INSERT per record. Where a batch holds several
+    records with the same key, the first is used and the rest are skipped, as they would be by a plain insert.
+    """
+
+    def __init__(self, db_api_conn, dialect, table, key_columns, value_columns, staging_table, paramstyle,
+                 pg_copy=False, metrics=None, phase='batch'):
+        """
+        Initialize a MergeBatcher, for the given connection and target table.
+        :param dialect: SQL Alchemy dialect name, i.e. 'oracle', 'postgresql' or 'sqlite'.
+        :param key_columns: Columns of the target table's primary key, which identify the records to replace.
+        :param value_columns: Other columns, which are updated for existing records.
+        :param staging_table: Name for the staging table; a temporary table, or a global temporary table on Oracle.
+        :param pg_copy: Flag indicating whether batches should be loaded into the staging table with COPY (PostgreSQL only)
+        :param metrics: Optional Metrics object, to record timings and row counts in.
+        :param phase: Name of the loading phase that this batcher performs, for metrics.
+        """
+        self.conn = db_api_conn
+        self.cursor = db_api_conn.cursor()
+        self.dialect = dialect
+        self.table = table
+        self.staging_table = staging_table
+        self.key_len = len(key_columns)
+        self.pg_copy = pg_copy
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.phase = phase
+
+        columns = list(key_columns) + list(value_columns)
+        column_list = ', '.join(columns)
+
+        if dialect == 'oracle':
+            self._create_oracle_staging()
+            self.merge_sql = "merge into {} t using {} s on ({}) when matched then update set {} " \
+                             "when not matched then insert ({}) values ({})".format(
+                table, staging_table,
+                ' and '.join('t.{0} = s.{0}'.format(col) for col in key_columns),
+                ', '.join('t.{0} = s.{0}'.format(col) for col in value_columns),
+                column_list, ', '.join('s.{}'.format(col) for col in columns))
+        else:
+            if dialect == 'postgresql':
+                self.cursor.execute("create temporary table if not exists {} (like {} including defaults) on commit delete rows".format(
+                    staging_table, table))
+            else:
+                self.cursor.execute("create temporary table if not exists {} as select * from {} where 0 = 1".format(
+                    staging_table, table))
+            self.conn.commit()
+
+            # The WHERE clause resolves a parsing ambiguity between ON CONFLICT and a join condition, in SQLite
+            self.merge_sql = "insert into {0} ({1}) select {1} from {2} where 1 = 1 on conflict ({3}) do update set {4}".format(
+                table, column_list, staging_table, ', '.join(key_columns),
+                ', '.join('{0} = excluded.{0}'.format(col) for col in value_columns))
+
+        self.staging_sql = "insert into {} ({}) values ({})".format(staging_table, column_list, ', '.join(bind_params(paramstyle, len(columns))))
+        self.copy_sql = "copy {} ({}) from stdin".format(staging_table, column_list)
+
+        # Only PostgreSQL and Oracle empty the staging table on commit
+        self.clear_sql = "delete from {}".format(staging_table) if dialect == 'sqlite' else None
+
+    def _create_oracle_staging(self):
+        """Create the staging table as a global temporary table, unless it already exists"""
+        self.cursor.execute("select count(*) from user_tables where table_name = :1", (self.staging_table.upper(),))
+        if self.cursor.fetchone()[0] > 0:
+            return
+        try:
+            self.cursor.execute("create global temporary table {} on commit delete rows as select * from {} where 1 = 0".format(
+                self.staging_table, self.table))
+        except Exception, exc:
+            # Another process may have just created it (ORA-00955: name is already used by an existing object)
+            if 'ORA-00955' not in str(exc):
+                raise
+
+    def execute(self, data):
+        """Merge the given records into the target table, in bulk"""
+
+        if len(data) == 0:
+            return
+
+        start = time.time()
+
+        records = []
+        keys = set()
+        for record in data:
+            key = record[:self.key_len]
+            if key in keys:
+                logger.warn( "Duplicate record skipped when merging into {}; data={}".format(self.table, record) )
+                self.metrics.incr('integrity_errors_total', phase=self.phase)
+                continue
+            keys.add(key)
+            records.append(record)
+
+        if self.pg_copy:
+            buf = StringIO( u''.join( copy_text_row(record) for record in records ).encode('utf-8') )
+            self.cursor.copy_expert(self.copy_sql, buf)
+        else:
+            self.cursor.executemany(self.staging_sql, records)
+
+        self.cursor.execute(self.merge_sql)
+
+        if self.clear_sql is not None:
+            self.cursor.execute(self.clear_sql)
+
+        self.conn.commit()
+
+        end = time.time()
+
+        self.metrics.observe('phase_seconds', end-start, phase=self.phase)
+        self.metrics.incr('rows_total', len(records), phase=self.phase)
+
+        logger.info("Merge into [{}] took {:.3f} seconds; {} records processed".format(self.table, end-start, len(records)))
+
+
+    def close(self):
+        """Clean up MergeBatcher resources"""
         self.cursor.close()
 
 
 ### Support functions ###
 
 def chunks(l, n):
-    """ Yield successive n-sized chunks from l. Via Stack Overflow."""
-    for i in xrange(0, len(l), n):
-        yield (i+n, l[i:i+n] )
+    """
+    Yield successive n-sized chunks from an iterable, as (end index, list) tuples. Via Stack Overflow.
+    :param n: Chunk size; a number, or a chunk sizer whose size is read before each chunk.
+    """
+    sizer = chunk_sizer(n)
+    it = iter(l)
+    i = 0
+    while True:
+        chunk = list(islice(it, sizer.size))
+        if len(chunk) == 0:
+            return
+        i += len(chunk)
+        yield (i, chunk)
+
+def iter_biblio(input_file, read_size=65536):
+    """
+    Incrementally parse a JSON array of biblio records, yielding one record at a time. Only the record being
+    decoded and a small read buffer are held in memory, so memory use is independent of the file size.
+    :param input_file: File-like object (unicode stream) positioned at the start of the JSON array.
+    :param read_size: Number of characters to read from the file per buffer refill.
+    """
+    decoder = json.JSONDecoder()
+    buf = u""
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+
+        # Skip whitespace and array punctuation between records
+        while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ',')):
+            pos += 1
+
+        if pos < len(buf):
+
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError("Biblio data must be a JSON array of records")
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ']':
+                return
+
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The record is incomplete; read more data unless we've run out
+                if eof:
+                    raise
+            else:
+                pos = end
+                yield record
+                continue
+
+        elif eof:
+            if started:
+                raise ValueError("Unexpected end of biblio data; JSON array was not terminated")
+            return
+
+        more = input_file.read(read_size)
+        eof = len(more) == 0
+        buf = buf[pos:] + more
+        pos = 0
+
+def open_data_file(file_name, metrics=None):
+    """
+    Open a data file for reading as a UTF-8 text stream. Gzipped files (.gz) are decompressed on the fly, through
+    a pigz pipe if pigz is installed, or in-process otherwise.
+    :param metrics: Optional Metrics object; if given, the time spent reading (and decompressing) the file is
+        recorded as the "read" (or "decompress") phase when the file is closed.
+    """
+    return codecs.getreader('utf-8')( open_raw_data_file(file_name, metrics) )
+
+def open_raw_data_file(file_name, metrics=None):
+    """Open a data file for reading, as open_data_file does, but as a stream of (UTF-8 encoded) bytes"""
+    if not file_name.endswith('.gz'):
+        raw_file = open(file_name, 'rb')
+    elif PIGZ_PATH is not None:
+        raw_file = PipeReader([PIGZ_PATH, '-dc', file_name])
+    else:
+        raw_file = gzip.open(file_name, 'rb')
+
+    if metrics is not None:
+        raw_file = TimedReader(raw_file, metrics, 'decompress' if file_name.endswith('.gz') else 'read')
+
+    return raw_file
+
+class TimedReader:
+    """Read-only file object wrapper that totals the time spent reading, and records it when the file is closed"""
+
+    def __init__(self, raw_file, metrics, phase):
+        self.raw_file = raw_file
+        self.metrics = metrics
+        self.phase = phase
+        self.elapsed = 0.0
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.raw_file.read(size)
+        self.elapsed += time.time() - start
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        start = time.time()
+        data = self.raw_file.readline(size)
+        self.elapsed += time.time() - start
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.metrics.observe('phase_seconds', self.elapsed, phase=self.phase)
+        self.metrics.incr('bytes_read_total', self.bytes_read, phase=self.phase)
+        return self.raw_file.close()
+
+def timed_reader(input_file):
+    """Return the TimedReader of a file opened by open_data_file or open_raw_data_file, or None if it has none"""
+    raw_file = getattr(input_file, 'stream', input_file)
+    return raw_file if isinstance(raw_file, TimedReader) else None
+
+class PipeReader:
+    """Read-only file object over the output of an external command; failures are raised when it's closed"""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1048576)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def readline(self, size=-1):
+        return self.process.stdout.readline(size)
+
+    def close(self):
+        self.process.stdout.close()
+        return_code = self.process.wait()
+        # Closing the pipe early kills the command with SIGPIPE, which isn't an error
+        if return_code not in (0, -13):
+            raise IOError("Command {} failed with exit code {}".format(self.command, return_code))
+
+def iter_byte_range(input_file, start, end, decode=True):
+    """
+    Yield the lines of a UTF-8 file that start within the given byte range. A line that straddles the start
+    offset belongs to the previous range, so adjacent ranges cover every line exactly once.
+    :param input_file: File object, opened in binary mode.
+    :param decode: Flag indicating whether lines should be decoded, or yielded as UTF-8 encoded strings.
+    """
+    if start > 0:
+        input_file.seek(start - 1)
+        input_file.readline()
+    else:
+        input_file.seek(0)
+
+    while input_file.tell() < end:
+        line = input_file.readline()
+        if len(line) == 0:
+            return
+        yield line.decode('utf-8') if decode else line
+
+def bind_params(paramstyle, count):
+    """Generate positional bind parameter markers for the given DB-API paramstyle"""
+    if paramstyle in ('named', 'numeric'):
+        return [':{}'.format(i) for i in xrange(1, count + 1)]
+    elif paramstyle == 'qmark':
+        return ['?'] * count
+    else:
+        return ['%s'] * count
+
+def copy_text_row(record):
+    """Format a record as a line of PostgreSQL COPY text format"""
+    fields = []
+    for value in record:
+        if value is None:
+            fields.append(u'\\N')
+        elif isinstance(value, basestring):
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            fields.append( value.translate(COPY_ESCAPES) )
+        elif isinstance(value, float):
+            fields.append( repr(value) )
+        else:
+            fields.append( unicode(value) )
+    return u'\t'.join(fields) + u'\n'
+
+COPY_ESCAPES = { ord(u'\\'): u'\\\\', ord(u'\t'): u'\\t', ord(u'\n'): u'\\n', ord(u'\r'): u'\\r' }
 
 def bib_scalar(biblio, key):
     """Retrieve the value of a scalar field from input biblio data"""
@@ -0,0 +1,271 @@
+import os
+import json
+import mmap
+import struct
+import logging
+from array import array
+from sqlalchemy import select, func
+
+from .id_store import ChemicalIdSet, DocumentIdMap
+
+logger = logging.getLogger(__name__)
+
+class IdCache:
+    """
+    Persistent cache of the document and chemical IDs known to a DataLoader, kept in the working directory
+    between runs, so that a new run doesn't have to re-discover existing records with database queries.
+
+    The cache is a snapshot file, written at the end of each successful run and memory-mapped when the next run
+    starts, plus journal files that newly known IDs are appended to after every commit, by any loading process.
+    The snapshot records the highest document and chemical IDs in the database when it was written, and the number
+    of each (the watermark). It's discarded if the database no longer matches it - e.g. because it was rebuilt, or
+    records were deleted or inserted with IDs below the watermark. Reloading records with the same IDs can't be
+    detected, so the cache must be discarded when that's done (e.g. by a partition swap).
+
+    The cache may lack IDs that were loaded by other means, which the loader then finds in the database as
+    usual, but documents and chemicals must not be deleted from the database while it's in use.
+    """
+
+    MAGIC = 'SCHEMBL-ID-CACHE'
+    VERSION = 3
+
+    # Document fingerprints use the string hash function, which may vary by platform or with hash randomization
+    SIGNATURE = hash('SureChEMBL ID cache')
+
+    # Trailer: offset of the JSON header, which follows the raw data sections
+    TRAILER = struct.Struct('<Q')
+
+    def __init__(self, path, db):
+        """
+        Create a new IdCache.
+        :param path: Path of the snapshot file; journals are kept alongside it.
+        :param db: SQL Alchemy engine for the database that the cached IDs belong to.
+        """
+        self.path = path
+        self.doc_journal_path = path + '.docs.journal'
+        self.chem_journal_path = path + '.chems.journal'
+        self.db = db
+        self.identity = "{}://{}@{}:{}/{}".format(db.url.drivername, db.url.username, db.url.host, db.url.port, db.url.database)
+
+    def load(self, loader):
+        """
+        Fill the ID structures of a loader from the cache, if it exists and matches the database, and start
+        journalling new IDs. Otherwise, any existing cache is discarded and a new one is started.
+        :return: True if cached IDs were loaded.
+        """
+
+        watermark = self._watermark(loader)
+
+        loaded = False
+        if os.path.exists(self.path):
+            loaded = self._load_snapshot(loader, watermark)
+
+        if loaded:
+            self.replay_journals(loader)
+            logger.info( "Loaded {} document IDs and {} chemical IDs from ID cache [{}]".format(
+                len(loader.doc_id_map), len(loader.existing_chemicals), self.path) )
+        else:
+            # Journals are only meaningful alongside their snapshot
+            self._write_snapshot(loader, watermark)
+
+        loader.doc_id_map.journal = array('l')
+        loader.existing_chemicals.journal = array('l')
+
+        return loaded
+
+    def discard(self):
+        """Delete the snapshot and journals, e.g. after IDs have been reassigned in the database"""
+        for path in (self.path, self.doc_journal_path, self.chem_journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info( "Discarded ID cache file [{}]".format(path) )
+
+    def flush(self, loader):
+        """Append the IDs that the loader has learned since the last flush to the journals"""
+        self._append(self.doc_journal_path, loader.doc_id_map.journal)
+        self._append(self.chem_journal_path, loader.existing_chemicals.journal)
+
+    def save(self, loader):
+        """
+        Write a new snapshot of all known IDs - including those journalled by other processes - and clear the
+        journals. Should be called after a successful run.
+        """
+        self.flush(loader)
+        self.replay_journals(loader)
+        self._write_snapshot(loader, self._watermark(loader))
+
+        logger.info( "Saved {} document IDs and {} chemical IDs to ID cache [{}]".format(
+            len(loader.doc_id_map), len(loader.existing_chemicals), self.path) )
+
+    def _watermark(self, loader):
+        """Find the highest document and chemical IDs in the database, plus the SCPN of that document, and the counts"""
+
+        conn = self.db.connect()
+        try:
+            max_doc_id, doc_count = conn.execute( select([func.max(loader.docs.c.id), func.count()]) ).first()
+            max_chem_id, chem_count = conn.execute( select([func.max(loader.chemicals.c.id), func.count()]) ).first()
+
+            max_doc_scpn = None
+            if max_doc_id is not None:
+                max_doc_scpn = conn.execute( select([loader.docs.c.scpn]).where(loader.docs.c.id == max_doc_id) ).scalar()
+        finally:
+            conn.close()
+
+        return {'max_doc_id': max_doc_id or 0, 'max_doc_scpn': max_doc_scpn, 'max_chem_id': max_chem_id or 0,
+                'doc_count': doc_count, 'chem_count': chem_count}
+
+    def _check_watermark(self, loader, cached, current):
+        """
+        Check that the database has only grown since the cached watermark was taken: every record added since has an
+        ID above the cached maximum, and none have been deleted.
+        """
+
+        if current['max_doc_id'] < cached['max_doc_id'] or current['max_chem_id'] < cached['max_chem_id']:
+            return False
+
+        conn = self.db.connect()
+        try:
+            if cached['max_doc_scpn'] is not None:
+                doc_id = conn.execute( select([loader.docs.c.id]).where(loader.docs.c.scpn == cached['max_doc_scpn']) ).scalar()
+                if doc_id != cached['max_doc_id']:
+                    return False
+
+            # Only the records above the cached maximum are counted, which is a short index range scan
+            for table, max_key, count_key in ((loader.docs, 'max_doc_id', 'doc_count'), (loader.chemicals, 'max_chem_id', 'chem_count')):
+                added = conn.execute( select([func.count()]).where(table.c.id > cached[max_key]) ).scalar()
+                if current[count_key] - cached[count_key] != added:
+                    return False
+        finally:
+            conn.close()
+
+        return True
+
+    def _load_snapshot(self, loader, watermark):
+
+        try:
+            with open(self.path, 'rb') as snapshot:
+                data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file can't be mapped
+            logger.warn( "ID cache [{}] is empty; discarding it".format(self.path) )
+            return False
+
+        try:
+            return self._read_snapshot(loader, watermark, data)
+        except (ValueError, struct.error, KeyError), exc:
+            # e.g. a snapshot truncated by a full disk, or garbled
+            logger.warn( "ID cache [{}] is damaged ({}); discarding it".format(self.path, exc) )
+            return False
+        finally:
+            data.close()
+
+    def _read_snapshot(self, loader, watermark, data):
+        """Fill the ID structures of a loader from a mapped snapshot, if it's compatible and matches the database"""
+
+        header_offset = self.TRAILER.unpack_from(data, len(data) - self.TRAILER.size)[0]
+        header = json.loads( data[header_offset:len(data) - self.TRAILER.size] )
+
+        if header.get('magic') != self.MAGIC or header.get('version') != self.VERSION or header.get('signature') != self.SIGNATURE:
+            logger.warn( "ID cache [{}] was written by an incompatible version or platform; discarding it".format(self.path) )
+            return False
+
+        if header['identity'] != self.identity:
+            logger.warn( "ID cache [{}] belongs to a different database ({}); discarding it".format(self.path, header['identity']) )
+            return False
+
+        if not self._check_watermark(loader, header['watermark'], watermark):
+            logger.warn( "Database no longer matches ID cache [{}] (cached: {}, database: {}); discarding it".format(
+                self.path, header['watermark'], watermark) )
+            return False
+
+        doc_id_map, offset = DocumentIdMap.read(header['doc_ids'], data, 0)
+        existing_chemicals, offset = ChemicalIdSet.read(header['chem_ids'], data, offset)
+
+        # Sections cut short by truncation are read without error, so check that they end where the header starts
+        if offset != header_offset:
+            raise ValueError("data sections end at {}, not at the header offset {}".format(offset, header_offset))
+
+        loader.doc_id_map = doc_id_map
+        loader.existing_chemicals = existing_chemicals
+
+        return True
+
+    def _write_snapshot(self, loader, watermark):
+        """Atomically replace the snapshot, then clear the journals, which it now includes"""
+
+        temp_path = self.path + '.tmp'
+
+        with open(temp_path, 'wb') as snapshot:
+            header = {
+                'magic'     : self.MAGIC,
+                'version'   : self.VERSION,
+                'signature' : self.SIGNATURE,
+                'identity'  : self.identity,
+                'watermark' : watermark,
+                'doc_ids'   : loader.doc_id_map.write(snapshot),
+                'chem_ids'  : loader.existing_chemicals.write(snapshot) }
+
+            header_offset = snapshot.tell()
+            snapshot.write( json.dumps(header) )
+            snapshot.write( self.TRAILER.pack(header_offset) )
+            snapshot.flush()
+            os.fsync( snapshot.fileno() )
+
+        os.rename(temp_path, self.path)
+
+        for journal_path in (self.doc_journal_path, self.chem_journal_path):
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+
+    def replay_journals(self, loader):
+        """
+        Apply the journals to the loader's ID structures, without journalling the entries again; e.g. to learn the
+        IDs written by other processes.
+        """
+
+        doc_journal = loader.doc_id_map.journal
+        chem_journal = loader.existing_chemicals.journal
+        loader.doc_id_map.journal = None
+        loader.existing_chemicals.journal = None
+
+        try:
+            # Ignore any partial record at the end of a journal, left by a process that was killed mid-write
+            loader.doc_id_map.replay( self._read_journal(self.doc_journal_path, 3) )
+            loader.existing_chemicals.update( self._read_journal(self.chem_journal_path, 1) )
+        finally:
+            loader.doc_id_map.journal = doc_journal
+            loader.existing_chemicals.journal = chem_journal
+
+    def _read_journal(self, journal_path, record_size):
+
+        entries = array('l')
+        if not os.path.exists(journal_path) or os.path.getsize(journal_path) == 0:
+            return entries
+
+        with open(journal_path, 'rb') as journal:
+            data = mmap.mmap(journal.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            record_bytes = entries.itemsize * record_size
+            entries.fromstring( buffer(data, 0, len(data) - len(data) % record_bytes) )
+        finally:
+            data.close()
+
+        return entries
+
+    def _append(self, journal_path, entries):
+        """Append entries to a journal, with a single write so that concurrent writers don't interleave records"""
+
+        if len(entries) == 0:
+            return
+
+        fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            data = entries.tostring()
+            written = os.write(fd, data)
+            if written != len(data):
+                raise IOError("Incomplete write to ID cache journal [{}]: {} of {} bytes".format(journal_path, written, len(data)))
+        finally:
+            os.close(fd)
+
+        del entries[:]
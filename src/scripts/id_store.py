@@ -0,0 +1,262 @@
+import sys
+from array import array
+from zlib import crc32
+
+class ChemicalIdSet:
+    """
+    Compact set of chemical IDs (non-negative integers), stored as a sparse bitmap.
+
+    The bitmap is split into fixed-size pages that are allocated on demand, so memory use is one bit per
+    possible ID in the occupied ID ranges, rather than a boxed int plus hash table slot per member.
+    """
+
+    # 2^19 IDs (64KiB) per page; the constants are repeated in __contains__, which is speed critical
+    PAGE_BITS = 19
+    PAGE_MASK = (1 << PAGE_BITS) - 1
+    PAGE_BYTES = 1 << (PAGE_BITS - 3)
+
+    def __init__(self, ids=()):
+        self.pages = dict()
+        self.count = 0
+
+        # Optional array('l') that records newly added IDs (see IdCache)
+        self.journal = None
+
+        self.update(ids)
+
+    def __contains__(self, chem_id):
+        page = self.pages.get(chem_id >> 19)
+        if page is None:
+            return False
+        offset = chem_id & 0x7ffff
+        return page[offset >> 3] & (1 << (offset & 7)) != 0
+
+    def add(self, chem_id):
+        """Add a chemical ID to the set"""
+        if chem_id < 0:
+            raise ValueError("Chemical IDs must not be negative: {}".format(chem_id))
+
+        page_no = chem_id >> self.PAGE_BITS
+        page = self.pages.get(page_no)
+        if page is None:
+            page = bytearray(self.PAGE_BYTES)
+            self.pages[page_no] = page
+
+        offset = chem_id & self.PAGE_MASK
+        bit = 1 << (offset & 7)
+        if not page[offset >> 3] & bit:
+            page[offset >> 3] |= bit
+            self.count += 1
+            if self.journal is not None:
+                self.journal.append(chem_id)
+
+    def update(self, chem_ids):
+        """Add all the given chemical IDs to the set"""
+        for chem_id in chem_ids:
+            self.add(chem_id)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for page_no in sorted(self.pages):
+            page = self.pages[page_no]
+            base = page_no << self.PAGE_BITS
+            for byte_no, byte in enumerate(page):
+                if byte == 0:
+                    continue
+                for bit in xrange(8):
+                    if (byte >> bit) & 1:
+                        yield base + (byte_no << 3) + bit
+
+    def write(self, output):
+        """
+        Write the raw pages of the set to a binary file.
+        :return: Header dict, needed to read the pages back.
+        """
+        page_nos = sorted(self.pages)
+        for page_no in page_nos:
+            output.write(self.pages[page_no])
+        return {'count': self.count, 'page_nos': page_nos}
+
+    @classmethod
+    def read(cls, header, data, offset):
+        """
+        Read a set from raw pages, as written by write().
+        :param header: Header dict returned by write().
+        :param data: Buffer (e.g. mmap) holding the pages.
+        :param offset: Start of the pages in the buffer.
+        :return: Tuple of (ChemicalIdSet, offset of the end of the pages).
+        """
+        chem_ids = cls()
+        for page_no in header['page_nos']:
+            chem_ids.pages[page_no] = bytearray( buffer(data, offset, cls.PAGE_BYTES) )
+            offset += cls.PAGE_BYTES
+        chem_ids.count = header['count']
+        return chem_ids, offset
+
+
+class DocumentIdMap:
+    """
+    Compact map of SCPN (publication number) to document ID.
+
+    Each SCPN is reduced to a 96 bit fingerprint - its 64 bit string hash, plus a CRC32 check value - which is
+    stored with the 32 bit document ID in an open-addressing hash table made of three flat integer arrays (16 bytes
+    per slot), rather than keeping a string object and a boxed int for every document. The chance of two SCPNs
+    sharing a fingerprint is negligible (around 1 in 10^13 for a hundred million documents). SCPNs that aren't
+    plain ASCII are kept in an ordinary dict.
+    """
+
+    # String hashes are never -1, so that marks an empty slot (repeated in get, which is speed critical)
+    EMPTY = -1
+    MIN_CAPACITY = 1024
+    MAX_LOAD = 0.7
+
+    def __init__(self, mapping=None):
+        self.keys = array('l', [self.EMPTY]) * self.MIN_CAPACITY
+        self.checks = array('I', [0]) * self.MIN_CAPACITY
+        self.values = array('i', [0]) * self.MIN_CAPACITY
+        self.mask = self.MIN_CAPACITY - 1
+        self.count = 0
+        self.overflow = dict()
+
+        # Optional array('l') that records new entries, as (hash, check, doc ID) triples (see IdCache)
+        self.journal = None
+
+        if mapping is not None:
+            self.update(mapping)
+
+    def get(self, scpn, default=None):
+        try:
+            check = crc32(scpn) & 0xffffffff
+        except UnicodeError:
+            return self.overflow.get(scpn, default)
+
+        key = hash(scpn)
+        keys = self.keys
+        mask = self.mask
+        i = key & mask
+        while True:
+            found = keys[i]
+            if found == key and self.checks[i] == check:
+                return self.values[i]
+            if found == -1:
+                return default
+            i = (i + 1) & mask
+
+    def __getitem__(self, scpn):
+        doc_id = self.get(scpn)
+        if doc_id is None:
+            raise KeyError(scpn)
+        return doc_id
+
+    def __contains__(self, scpn):
+        return self.get(scpn) is not None
+
+    def __setitem__(self, scpn, doc_id):
+        try:
+            check = crc32(scpn) & 0xffffffff
+        except UnicodeError:
+            self.overflow[scpn] = doc_id
+            return
+
+        key = hash(scpn)
+        if self._put(key, check, doc_id) and self.journal is not None:
+            self.journal.extend( (key, check, doc_id) )
+
+        if self.count > self.MAX_LOAD * len(self.keys):
+            self._resize( len(self.keys) * 2 )
+
+    def update(self, mapping):
+        """Add all entries of the given dict to the map"""
+        for scpn, doc_id in mapping.iteritems():
+            self[scpn] = doc_id
+
+    def replay(self, journal):
+        """Apply entries recorded in a journal array (possibly by another process) to the map"""
+        for i in xrange(0, len(journal) - 2, 3):
+            self._put(journal[i], journal[i + 1], journal[i + 2])
+            if self.count > self.MAX_LOAD * len(self.keys):
+                self._resize( len(self.keys) * 2 )
+
+    def write(self, output):
+        """
+        Write the raw hash table of the map to a binary file.
+        :return: Header dict, needed to read the table back.
+        """
+        self.keys.tofile(output)
+        self.checks.tofile(output)
+        self.values.tofile(output)
+        return {'capacity': len(self.keys), 'count': self.count, 'overflow': self.overflow}
+
+    @classmethod
+    def read(cls, header, data, offset):
+        """
+        Read a map from a raw hash table, as written by write().
+        :param header: Header dict returned by write().
+        :param data: Buffer (e.g. mmap) holding the table.
+        :param offset: Start of the table in the buffer.
+        :return: Tuple of (DocumentIdMap, offset of the end of the table).
+        """
+        doc_ids = cls()
+        capacity = header['capacity']
+
+        for name in ('keys', 'checks', 'values'):
+            table = array( getattr(doc_ids, name).typecode )
+            size = capacity * table.itemsize
+            table.fromstring( buffer(data, offset, size) )
+            setattr(doc_ids, name, table)
+            offset += size
+
+        doc_ids.mask = capacity - 1
+        doc_ids.count = header['count']
+        doc_ids.overflow = dict(header['overflow'])
+        return doc_ids, offset
+
+    def memory_bytes(self):
+        """Approximate memory held by the map, in bytes (the arrays, plus the overflow dict and its contents)"""
+        table_bytes = sum( table.buffer_info()[1] * table.itemsize for table in (self.keys, self.checks, self.values) )
+        return table_bytes + dict_memory_bytes(self.overflow)
+
+    def _put(self, key, check, doc_id):
+        """Store an entry in the hash table, returning False if it was already there"""
+        keys = self.keys
+        mask = self.mask
+        i = key & mask
+        while True:
+            found = keys[i]
+            if found == self.EMPTY:
+                keys[i] = key
+                self.checks[i] = check
+                self.count += 1
+                break
+            if found == key and self.checks[i] == check:
+                if self.values[i] == doc_id:
+                    return False
+                break
+            i = (i + 1) & mask
+        self.values[i] = doc_id
+        return True
+
+    def _resize(self, capacity):
+        old_keys = self.keys
+        old_checks = self.checks
+        old_values = self.values
+
+        self.keys = array('l', [self.EMPTY]) * capacity
+        self.checks = array('I', [0]) * capacity
+        self.values = array('i', [0]) * capacity
+        self.mask = capacity - 1
+        self.count = 0
+
+        for i, key in enumerate(old_keys):
+            if key != self.EMPTY:
+                self._put(key, old_checks[i], old_values[i])
+
+    def __len__(self):
+        return self.count + len(self.overflow)
+
+
+def dict_memory_bytes(mapping):
+    """Approximate memory held by a dict and its keys and values, in bytes, e.g. for comparison with DocumentIdMap"""
+    return sys.getsizeof(mapping) + sum( sys.getsizeof(key) + sys.getsizeof(value) for key, value in mapping.iteritems() )
@@ -0,0 +1,133 @@
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Data file names, e.g. "a.biblio.json", "a.chemicals.tsv" and "a_supp2.chemicals.tsv" all belong to unit "a"
+BIBLIO_FILE_REGEX = re.compile(r"\.biblio\.json(\.gz)?$")
+CHEM_FILE_REGEX   = re.compile(r"(_supp[0-9]+)?\.chemicals\.tsv(\.gz)?$")
+
+
+def is_biblio_file(file_name):
+    """Check if the given file name is a biblio data file"""
+    return BIBLIO_FILE_REGEX.search(file_name) is not None
+
+def is_chem_file(file_name):
+    """Check if the given file name is a chemicals data file"""
+    return CHEM_FILE_REGEX.search(file_name) is not None
+
+def unit_key(file_name):
+    """Identify the biblio/chemicals file group that a data file belongs to (the base name, minus suffixes)"""
+    base_name = os.path.basename(file_name)
+    return CHEM_FILE_REGEX.sub("", BIBLIO_FILE_REGEX.sub("", base_name))
+
+
+def group_order(file_name):
+    """Sort key for the files of a group: the biblio file, then the main chemicals file, then supplementary files"""
+    base_name = os.path.basename(file_name)
+    match = CHEM_FILE_REGEX.search(base_name)
+    supp_no = int(match.group(1)[len("_supp"):]) if match is not None and match.group(1) else 0
+    return (not is_biblio_file(file_name), supp_no, base_name)
+
+
+def pipeline_order(file_list):
+    """
+    Order a list of data files so that each biblio file is immediately followed by its chemical files, allowing
+    each group to be loaded as soon as it has arrived. Groups keep the order of their first file.
+    :param file_list: List of file paths or names.
+    :return: Re-ordered list of the same files; files that aren't biblio or chemicals data are dropped.
+    """
+
+    groups = dict()
+    keys = []
+
+    for file_name in file_list:
+        if not (is_biblio_file(file_name) or is_chem_file(file_name)):
+            continue
+        key = unit_key(file_name)
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(file_name)
+
+    ordered = []
+    for key in keys:
+        ordered.extend( sorted(groups[key], key=group_order) )
+
+    return ordered
+
+
+def load_in_order(arrivals, expected_files, load_biblio, load_chems):
+    """
+    Load data files as they arrive. Biblio files are loaded immediately, while a chemicals file is held back until
+    the biblio file from its group has been loaded (if that biblio file is expected at all), so that document IDs
+    are available for its mappings, and until the chemicals files that precede it in the group (see group_order)
+    have been loaded, so that supplementary files are applied after the main file, and in sequence.
+    :param arrivals: Iterable of local file paths, in order of arrival.
+    :param expected_files: All file names that are expected to arrive.
+    :param load_biblio: Function to load a biblio file, given its path.
+    :param load_chems: Function to load a chemicals file, given its path.
+    :return: Number of files loaded.
+    """
+
+    expected_biblio = set( unit_key(f) for f in expected_files if is_biblio_file(f) )
+    expected_chems = dict()
+    for f in expected_files:
+        if is_chem_file(f):
+            expected_chems.setdefault(unit_key(f), set()).add( os.path.basename(f) )
+
+    loaded_biblio = set()
+    loaded_chems = []
+    waiting_chems = []
+    loaded = 0
+
+    def is_ready(chem_path):
+        key = unit_key(chem_path)
+        if key in expected_biblio and key not in loaded_biblio:
+            return False
+        order = group_order(chem_path)
+        return all( name in loaded_chems or group_order(name) >= order for name in expected_chems.get(key, ()) )
+
+    def load_chems_file(chem_path):
+        load_chems(chem_path)
+        loaded_chems.append( os.path.basename(chem_path) )
+
+    def release_waiting():
+        # Loading one file may release the next in its group
+        while True:
+            ready = sorted( [f for f in waiting_chems if is_ready(f)], key=group_order )
+            if not ready:
+                return
+            waiting_chems.remove(ready[0])
+            load_chems_file(ready[0])
+
+    for file_path in arrivals:
+
+        if is_biblio_file(file_path):
+
+            load_biblio(file_path)
+            loaded += 1
+            loaded_biblio.add( unit_key(file_path) )
+
+            # Release any chemicals files that were waiting for this biblio file
+            release_waiting()
+
+        elif is_chem_file(file_path):
+
+            if is_ready(file_path):
+                load_chems_file(file_path)
+                release_waiting()
+            else:
+                logger.info("Chemicals file [{}] is waiting for the files before it in its group".format(file_path))
+                waiting_chems.append(file_path)
+
+        else:
+            logger.info("Ignoring non-data file [{}]".format(file_path))
+
+    # Files that never arrived would have raised errors upstream; load anything left regardless, in group order
+    for chem_path in sorted(waiting_chems, key=group_order):
+        logger.warn("Files before [{}] in its group were not loaded; loading chemicals anyway".format(chem_path))
+        load_chems_file(chem_path)
+
+    return loaded + len(loaded_chems)
@@ -0,0 +1,63 @@
+import time
+import logging
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+PRUNE_SQL = "delete from schembl_document_chemistry where schembl_doc_id >= :low and schembl_doc_id < :high and frequency = 0"
+
+PRUNE_WIDE_SQL = "delete from schembl_document_chemistry_wide where schembl_doc_id >= :low and schembl_doc_id < :high and " \
+                 "title_count = 0 and abstract_count = 0 and claims_count = 0 and description_count = 0 and " \
+                 "image_count = 0 and attachment_count = 0"
+
+def prune_zero_mappings(db, batch_docs=10000, start_id=None, end_id=None, wide=False):
+    """
+    Delete the document/chemical mappings with a frequency of zero, which aren't written when loading with sparse
+    mappings. Mappings are deleted for one range of document IDs at a time, so each delete follows the primary key
+    index and is committed separately; the prune can be interrupted and resumed from the last logged ID.
+    :param db: SQL Alchemy engine.
+    :param batch_docs: Number of document IDs per delete (and commit).
+    :param start_id: First document ID to prune; defaults to the lowest document ID.
+    :param end_id: Last document ID to prune; defaults to the highest document ID.
+    :param wide: Flag indicating that mappings are kept in the wide table, whose rows are deleted if all their counts
+        are zero.
+    :return: Number of mappings deleted.
+    """
+
+    prune_sql = PRUNE_WIDE_SQL if wide else PRUNE_SQL
+
+    conn = db.connect()
+    try:
+        low_id, high_id = conn.execute( text("select min(id), max(id) from schembl_document") ).fetchone()
+        if low_id is None:
+            logger.info("No documents found; nothing to prune")
+            return 0
+
+        low_id = low_id if start_id is None else max(low_id, start_id)
+        high_id = high_id if end_id is None else min(high_id, end_id)
+
+        logger.info( "Pruning zero-frequency mappings for document IDs {} to {}, {} documents at a time".format(low_id, high_id, batch_docs) )
+
+        total = 0
+        start = time.time()
+
+        for low in xrange(low_id, high_id + 1, batch_docs):
+            high = min(low + batch_docs, high_id + 1)
+
+            transaction = conn.begin()
+            try:
+                deleted = conn.execute( text(prune_sql), low=low, high=high ).rowcount
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+
+            total += deleted
+            logger.info( "Deleted {} mappings for document IDs {} to {} ({} in total, {:.0f} seconds)".format(deleted, low, high - 1, total, time.time() - start) )
+
+        logger.info( "Pruning complete; {} zero-frequency mappings deleted".format(total) )
+
+        return total
+
+    finally:
+        conn.close()
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+class Metrics:
+    """
+    Collects counters, gauges and histograms for a loading run, so that the time spent in each phase (download,
+    decompression, parsing, ID lookups, and insertion into each table) can be reported and graphed.
+
+    Each metric is identified by a name plus optional labels, e.g. observe('phase_seconds', 0.2, phase='download').
+    Updates are thread safe. Metrics from worker processes can be combined with merge(), and the whole collection
+    written out as a JSON summary, or as a Prometheus textfile (for the node exporter's textfile collector).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        """Increment a counter"""
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge"""
+        with self.lock:
+            self.gauges[ (name, _label_key(labels)) ] = value
+
+    def observe(self, name, value, **labels):
+        """Record an observation (typically a duration in seconds) in a histogram"""
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = _Histogram(self.buckets)
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager that records the time taken by its body in a histogram"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def timed_iter(self, iterable, name, batch=1, exclude=None, **labels):
+        """
+        Wrap an iterable, recording the time spent producing its items (e.g. reading and parsing) in a histogram.
+        :param batch: Number of items per observation; time for the last, partial batch is recorded at the end.
+        :param exclude: Optional object with a running total of seconds in its elapsed attribute (e.g. a TimedReader),
+            for time that is recorded elsewhere; any time it gains while producing an item is left out.
+        """
+        it = iter(iterable)
+        elapsed = 0.0
+        count = 0
+        try:
+            while True:
+                excluded = exclude.elapsed if exclude is not None else 0.0
+                start = time.time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    elapsed += time.time() - start
+                    if exclude is not None:
+                        elapsed -= exclude.elapsed - excluded
+                    return
+                elapsed += time.time() - start
+                if exclude is not None:
+                    elapsed -= exclude.elapsed - excluded
+                count += 1
+                if count == batch:
+                    self.observe(name, elapsed, **labels)
+                    elapsed = 0.0
+                    count = 0
+                yield item
+        finally:
+            if count > 0:
+                self.observe(name, elapsed, **labels)
+
+    def merge(self, summary):
+        """Add the metrics from a summary (e.g. one written by a worker process) to this collection"""
+        with self.lock:
+            for entry in summary['counters']:
+                key = (entry['name'], _label_key(entry['labels']))
+                self.counters[key] = self.counters.get(key, 0) + entry['value']
+
+            for entry in summary['gauges']:
+                self.gauges[ (entry['name'], _label_key(entry['labels'])) ] = entry['value']
+
+            for entry in summary['histograms']:
+                key = (entry['name'], _label_key(entry['labels']))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = _Histogram(self.buckets)
+                    self.histograms[key] = histogram
+                histogram.merge(entry)
+
+    def summary(self):
+        """Return all metrics as a JSON-serializable dict"""
+        with self.lock:
+            return {
+                'counters'   : [ {'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in sorted(self.counters.items()) ],
+                'gauges'     : [ {'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in sorted(self.gauges.items()) ],
+                'histograms' : [ dict(histogram.summary(), name=name, labels=dict(labels))
+                                 for (name, labels), histogram in sorted(self.histograms.items()) ] }
+
+    def write_summary(self, file_name):
+        """Write all metrics to a JSON file"""
+        _write_atomic(file_name, json.dumps(self.summary(), indent=2, sort_keys=True) + "\n")
+        logger.info("Metrics summary written to [{}]".format(file_name))
+
+    def write_prometheus(self, file_name, prefix='schembl_load_'):
+        """
+        Write all metrics to a file in the Prometheus text exposition format. The file is replaced atomically, as
+        required by the node exporter's textfile collector.
+        """
+
+        lines = []
+        summary = self.summary()
+
+        for metric_type, entries in (('counter', summary['counters']), ('gauge', summary['gauges'])):
+            for name in _names(entries):
+                lines.append( "# TYPE {}{} {}".format(prefix, name, metric_type) )
+                for entry in entries:
+                    if entry['name'] == name:
+                        lines.append( "{}{}{} {}".format(prefix, name, _prom_labels(entry['labels']), _prom_value(entry['value'])) )
+
+        for name in _names(summary['histograms']):
+            lines.append( "# TYPE {}{} histogram".format(prefix, name) )
+            for entry in summary['histograms']:
+                if entry['name'] != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], entry['buckets']):
+                    cumulative += count
+                    labels = dict(entry['labels'], le=str(bound))
+                    lines.append( "{}{}_bucket{} {}".format(prefix, name, _prom_labels(labels), cumulative) )
+                lines.append( "{}{}_sum{} {}".format(prefix, name, _prom_labels(entry['labels']), _prom_value(entry['sum'])) )
+                lines.append( "{}{}_count{} {}".format(prefix, name, _prom_labels(entry['labels']), entry['count']) )
+
+        _write_atomic(file_name, "\n".join(lines) + "\n")
+        logger.info("Prometheus metrics written to [{}]".format(file_name))
+
+    def log_phases(self, name='phase_seconds'):
+        """Log the total time and count for each phase"""
+        with self.lock:
+            phases = [ (dict(labels).get('phase'), histogram) for (metric, labels), histogram in sorted(self.histograms.items())
+                       if metric == name ]
+        for phase, histogram in phases:
+            logger.info( "Phase [{}]: {:.3f} seconds in {} operations".format(phase, histogram.sum, histogram.count) )
+
+
+class _Histogram:
+    """Bucketed counts of observations, plus their count, sum, min and max"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, entry):
+        if len(entry['buckets']) != len(self.counts):
+            raise ValueError("Histogram buckets don't match")
+        self.counts = [ a + b for a, b in zip(self.counts, entry['buckets']) ]
+        self.count += entry['count']
+        self.sum += entry['sum']
+        for value in (entry['min'], entry['max']):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max, 'buckets': list(self.counts)}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _names(entries):
+    names = []
+    for entry in entries:
+        if entry['name'] not in names:
+            names.append(entry['name'])
+    return names
+
+def _prom_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join( '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                           for key, value in sorted(labels.items()) ) + "}"
+
+def _prom_value(value):
+    return repr(float(value))
+
+def _write_atomic(file_name, content):
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'w') as output:
+        output.write(content)
+    os.rename(temp_name, file_name)
@@ -1,8 +1,13 @@
 
 import os
 import re
+import time
 import logging
 import ftplib
+import threading
+import Queue
+from .helper_funcs import retry
+from .metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
@@ -23,13 +28,18 @@ class NewFileReader:
     SUPP_CHEM_REGEX = r"_supp[0-9]+.chemicals.tsv.gz"
     FILE_PATH_REGEX = r"(.*/)([^/]+$)"
 
-    def __init__(self, ftp):
+    def __init__(self, ftp, ftp_factory=None, metrics=None):
         """
         Create a NewFileReader object.
         :param ftp: Instance of ftplib.FTP, must be initialized and ready for server interaction.
+        :param ftp_factory: Optional callable returning a new, logged in, ftplib.FTP instance. Required for
+            concurrent downloads, and used to reconnect after failed downloads.
+        :param metrics: Optional Metrics object, to record download timings and counts in.
         """
 
         self.ftp = ftp
+        self.ftp_factory = ftp_factory
+        self.metrics = metrics if metrics is not None else Metrics()
         self.supp_regex = re.compile(self.SUPP_CHEM_REGEX)
 
 
@@ -172,34 +182,196 @@ class NewFileReader:
         return download_list
 
 
-    def read_files(self,file_list,target_dir):
+    def read_files(self, file_list, target_dir, workers=1, attempts=3, retry_secs=30):
         """
         Download the files from the FTP server, into the target folder.
+
+        Partially downloaded files are resumed (using REST) and each download is checked against the size
+        reported by the server. Failed downloads are retried, on a fresh connection where possible.
         :param file_list: List of absolute file paths on FTP server. Invalid paths will result in ftplib exceptions
         :param target_dir: Local file path to store the downloads in; will be created if non-existent
+        :param workers: Number of concurrent FTP sessions to download with; requires an ftp_factory if > 1
+        :param attempts: Maximum number of attempts for each file
+        :param retry_secs: Seconds to wait between attempts
+        """
+
+        for local_path in self.iter_files(file_list, target_dir, workers, attempts, retry_secs):
+            pass
+
+    def iter_files(self, file_list, target_dir, workers=1, attempts=3, retry_secs=30, queue_size=0):
+        """
+        Download the files from the FTP server in background threads, yielding the local path of each file as
+        soon as its download is complete. Files are fetched in list order, but may complete out of order when
+        several workers are used. See read_files for parameter details.
+        :param queue_size: Maximum number of completed downloads waiting to be consumed before the download
+            workers pause (0 for unlimited).
         """
 
         logger.info( "Creating target directory for download: [{}]".format(target_dir) )
         if not os.path.exists(target_dir):
             os.makedirs(target_dir, mode=0755)
 
+        if workers > 1 and self.ftp_factory is None:
+            raise ValueError("An FTP connection factory is required for concurrent downloads")
+
+        work = Queue.Queue()
         for file_path in file_list:
+            work.put(file_path)
+
+        workers = max(1, min(workers, len(file_list)))
+        if workers > 1:
+            logger.info( "Downloading {} files with {} concurrent FTP sessions".format(len(file_list), workers) )
+
+        done = Queue.Queue(queue_size)
+        failures = []
+        for i in range(workers):
+            session = _FTPSession(self.ftp_factory, self.ftp if workers == 1 else None)
+            thread = threading.Thread(
+                target=self._download_worker,
+                args=(work, target_dir, session, attempts, retry_secs, failures, done, workers == 1),
+                name="ftp-download-{}".format(i))
+            thread.daemon = True
+            thread.start()
+
+        # Each worker signals completion with None
+        finished = 0
+        while finished < workers:
+            local_path = done.get()
+            if local_path is None:
+                finished += 1
+            else:
+                yield local_path
+
+        if len(failures) > 0:
+            if workers == 1:
+                raise failures[0][1]
+            raise RuntimeError( "Failed to download {} files: {}".format(
+                len(failures), ", ".join( sorted(file_path for file_path, exc in failures) )) )
 
-            matched = re.match(self.FILE_PATH_REGEX, file_path)
-            path = matched.group(1)
-            file = matched.group(2)
+    def _download_worker(self, work, target_dir, session, attempts, retry_secs, failures, done, stop_on_failure):
+        """
+        Download files from the work queue until it is empty, putting the local path of each downloaded file on
+        the done queue, followed by None when finished. Files that can't be downloaded are recorded in the
+        failure list.
+        """
 
-            fhandle = open("{0}/{1}".format(target_dir,file), 'wb')
+        try:
+
+            while True:
+
+                try:
+                    file_path = work.get_nowait()
+                except Queue.Empty:
+                    break
+
+                start = time.time()
+                try:
+                    local_path = retry(attempts, self._download_file, [session, file_path, target_dir], sleep_secs=retry_secs)
+                except Exception, exc:
+                    logger.error( "Giving up on download of [{}]: {}".format(file_path, exc) )
+                    self.metrics.incr('downloads_total', status='failed')
+                    failures.append( (file_path, exc) )
+                    if stop_on_failure:
+                        break
+                else:
+                    self.metrics.observe('phase_seconds', time.time() - start, phase='download')
+                    self.metrics.incr('downloads_total', status='ok')
+                    self.metrics.incr('bytes_downloaded_total', os.path.getsize(local_path))
+                    done.put(local_path)
+
+        finally:
+            session.close()
+            done.put(None)
+
+    def _download_file(self, session, file_path, target_dir):
+        """
+        Download (or resume downloading) a single file, verifying its size against the server.
+        :return: The local path of the downloaded file.
+        """
+
+        matched = re.match(self.FILE_PATH_REGEX, file_path)
+        path = matched.group(1)
+        file = matched.group(2)
+
+        local_path = "{0}/{1}".format(target_dir,file)
+
+        self.metrics.incr('download_attempts_total')
+
+        try:
+
+            ftp = session.connection()
 
             logger.info("Changing to remote directory [{}]".format(path))
-            logger.info("Downloading [{}]".format(file))
+            ftp.cwd( path )
+
+            remote_size = self._remote_size(ftp, file)
+            offset = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+
+            if remote_size is None or offset > remote_size:
+                offset = 0
+            elif offset == remote_size:
+                logger.info("Skipping [{}], already downloaded".format(file))
+                return local_path
+
+            fhandle = open(local_path, 'ab' if offset > 0 else 'wb')
+
+            try:
+                if offset > 0:
+                    logger.info("Resuming download of [{}] from byte {}".format(file, offset))
+                    ftp.retrbinary("RETR " + file, fhandle.write, rest=offset)
+                else:
+                    logger.info("Downloading [{}]".format(file))
+                    ftp.retrbinary("RETR " + file, fhandle.write)
+            finally:
+                fhandle.close()
+
+        except Exception:
+            # The connection may be in an unknown state; use a new one for the next attempt
+            session.reset()
+            raise
 
-            self.ftp.cwd( path )
-            self.ftp.retrbinary("RETR " + file, fhandle.write)
+        local_size = os.path.getsize(local_path)
+        if remote_size is not None and local_size != remote_size:
+            raise IOError("Downloaded size of [{}] is {} bytes, but the server reported {} bytes".format(
+                file, local_size, remote_size))
 
-            # TODO implement resilient download / error checking / retry
+        return local_path
 
-            fhandle.close()
+    def _remote_size(self, ftp, file):
+        """Ask the server for the size of a file, in binary mode. Returns None if the server doesn't say"""
+        try:
+            ftp.voidcmd("TYPE I")
+            return ftp.size(file)
+        except ftplib.error_perm:
+            return None
 
 
+class _FTPSession:
+    """Holds an FTP connection for a download worker, (re)connecting with the connection factory as needed"""
 
+    def __init__(self, ftp_factory, ftp=None):
+        self.ftp_factory = ftp_factory
+        self.ftp = ftp
+        self.owned = ftp is None
+
+    def connection(self):
+        """Return the current connection, creating one if needed"""
+        if self.ftp is None:
+            self.ftp = self.ftp_factory()
+            self.owned = True
+        return self.ftp
+
+    def reset(self):
+        """Discard the current connection, if it can be replaced"""
+        if self.ftp_factory is None:
+            return
+        self.close()
+        self.ftp = None
+
+    def close(self):
+        """Close the current connection, if it was opened by this session"""
+        if self.ftp is not None and self.owned:
+            try:
+                self.ftp.quit()
+            except Exception:
+                self.ftp.close()
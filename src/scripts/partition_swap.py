@@ -0,0 +1,272 @@
+import logging
+from sqlalchemy import text, UniqueConstraint
+
+logger = logging.getLogger(__name__)
+
+# Document IDs below YEAR_ID_BASE are allocated by the schembl_document_id sequence, for front file (and other
+# ordinary) loads, and kept in the front partitions. Each backfile year loaded with a partition swap has its own
+# block of IDs above that, and its own partition of each document table; see schema/sc_data_partitioned.sql.
+YEAR_ID_BASE  = 100000000
+YEAR_ID_BLOCK = 10000000
+FIRST_YEAR    = 1960
+LAST_YEAR     = FIRST_YEAR + (2 ** 31 - 1 - YEAR_ID_BASE) // YEAR_ID_BLOCK - 1
+
+def year_id_range(year):
+    """Return the range of document IDs, as (first, last + 1), of the partitions for a backfile year"""
+    if not FIRST_YEAR <= year <= LAST_YEAR:
+        raise ValueError("Partitions are only defined for the years {} to {}, not {}".format(FIRST_YEAR, LAST_YEAR, year))
+    low = YEAR_ID_BASE + (year - FIRST_YEAR) * YEAR_ID_BLOCK
+    return low, low + YEAR_ID_BLOCK
+
+def staging_suffix(year):
+    """Return the table name suffix of the staging tables for a backfile year (see DataLoader's table_suffix)"""
+    return '_stage_{}'.format(year)
+
+
+class PartitionSwap:
+    """
+    Replaces the partitions of a backfile year in the document tables (documents, titles, classifications and
+    mappings), with standalone staging tables that a DataLoader has loaded the year into. Reloading a year is then a
+    metadata operation, rather than deletes and inserts that maintain the indexes of the whole tables.
+
+    The staging tables are created by prepare(), with the column definitions of the partitioned tables and a
+    document ID sequence covering the year's block of IDs, and are loaded by a DataLoader created with the year's
+    table_suffix. swap() then checks that none of the staged documents exist in other partitions, and puts the
+    staging tables in place of the year's partitions. (Ordinary loads into the partitioned tables make the same
+    check for each new document; see DataLoader._insert_documents.)
+
+    On PostgreSQL (12 or later), the old partitions are detached and dropped, and the staging tables are renamed
+    and attached, in a single transaction. On Oracle, the partitions are exchanged with the staging tables without
+    validation, and their local indexes rebuilt; the foreign keys are disabled for the exchange, and re-enabled
+    without validation, since the staged data was loaded with them in place. The staging tables, which then hold the
+    old data, are dropped.
+    """
+
+    SUPPORTED_DIALECTS = ('oracle', 'postgresql')
+
+    def __init__(self, loader, year):
+        """
+        Create a new PartitionSwap.
+        :param loader: DataLoader to load the staging tables with; its table_suffix must be staging_suffix(year).
+        :param year: Backfile year to replace the partitions of.
+        """
+        self.db = loader.db
+        if self.db.dialect.name not in self.SUPPORTED_DIALECTS:
+            raise ValueError("Partition swaps are only supported for Oracle and PostgreSQL, not {}".format(self.db.dialect.name))
+
+        suffix = staging_suffix(year)
+        if loader.table_suffix != suffix:
+            raise ValueError("The loader must write to the staging tables of {}, with table suffix {}".format(year, suffix))
+
+        self.loader = loader
+        self.year = year
+        self.low, self.high = year_id_range(year)
+        self.oracle = self.db.dialect.name == 'oracle'
+        self.sequence = loader.docs.c.id.default.name
+
+        # Staging tables, with the partitioned table that each replaces a partition of; documents first
+        self.staging_tables = [loader.docs, loader.titles, loader.classes, loader.chem_mapping]
+        self.targets = [(table.name, table.name[:-len(suffix)]) for table in self.staging_tables]
+
+    def partition_name(self, target):
+        """Return the name of the year's partition of a table (PostgreSQL)"""
+        return '{}_y{}'.format(target, self.year)
+
+    def prepare(self):
+        """Create empty staging tables and the staging document ID sequence, replacing any left by a failed run"""
+
+        logger.info( "Partition swap: creating staging tables for {} (document IDs {} to {})".format(self.year, self.low, self.high - 1) )
+
+        metadata = self.loader.db_metadata()
+
+        conn = self.db.connect()
+        try:
+            metadata.drop_all(conn, tables=self.staging_tables)
+            conn.execute( text("CREATE SEQUENCE {} START WITH {} MAXVALUE {}".format(self.sequence, self.low, self.high - 1)) )
+            for statement in self._create_statements():
+                conn.execute( text(statement) )
+            self._check_columns(conn)
+        finally:
+            conn.close()
+
+    def _create_statements(self):
+        """
+        Build the DDL for the staging tables. The columns are copied from the partitioned tables, since a partition
+        can only be swapped for a table with identical column definitions, while the keys are those of the loader's
+        tables, so that the staged data is checked as it's loaded.
+        """
+
+        statements = []
+
+        for table, (staged, target) in zip(self.staging_tables, self.targets):
+
+            if self.oracle:
+                statements.append( "CREATE TABLE {} AS SELECT * FROM {} WHERE 1 = 0".format(staged, target) )
+            else:
+                statements.append( "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(staged, target) )
+
+            statements.append( "ALTER TABLE {} ADD PRIMARY KEY ({})".format(staged, ", ".join(column.name for column in table.primary_key.columns)) )
+
+            for constraint in sorted(table.constraints, key=lambda c: [column.name for column in c.columns]):
+                if isinstance(constraint, UniqueConstraint):
+                    statements.append( "ALTER TABLE {} ADD UNIQUE ({})".format(staged, ", ".join(column.name for column in constraint.columns)) )
+
+            for key in sorted(table.foreign_keys, key=lambda k: k.parent.name):
+                statements.append( "ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {} ({})".format(staged, key.parent.name, key.column.table.name, key.column.name) )
+
+        return statements
+
+    def _check_columns(self, conn):
+        """
+        Check that the staging tables' column definitions match those of the partitioned tables, so that a swap
+        doesn't fail after the year has been loaded.
+        :raises RuntimeError: if any of the columns differ.
+        """
+
+        if self.oracle:
+            pairs = [(staged.upper(), target.upper()) for staged, target in self.targets]
+            query = ("SELECT table_name, column_name, data_type, data_length, data_precision, data_scale, char_used, nullable "
+                     "FROM user_tab_columns WHERE table_name IN ({})")
+        else:
+            pairs = self.targets
+            query = ("SELECT table_name, column_name, data_type, character_maximum_length, numeric_precision, is_nullable "
+                     "FROM information_schema.columns WHERE table_schema = current_schema() AND table_name IN ({})")
+
+        names = ", ".join("'{}'".format(name) for pair in pairs for name in pair)
+
+        columns = dict()
+        for row in conn.execute( text(query.format(names)) ).fetchall():
+            columns.setdefault(row[0], dict())[row[1]] = tuple(row[2:])
+
+        for staged, target in pairs:
+            staged_columns = columns.get(staged, dict())
+            target_columns = columns.get(target, dict())
+            different = sorted( name for name in set(staged_columns) | set(target_columns)
+                                if staged_columns.get(name) != target_columns.get(name) )
+            if different:
+                raise RuntimeError("The columns of staging table {} don't match those of {}: {}".format(staged, target, ", ".join(different)))
+
+    def swap(self):
+        """
+        Replace the year's partitions with the loaded staging tables.
+        :raises RuntimeError: if any of the staged documents already exist in another partition.
+        """
+
+        conn = self.db.connect()
+        try:
+            self._check_documents(conn)
+
+            if self.oracle:
+                statements = self._oracle_statements(conn)
+            else:
+                statements = self._postgres_statements(conn)
+
+            # Oracle commits each DDL statement as it goes
+            transaction = None if self.oracle else conn.begin()
+            try:
+                for statement in statements:
+                    logger.info( "Partition swap: {}".format(statement) )
+                    conn.execute( text(statement) )
+                if transaction is not None:
+                    transaction.commit()
+            except:
+                if transaction is not None:
+                    transaction.rollback()
+                raise
+        finally:
+            conn.close()
+
+        logger.info( "Partition swap: partitions for {} replaced".format(self.year) )
+
+    def _check_documents(self, conn):
+        """Check that the staged documents aren't found outside the year's partitions"""
+
+        staged, target = self.targets[0]
+        found = conn.execute( text("SELECT COUNT(*) FROM {} s JOIN {} d ON d.scpn = s.scpn "
+                                   "WHERE d.id < :low OR d.id >= :high".format(staged, target)),
+                              low=self.low, high=self.high ).scalar()
+        if found > 0:
+            raise RuntimeError("{} of the documents staged for {} already exist in other partitions".format(found, self.year))
+
+    def _postgres_statements(self, conn):
+        """Detach and drop the old partitions, children first, then attach the renamed staging tables"""
+
+        staged_names = [staged for staged, _ in self.targets]
+        names = ", ".join("'{}'".format(name) for name in staged_names + [self.partition_name(target) for _, target in self.targets])
+
+        foreign_keys = conn.execute( text(
+            "SELECT t.relname, c.conname FROM pg_constraint c JOIN pg_class t ON t.oid = c.conrelid "
+            "JOIN pg_namespace n ON n.oid = t.relnamespace "
+            "WHERE c.contype = 'f' AND n.nspname = current_schema() AND t.relname IN ({})".format(names)) ).fetchall()
+        indexes = conn.execute( text(
+            "SELECT tablename, indexname FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename IN ({})".format(names)) ).fetchall()
+        existing = set( row[0] for row in conn.execute( text(
+            "SELECT tablename FROM pg_tables "
+            "WHERE schemaname = current_schema() AND tablename IN ({})".format(names)) ) )
+
+        statements = []
+
+        # The partitioned tables' foreign keys are applied to the partitions when they're attached
+        for table, name in foreign_keys:
+            if table in staged_names:
+                statements.append( "ALTER TABLE {} DROP CONSTRAINT {}".format(table, name) )
+
+        for _, target in reversed(self.targets):
+            partition = self.partition_name(target)
+            if partition in existing:
+                statements.append( "ALTER TABLE {} DETACH PARTITION {}".format(target, partition) )
+                statements.append( "DROP TABLE {}".format(partition) )
+
+        for staged, target in self.targets:
+            partition = self.partition_name(target)
+            statements.append( "ALTER TABLE {} RENAME TO {}".format(staged, partition) )
+
+            # Index names include the table name; they're renamed too, so the next staging tables can reuse them
+            for table, index in indexes:
+                if table == staged and staged in index:
+                    statements.append( "ALTER INDEX {} RENAME TO {}".format(index, index.replace(staged, partition)) )
+
+            statements.append( "ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})".format(target, partition, self.low, self.high) )
+
+        statements.append( "DROP SEQUENCE {}".format(self.sequence) )
+
+        return statements
+
+    def _oracle_statements(self, conn):
+        """Exchange the year's (interval) partitions with the staging tables, then drop the staging tables"""
+
+        targets = [target.upper() for _, target in self.targets]
+        staged_names = [staged.upper() for staged, _ in self.targets]
+        names = ", ".join("'{}'".format(name) for name in targets + staged_names)
+
+        foreign_keys = conn.execute( text(
+            "SELECT table_name, constraint_name FROM user_constraints "
+            "WHERE constraint_type = 'R' AND table_name IN ({})".format(names)) ).fetchall()
+
+        target_keys = [(table, name) for table, name in foreign_keys if table in targets]
+
+        statements = []
+
+        for table, name in foreign_keys:
+            if table in staged_names:
+                statements.append( "ALTER TABLE {} DROP CONSTRAINT {}".format(table, name) )
+        for table, name in target_keys:
+            statements.append( "ALTER TABLE {} DISABLE CONSTRAINT {}".format(table, name) )
+
+        for staged, target in self.targets:
+            # Locking the partition creates it, if the year hasn't been loaded before
+            statements.append( "LOCK TABLE {} PARTITION FOR ({}) IN SHARE MODE".format(target, self.low) )
+            statements.append( "ALTER TABLE {} EXCHANGE PARTITION FOR ({}) WITH TABLE {} "
+                               "EXCLUDING INDEXES WITHOUT VALIDATION UPDATE GLOBAL INDEXES".format(target, self.low, staged) )
+            statements.append( "ALTER TABLE {} MODIFY PARTITION FOR ({}) REBUILD UNUSABLE LOCAL INDEXES".format(target, self.low) )
+
+        for table, name in target_keys:
+            statements.append( "ALTER TABLE {} ENABLE NOVALIDATE CONSTRAINT {}".format(table, name) )
+
+        for staged, _ in reversed(self.targets):
+            statements.append( "DROP TABLE {} PURGE".format(staged) )
+
+        statements.append( "DROP SEQUENCE {}".format(self.sequence) )
+
+        return statements
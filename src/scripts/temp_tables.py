@@ -0,0 +1,116 @@
+import logging
+from contextlib import contextmanager
+from sqlalchemy import MetaData, Table, select, text
+from sqlalchemy.schema import CreateTable
+
+logger = logging.getLogger(__name__)
+
+class TempTable:
+    """
+    Session-scoped temporary table, for set-based statements that join against a batch of keys (or records), rather
+    than listing them in an IN clause. IN lists are limited to 1000 elements on Oracle, and produce a different SQL
+    text for every batch size, whereas statements against a temporary table stay the same.
+
+    On PostgreSQL and SQLite, this is a temporary table, created on first use by each (DB-API) connection. On Oracle, it's
+    a global temporary table, which is created once (as a permanent part of the schema), but whose rows are private
+    to each session. Rows are only kept for the duration of a transaction; see loaded().
+    """
+
+    def __init__(self, db, name, *columns):
+        """
+        Create a new TempTable.
+        :param db: SQL Alchemy engine.
+        :param name: Table name; at most 30 characters, for Oracle.
+        :param columns: SQL Alchemy Columns of the table.
+        """
+        self.db = db
+        self.oracle = db.dialect.name == 'oracle'
+
+        # Keys are always supplied, so integer keys mustn't become SERIAL columns (with sequences) on PostgreSQL
+        for column in columns:
+            column.autoincrement = False
+
+        self.table = Table(name, MetaData(), *columns, prefixes=['GLOBAL TEMPORARY' if self.oracle else 'TEMPORARY'])
+        self.oracle_created = False
+
+        ddl = unicode( CreateTable(self.table).compile(dialect=db.dialect) ).strip()
+        if self.oracle:
+            self.create_ddl = ddl + " ON COMMIT DELETE ROWS"
+        else:
+            self.create_ddl = ddl.replace("CREATE TEMPORARY TABLE ", "CREATE TEMPORARY TABLE IF NOT EXISTS ", 1)
+            if db.dialect.name == 'postgresql':
+                self.create_ddl += " ON COMMIT DELETE ROWS"
+
+    @property
+    def c(self):
+        """Columns of the table, for use in SQL Alchemy expressions"""
+        return self.table.c
+
+    @contextmanager
+    def loaded(self, sql_alc_conn, records):
+        """
+        Context manager that fills the table with the given records, in a transaction, for the statements run in its
+        body on the same connection. The table is emptied again afterwards, and the transaction committed (or rolled
+        back on error).
+        :param records: Records to insert, as dicts of column name to value.
+        """
+
+        self._create(sql_alc_conn)
+
+        transaction = sql_alc_conn.begin()
+        try:
+            if len(records) > 0:
+                sql_alc_conn.execute(self.table.insert(), records)
+
+            yield self.table
+
+            sql_alc_conn.execute(self.table.delete())
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+
+    def lookup(self, sql_alc_conn, keys, target_column, columns):
+        """
+        Find the rows of another table that match any of the given keys, by loading the keys into this table (whose
+        primary key must be a single column) and joining against it. The SQL is the same however many keys there
+        are, so it's parsed once and can be cached by the database and driver.
+        :param keys: Keys to look for.
+        :param target_column: Column of the other table to match the keys against.
+        :param columns: Columns to select from the other table.
+        :return: List of matching rows.
+        """
+
+        key_name = list(self.table.primary_key.columns)[0].name
+
+        with self.loaded(sql_alc_conn, [{key_name: key} for key in keys]) as table:
+            sel = select(columns).where( target_column == table.c[key_name] )
+            return sql_alc_conn.execute(sel).fetchall()
+
+    def _create(self, sql_alc_conn):
+        """Create the table, unless it already exists"""
+
+        if not self.oracle:
+            # The pool's info dict lasts as long as the DB-API connection, and so its temporary tables
+            created = sql_alc_conn.info.setdefault('temp_tables', set())
+            if self.table.name not in created:
+                sql_alc_conn.execute( text(self.create_ddl) )
+                created.add(self.table.name)
+            return
+
+        if self.oracle_created:
+            return
+
+        found = sql_alc_conn.execute( text("select count(*) from user_tables where table_name = :name"),
+                                      name=self.table.name.upper() ).scalar()
+        if found == 0:
+            logger.info( "Creating global temporary table {}".format(self.table.name) )
+            try:
+                sql_alc_conn.execute( text(self.create_ddl) )
+            except Exception, exc:
+                # Another process may have just created it (ORA-00955: name is already used by an existing object)
+                if 'ORA-00955' not in str(exc):
+                    raise
+
+        self.oracle_created = True
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+from sqlalchemy import create_engine
+
+from mock import MagicMock
+
+from src.scripts.background_writer import BackgroundWriter
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+class RecordingBatcher:
+
+    def __init__(self, name, log, conn, fail_on=None):
+        self.name = name
+        self.log = log
+        self.conn = conn
+        self.fail_on = fail_on
+        log.append( (name, 'create', threading.current_thread().name) )
+
+    def execute(self, data):
+        if data == self.fail_on:
+            raise RuntimeError("Batch operation failed: {}".format(data))
+        self.log.append( (self.name, data, threading.current_thread().name) )
+
+    def close(self):
+        self.log.append( (self.name, 'close', threading.current_thread().name) )
+
+
+class BackgroundWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.db = MagicMock()
+
+    def test_operations_in_order(self):
+        writer = BackgroundWriter(self.db, depth=2, name='test-writer')
+        chems = writer.batcher( lambda conn: RecordingBatcher('chems', self.log, conn) )
+        maps = writer.batcher( lambda conn: RecordingBatcher('maps', self.log, conn) )
+
+        data = [1, 2]
+        for i in xrange(10):
+            chems.execute(data)
+            maps.execute(data)
+            data.append(i)
+        chems.close()
+        maps.close()
+        writer.close()
+
+        self.failUnless( all(thread == 'test-writer' for _, _, thread in self.log) )
+        self.failUnlessEqual( ('chems', 'create'), self.log[0][:2] )
+        self.failUnlessEqual( ('maps', [1, 2, 0, 1, 2, 3, 4, 5, 6, 7, 8]), self.log[-3][:2] )
+        self.failUnlessEqual( ['chems', 'maps'] * 10, [name for name, data, _ in self.log[2:-2]] )
+
+        # Batches are copied when queued
+        self.failUnlessEqual( [1, 2], self.log[2][1] )
+
+        self.db.connect.return_value.close.assert_called_once_with()
+
+    def test_flush(self):
+        writer = BackgroundWriter(self.db)
+        chems = writer.batcher( lambda conn: RecordingBatcher('chems', self.log, conn) )
+        chems.execute([1])
+        chems.flush()
+        self.failUnlessEqual( ('chems', [1]), self.log[-1][:2] )
+        writer.close()
+
+    def test_errors_raised_in_caller(self):
+        writer = BackgroundWriter(self.db)
+        chems = writer.batcher( lambda conn: RecordingBatcher('chems', self.log, conn, fail_on=[2]) )
+        chems.execute([1])
+        chems.execute([2])
+        chems.execute([3])
+
+        try:
+            writer.flush()
+            self.fail("A runtime error should have been thrown")
+        except RuntimeError as e:
+            self.failUnlessEqual( "Batch operation failed: [2]", e.message )
+
+        # Nothing is written after the failure, and the error is raised again by later calls
+        self.failIf( ('chems', [3]) in [entry[:2] for entry in self.log] )
+        self.failUnlessRaises( RuntimeError, chems.execute, [4] )
+        self.failUnlessRaises( RuntimeError, writer.close )
+        self.db.connect.return_value.close.assert_called_once_with()
+
+    def test_full_queue_with_failure(self):
+        # The caller doesn't stay blocked on a full queue if the writer fails
+        release = threading.Event()
+        writer = BackgroundWriter(self.db, depth=1)
+
+        def fail():
+            release.wait()
+            raise ValueError("Failed")
+
+        writer.submit(fail)
+        writer.submit(lambda: None)
+        threading.Timer(0.2, release.set).start()
+        self.failUnlessRaises( ValueError, writer.submit, lambda: None )
+
+    def test_sqlite_connection_used_by_writer(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            db = create_engine('sqlite:///' + os.path.join(work_dir, 'test.db'))
+            db.execute("create table test_table (id integer primary key)")
+
+            writer = BackgroundWriter(db)
+            writer.submit( lambda: writer.conn.execute("insert into test_table values (1)") )
+            writer.submit( lambda: writer.conn.commit() )
+            writer.close()
+
+            self.failUnlessEqual( [(1,)], db.execute("select id from test_table").fetchall() )
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+
+from mock import MagicMock
+
+from src.scripts.bulk_mode import BulkLoadMode
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+PG_INDEXES = [('fk_docchem_docid_idx', 'schembl_document_chemistry',
+               'CREATE INDEX fk_docchem_docid_idx ON public.schembl_document_chemistry USING btree (schembl_doc_id)')]
+
+PG_CONSTRAINTS = [('fk_docchem_to_doc', 'schembl_document_chemistry',
+                   'FOREIGN KEY (schembl_doc_id) REFERENCES schembl_document(id)')]
+
+ORA_INDEXES = [('FK_DOCCHEM_DOCID_IDX', 'SCHEMBL_DOCUMENT_CHEMISTRY')]
+
+ORA_CONSTRAINTS = [('FK_DOCCHEM_TO_DOC', 'SCHEMBL_DOCUMENT_CHEMISTRY')]
+
+class BulkLoadModeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.work_dir, 'bulk_mode_state.json')
+        self.statements = []
+        self.failing = None
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def mock_db(self, dialect, indexes, constraints, logged_tables=[], force_logging='NO'):
+
+        def execute(clause):
+            statement = str(clause)
+            if 'pg_indexes' in statement or 'user_indexes' in statement:
+                return indexes
+            if 'pg_constraint' in statement or 'user_constraints' in statement:
+                return constraints
+            if 'user_tables' in statement:
+                return logged_tables
+            if 'v$database' in statement:
+                return MagicMock( scalar=MagicMock(return_value=force_logging) )
+            with self.lock:
+                self.statements.append(statement)
+            if self.failing is not None and self.failing in statement:
+                raise DBAPIError(statement, None, Exception("insert or update violates foreign key constraint"))
+
+        db = MagicMock()
+        db.dialect.name = dialect
+        db.connect.return_value.execute.side_effect = execute
+        return db
+
+    def test_postgres(self):
+        bulk_mode = BulkLoadMode( self.mock_db('postgresql', PG_INDEXES, PG_CONSTRAINTS), self.state_file )
+
+        bulk_mode.disable()
+        self.failUnlessEqual( ['ALTER TABLE schembl_document_chemistry DROP CONSTRAINT fk_docchem_to_doc',
+                               'DROP INDEX fk_docchem_docid_idx'], self.statements )
+        self.failUnless( os.path.exists(self.state_file) )
+
+        del self.statements[:]
+        bulk_mode.restore()
+        self.failUnlessEqual( ['DROP INDEX IF EXISTS fk_docchem_docid_idx',
+                               PG_INDEXES[0][2],
+                               'ALTER TABLE schembl_document_chemistry DROP CONSTRAINT IF EXISTS fk_docchem_to_doc',
+                               'ALTER TABLE schembl_document_chemistry ADD CONSTRAINT fk_docchem_to_doc FOREIGN KEY (schembl_doc_id) REFERENCES schembl_document(id) NOT VALID',
+                               'ALTER TABLE schembl_document_chemistry VALIDATE CONSTRAINT fk_docchem_to_doc'], self.statements )
+        self.failIf( os.path.exists(self.state_file) )
+
+    def test_oracle(self):
+        bulk_mode = BulkLoadMode( self.mock_db('oracle', ORA_INDEXES, ORA_CONSTRAINTS), self.state_file, parallel=8 )
+
+        bulk_mode.disable()
+        self.failUnlessEqual( ['ALTER TABLE SCHEMBL_DOCUMENT_CHEMISTRY DISABLE CONSTRAINT FK_DOCCHEM_TO_DOC',
+                               'ALTER INDEX FK_DOCCHEM_DOCID_IDX UNUSABLE'], self.statements )
+
+        del self.statements[:]
+        bulk_mode.restore()
+        self.failUnlessEqual( ['ALTER INDEX FK_DOCCHEM_DOCID_IDX REBUILD PARALLEL 8',
+                               'ALTER INDEX FK_DOCCHEM_DOCID_IDX NOPARALLEL',
+                               'ALTER TABLE SCHEMBL_DOCUMENT_CHEMISTRY ENABLE VALIDATE CONSTRAINT FK_DOCCHEM_TO_DOC'], self.statements )
+
+    def test_oracle_nologging(self):
+        db = self.mock_db('oracle', ORA_INDEXES, ORA_CONSTRAINTS, logged_tables=[('SCHEMBL_CHEMICAL',), ('SCHEMBL_DOCUMENT_CHEMISTRY',)])
+        bulk_mode = BulkLoadMode( db, self.state_file, parallel=8, nologging=True )
+
+        bulk_mode.disable()
+        self.failUnlessEqual( ['ALTER TABLE SCHEMBL_CHEMICAL NOLOGGING',
+                               'ALTER TABLE SCHEMBL_DOCUMENT_CHEMISTRY NOLOGGING'], self.statements[2:] )
+
+        del self.statements[:]
+        bulk_mode.restore()
+        self.failUnlessEqual( ['ALTER INDEX FK_DOCCHEM_DOCID_IDX REBUILD PARALLEL 8 NOLOGGING',
+                               'ALTER INDEX FK_DOCCHEM_DOCID_IDX NOPARALLEL LOGGING',
+                               'ALTER TABLE SCHEMBL_DOCUMENT_CHEMISTRY ENABLE VALIDATE CONSTRAINT FK_DOCCHEM_TO_DOC',
+                               'ALTER TABLE SCHEMBL_CHEMICAL LOGGING',
+                               'ALTER TABLE SCHEMBL_DOCUMENT_CHEMISTRY LOGGING'], self.statements )
+        self.failIf( os.path.exists(self.state_file) )
+
+    def test_force_logging(self):
+        db = self.mock_db('oracle', [], [], logged_tables=[('SCHEMBL_CHEMICAL',)], force_logging='YES')
+        BulkLoadMode( db, self.state_file, nologging=True ).disable()
+        self.failUnlessEqual( [], self.statements )
+        self.failUnlessRaises( ValueError, BulkLoadMode, self.mock_db('postgresql', [], []), self.state_file, nologging=True )
+
+    def test_integrity_failure_keeps_state(self):
+        bulk_mode = BulkLoadMode( self.mock_db('postgresql', PG_INDEXES, PG_CONSTRAINTS), self.state_file )
+        bulk_mode.disable()
+
+        self.failing = 'VALIDATE CONSTRAINT'
+        try:
+            bulk_mode.restore()
+            self.fail("A runtime error should have been thrown")
+        except RuntimeError as e:
+            self.failUnless( e.message.startswith("Integrity check failed after bulk loading") )
+        self.failUnless( os.path.exists(self.state_file) )
+
+    def test_state_from_failed_run_restored(self):
+        BulkLoadMode( self.mock_db('postgresql', PG_INDEXES, PG_CONSTRAINTS), self.state_file ).disable()
+
+        # The failed run dropped everything, so the next run finds nothing in the database
+        bulk_mode = BulkLoadMode( self.mock_db('postgresql', [], []), self.state_file )
+        bulk_mode.disable()
+
+        del self.statements[:]
+        bulk_mode.restore()
+        self.failUnless( PG_INDEXES[0][2] in self.statements )
+        self.failUnless( 'ALTER TABLE schembl_document_chemistry VALIDATE CONSTRAINT fk_docchem_to_doc' in self.statements )
+
+    def test_unsupported_dialect(self):
+        self.failUnlessRaises( ValueError, BulkLoadMode, create_engine('sqlite://'), self.state_file )
+
+
+if __name__ == '__main__':
+    unittest.main()
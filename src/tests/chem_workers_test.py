@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import logging
+import tempfile
+import unittest
+from sqlalchemy import create_engine, select
+
+from src.scripts.data_loader import DataLoader
+from src.scripts.chem_workers import ChemLoaderPool
+from src.scripts.id_cache import IdCache
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+class ChemLoaderPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        # Worker processes need a database they can all connect to
+        handle, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.db = create_engine('sqlite:///' + self.db_file, echo=False)
+
+        self.loader = DataLoader( self.db )
+        self.metadata = self.loader.db_metadata()
+        self.metadata.create_all(self.db)
+
+        self.loader.load_biblio('data/biblio_typical.json')
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def test_partitioned_file_matches_serial_load(self):
+        pool = ChemLoaderPool(self.loader, 3, chunksize=4, partition_bytes=2000)
+        self.failUnless( len(pool._partitions('data/chem_typical.tsv')) > 3 )
+
+        pool.submit('data/chem_typical.tsv', False)
+        pool.join()
+
+        serial_db = create_engine('sqlite:///:memory:', echo=False)
+        serial_loader = DataLoader( serial_db )
+        serial_loader.db_metadata().create_all(serial_db)
+        serial_loader.load_biblio('data/biblio_typical.json')
+        serial_loader.load_chems('data/chem_typical.tsv', False, chunksize=4)
+
+        for table_name in ('schembl_chemical', 'schembl_chemical_structure', 'schembl_document_chemistry'):
+            table = self.metadata.tables[table_name]
+            query = select( [table] ).order_by( *table.primary_key.columns )
+            self.failUnlessEqual( serial_db.execute(query).fetchall(), self.db.execute(query).fetchall() )
+
+    def test_async_writes(self):
+        self.loader.async_writes = True
+        self.test_partitioned_file_matches_serial_load()
+
+    def test_whole_files_in_parallel(self):
+        pool = ChemLoaderPool(self.loader, 2)
+        pool.submit('data/chem_typical.tsv', False)
+        pool.submit('data/chem_dup_mappings.tsv', False)
+        pool.submit('data/chem_single_row_alternative.tsv', True)
+        pool.join()
+
+        self.failUnlessEqual( 150, len(self.db.execute( select([self.metadata.tables['schembl_document_chemistry']]) ).fetchall()) )
+        self.failUnlessEqual( 20, len(self.db.execute( select([self.metadata.tables['schembl_chemical']]) ).fetchall()) )
+
+    def test_worker_ids_merged(self):
+        pool = ChemLoaderPool(self.loader, 2, chunksize=4, partition_bytes=2000)
+        pool.submit('data/chem_typical.tsv', False)
+        pool.join()
+
+        chem_table = self.metadata.tables['schembl_chemical']
+        chem_ids = set( row[0] for row in self.db.execute( select([chem_table.c.id]) ) )
+        self.failUnlessEqual( 19, len(chem_ids) )
+        self.failUnlessEqual( chem_ids, set(self.loader.existing_chemicals) )
+
+    def test_worker_ids_merged_from_id_cache(self):
+        self.loader.id_cache = IdCache(self.db_file + '.ids', self.db)
+        self.loader.id_cache.load(self.loader)
+        try:
+            self.test_worker_ids_merged()
+            self.failUnlessEqual( 25, len(self.loader.doc_id_map) )
+        finally:
+            self.loader.id_cache.discard()
+
+    def test_worker_failure_reported(self):
+        pool = ChemLoaderPool(self.loader, 2)
+        pool.submit('data/chem_wrong_columns.tsv', False)
+        self.assertRaises( RuntimeError, pool.join )
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import unittest
+
+from src.scripts.chunk_sizing import AdaptiveChunkSize, FixedChunkSize, chunk_sizer, estimate_bytes
+from src.scripts.data_loader import chunks
+from src.scripts.metrics import Metrics
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+class AdaptiveChunkSizeTests(unittest.TestCase):
+
+    def new_sizer(self, **kwargs):
+        self.metrics = Metrics()
+        limits = dict(initial=100, minimum=10, maximum=1600, max_seconds=10.0, max_bytes=1024 * 1024 * 1024)
+        limits.update(kwargs)
+        return AdaptiveChunkSize('test', metrics=self.metrics, **limits)
+
+    def run_chunks(self, sizer, seconds_for, count):
+        """Process a number of chunks, each taking seconds_for(size) seconds; returns the sizes used"""
+        sizes = []
+        for _ in xrange(count):
+            sizes.append(sizer.size)
+            sizer.record( [('x',)] * sizer.size, seconds_for(sizer.size) )
+        return sizes
+
+    def test_grows_while_throughput_improves(self):
+        # Fixed overhead of one second per chunk: bigger chunks are always faster, up to the maximum
+        sizer = self.new_sizer()
+        self.failUnlessEqual( [100, 200, 400, 800, 1600, 1600, 1600],
+                              self.run_chunks(sizer, lambda size: 1 + size * 0.001, 7) )
+        self.failUnlessEqual( 1600, self.gauge() )
+
+    def test_settles_on_best_size(self):
+        # Throughput peaks at 400 records per chunk
+        rates = {100: 100.0, 200: 150.0, 400: 200.0, 800: 190.0}
+        sizer = self.new_sizer()
+        self.failUnlessEqual( [100, 200, 400, 800, 400, 400, 400],
+                              self.run_chunks(sizer, lambda size: size / rates[size], 7) )
+
+    def test_reprobes_after_holding(self):
+        rates = {100: 100.0, 200: 90.0}
+        sizer = self.new_sizer(reprobe=3)
+        self.failUnlessEqual( [100, 200, 100, 100, 100, 200, 100, 100],
+                              self.run_chunks(sizer, lambda size: size / rates[size], 8) )
+
+    def test_shrinks_slow_chunks(self):
+        sizer = self.new_sizer(initial=800)
+        self.failUnlessEqual( [800, 400, 200, 200],
+                              self.run_chunks(sizer, lambda size: size * 0.03, 4) )
+        self.failUnlessEqual( 200, self.gauge() )
+
+    def test_memory_limit(self):
+        record_bytes = estimate_bytes([('x',)])
+        sizer = self.new_sizer(max_bytes=record_bytes * 300)
+        self.failUnlessEqual( [100, 200, 300, 300],
+                              self.run_chunks(sizer, lambda size: 1 + size * 0.001, 4) )
+
+    def test_short_chunks_ignored(self):
+        sizer = self.new_sizer()
+        sizer.record( [('x',)] * 5, 1.0 )
+        sizer.record( [], 0.0 )
+        self.failUnlessEqual( 100, sizer.size )
+
+    def test_limits_checked(self):
+        self.failUnlessRaises( ValueError, AdaptiveChunkSize, 'test', initial=10, minimum=100 )
+        self.failUnlessRaises( ValueError, FixedChunkSize, 0 )
+
+    def test_chunks(self):
+        self.failUnlessEqual( [(3, [0, 1, 2]), (6, [3, 4, 5]), (7, [6])], list(chunks(xrange(7), 3)) )
+
+        # The size is read before each chunk
+        sizer = FixedChunkSize(1)
+        results = []
+        for end, chunk in chunks(xrange(7), sizer):
+            results.append(chunk)
+            sizer.size += 1
+        self.failUnlessEqual( [[0], [1, 2], [3, 4, 5], [6]], results )
+
+        self.failUnless( chunk_sizer(sizer) is sizer )
+        self.failUnlessEqual( 5, chunk_sizer(5).size )
+
+    def test_estimate_bytes(self):
+        records = [{'title': 'x' * 1000, 'classes': ['A01', 'B02']}] * 100
+        estimate = estimate_bytes(records)
+        self.failUnless( 100000 < estimate < 200000 )
+        self.failUnlessEqual( 0, estimate_bytes([]) )
+
+    def gauge(self):
+        return [entry['value'] for entry in self.metrics.summary()['gauges'] if entry['name'] == 'chunk_size'][0]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+import unittest
+from sqlalchemy import create_engine, select
+
+from src.scripts import columnar
+from src.scripts.data_loader import DataLoader
+from src.scripts.chem_workers import ChemLoaderPool
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+CHEM_TABLES = ('schembl_chemical', 'schembl_chemical_structure')
+
+@unittest.skipIf(not columnar.available(), "pandas is not installed")
+class ColumnarLoadingTests(unittest.TestCase):
+    """Checks that columnar parsing of chemical files loads exactly what row by row parsing does"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def new_loader(self, db_file=None, **kwargs):
+        db = create_engine('sqlite:///' + (db_file or ':memory:'), echo=False)
+        loader = DataLoader(db, **kwargs)
+        loader.db_metadata().create_all(db)
+        loader.load_biblio('data/biblio_typical.json')
+        return loader
+
+    def load_both(self, chem_files, chunksize=7, **kwargs):
+        row_loader = self.new_loader(**kwargs)
+        col_loader = self.new_loader(columnar_chems=True, **kwargs)
+        for file_name, update in chem_files:
+            row_loader.load_chems(file_name, update, chunksize=chunksize)
+            col_loader.load_chems(file_name, update, chunksize=chunksize)
+        return row_loader, col_loader
+
+    def verify_same(self, expected_loader, actual_loader):
+        tables = [expected_loader.db_metadata().tables[table_name] for table_name in CHEM_TABLES]
+        for table in tables + [expected_loader.chem_mapping]:
+            query = select( [table] ).order_by( *table.primary_key.columns )
+            expected = expected_loader.db.execute(query).fetchall()
+            self.failUnless( len(expected) > 0 )
+            self.failUnlessEqual( expected, actual_loader.db.execute(query).fetchall() )
+
+    def test_matches_row_parsing(self):
+        self.verify_same( *self.load_both([('data/chem_typical.tsv', False)]) )
+
+    def test_matches_row_parsing_with_updates(self):
+        self.verify_same( *self.load_both([('data/chem_typical.tsv', False), ('data/chem_dup_mappings.tsv', False),
+                                           ('data/chem_single_row_alternative.tsv', True)], chunksize=3) )
+
+    def test_sparse_mappings(self):
+        self.verify_same( *self.load_both([('data/chem_typical.tsv', False), ('data/chem_single_row_alternative.tsv', True)],
+                                          sparse_mappings=True) )
+
+    def test_wide_mappings(self):
+        self.verify_same( *self.load_both([('data/chem_typical.tsv', False), ('data/chem_single_row_alternative.tsv', True)],
+                                          wide_mappings=True) )
+
+    def test_no_header(self):
+        self.verify_same( *self.load_both([('data/chem_single_row_nohdr.tsv', False)]) )
+
+    def test_gzipped_file(self):
+        gz_file = os.path.join(self.work_dir, 'chem_typical.tsv.gz')
+        with gzip.open(gz_file, 'wb') as f:
+            f.write( open('data/chem_typical.tsv', 'rb').read() )
+
+        row_loader = self.new_loader()
+        row_loader.load_chems('data/chem_typical.tsv', False)
+        col_loader = self.new_loader(columnar_chems=True)
+        col_loader.load_chems(gz_file, False)
+
+        self.verify_same(row_loader, col_loader)
+
+    def test_unknown_documents_skipped(self):
+        col_loader = self.new_loader(columnar_chems=True)
+        col_loader.doc_id_map = {'WO-2013127697-A1': 1}
+        col_loader.load_chems('data/chem_typical.tsv', False)
+
+        skipped = [entry for entry in col_loader.metrics.summary()['counters']
+                   if entry['name'] == 'chemical_rows_total' and entry['labels'] == {'status': 'skipped'}]
+        self.failUnlessEqual( 20, skipped[0]['value'] )
+
+    def test_partitioned_file(self):
+        db_file = os.path.join(self.work_dir, 'test.db')
+        col_loader = self.new_loader(db_file, columnar_chems=True)
+
+        pool = ChemLoaderPool(col_loader, 3, chunksize=4, partition_bytes=2000)
+        pool.submit('data/chem_typical.tsv', False)
+        pool.join()
+
+        row_loader = self.new_loader()
+        row_loader.load_chems('data/chem_typical.tsv', False)
+
+        self.verify_same(row_loader, col_loader)
+
+    def test_malformed_files(self):
+        for file_name, expected_msg in (('data/chem_bad_header.tsv', "Malformed header detected in chemical data file"),
+                                        ('data/chem_wrong_columns.tsv', "Incorrect number of columns detected in chemical data file")):
+            try:
+                self.new_loader(columnar_chems=True).load_chems(file_name, False)
+                self.fail("A runtime error should have been thrown")
+            except RuntimeError as e:
+                self.failUnlessEqual(expected_msg, e.message)
+
+    def test_extra_columns(self):
+        chem_file = os.path.join(self.work_dir, 'chem_extra_columns.tsv')
+        lines = open('data/chem_typical.tsv', 'rb').read().splitlines()
+        lines[5] += "\textra"
+        open(chem_file, 'wb').write( "\n".join(lines) + "\n" )
+
+        try:
+            self.new_loader(columnar_chems=True).load_chems(chem_file, False)
+            self.fail("A runtime error should have been thrown")
+        except RuntimeError as e:
+            self.failUnlessEqual("Incorrect number of columns detected in chemical data file", e.message)
+
+    def test_chunk_reader(self):
+        reader = columnar.ChunkReader(['ab', 'cde', '', 'f'])
+        self.failUnlessEqual( 'abc', reader.read(3) )
+        self.failUnlessEqual( 'de', reader.read(2) )
+        self.failUnlessEqual( 'f', reader.read() )
+        self.failUnlessEqual( '', reader.read(10) )
+
+
+if __name__ == '__main__':
+    unittest.main()
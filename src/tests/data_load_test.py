@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import io
+import os
+import gzip
+import json
+import codecs
+import shutil
 import logging
+import tempfile
 import unittest
 from datetime import date
-from sqlalchemy import create_engine, select, and_
+from sqlalchemy import create_engine, event, select, and_
 
-from src.scripts.data_loader import DataLoader, DocumentClass, DocumentField
+from mock import MagicMock
+
+from src.scripts import data_loader
+from src.scripts.chunk_sizing import AdaptiveChunkSize
+from src.scripts.mapping_pruner import prune_zero_mappings
+from src.scripts.data_loader import DataLoader, DocumentClass, DocumentField, DBBatcher, DirectPathBatcher, LobBatcher, CopyBatcher, MergeBatcher, iter_biblio, copy_text_row
 
 logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
 
@@ -48,6 +60,14 @@ class DataLoaderTests(unittest.TestCase):
         self.failUnlessEqual( 25, len( rows ) )
         self.check_doc_row( rows[0], (1,'WO-2013127697-A1',date(2013,9,6),0,47747634) )
 
+    def test_write_docs_duplicates_in_chunk(self):
+        self.load(['data/biblio_dup_in_file.json'])
+        rows = self.query_all(['schembl_document']).fetchall()
+        self.failUnlessEqual( 2, len( rows ) )
+        self.check_doc_row( rows[0], (1,'WO-2013127697-A1',date(2013,9,6),0,47747634) )
+        self.check_doc_row( rows[1], (2,'WO-2013127698-A1',date(2013,9,6),0,47748611) )
+        self.failUnlessEqual( 5, len( self.query_all(['schembl_document_title']).fetchall() ) )
+
     def test_unexpected_disallowed_duplicate(self):
         try:
             self.load(['data/biblio_single_row.json'])
@@ -58,6 +78,46 @@ class DataLoaderTests(unittest.TestCase):
                                  "insertion of an existing document, but duplicates have been disallowed", exc.message)
 
 
+    def test_disallowed_duplicate_in_id_map(self):
+        # Documents loaded earlier by the same loader are still duplicates, without an ID cache
+        loader = DataLoader( self.db, self.test_classifications, allow_doc_dups=False )
+        loader.load_biblio('data/biblio_single_row.json')
+        self.failUnlessRaises( RuntimeError, loader.load_biblio, 'data/biblio_typical.json' )
+    def test_duplicates_in_partitioned_documents(self):
+        # SCPNs are only unique within each partition of a partitioned document table, so aren't enforced on insert
+        db = create_engine('sqlite:///:memory:', echo=False)
+        loader = DataLoader( db, self.test_classifications )
+        metadata = loader.db_metadata()
+        metadata.create_all(db, tables=[table for table in metadata.sorted_tables if table is not loader.docs])
+        db.execute("create table schembl_document (id integer primary key, scpn varchar(50) not null, published date, "
+                   "life_sci_relevant smallint, assign_applic varchar(1000), family_id integer)")
+        loader.docs_partitioned = True
+
+        loader.load_biblio('data/biblio_single_row.json')
+        loader.load_biblio('data/biblio_typical.json')
+        self.failUnlessEqual( 25, db.execute("select count(*) from schembl_document").scalar() )
+        self.failUnlessEqual( 25, db.execute("select count(distinct scpn) from schembl_document").scalar() )
+
+        strict_loader = DataLoader( db, self.test_classifications, allow_doc_dups=False )
+        strict_loader.docs_partitioned = True
+        self.failUnlessRaises( RuntimeError, strict_loader.load_biblio, 'data/biblio_single_row.json' )
+
+        # The catalog isn't checked on other databases
+        self.failIf( DataLoader(db)._documents_partitioned(db.connect()) )
+
+    def test_streaming_biblio_parser(self):
+        # Tiny read sizes force records to be split across buffer refills
+        expected = json.load(codecs.open('data/biblio_typical.json', 'r', 'utf-8'))
+        for read_size in (1, 7, 100, 65536):
+            actual = list(iter_biblio(codecs.open('data/biblio_typical.json', 'r', 'utf-8'), read_size=read_size))
+            self.failUnlessEqual( expected, actual )
+
+    def test_streaming_biblio_parser_edge_cases(self):
+        self.failUnlessEqual( [], list(iter_biblio(io.StringIO(u" [ ] "))) )
+        self.failUnlessEqual( [{u"a":[u"]"]}], list(iter_biblio(io.StringIO(u'[{"a":["]"]}]'), read_size=2)) )
+        self.assertRaises( ValueError, list, iter_biblio(io.StringIO(u'{"a":1}')) )
+        self.assertRaises( ValueError, list, iter_biblio(io.StringIO(u'[{"a":1},{"b"')) )
+        self.assertRaises( ValueError, list, iter_biblio(io.StringIO(u'[{"a":1}')) )
 
     def test_sequence_definitions(self):
         mdata = self.loader.db_metadata()
@@ -174,6 +234,16 @@ class DataLoaderTests(unittest.TestCase):
         self.check_doc_row( rows[18], (19,'WO-2013189302-A1',date(2013,12,31),1,47474748) ) # This record is now life-sci-relevant
 
 
+    def test_replace_documents_duplicated_in_chunk(self):
+        updating_loader = DataLoader( self.db, self.test_classifications, overwrite=True )
+        updating_loader.load_biblio( 'data/biblio_dup_in_file.json' )
+        updating_loader.load_biblio( 'data/biblio_dup_in_file.json' )
+
+        rows = self.query_all(['schembl_document']).fetchall()
+        self.failUnlessEqual( 2, len( rows ) )
+        self.check_doc_row( rows[0], (1,'WO-2013127697-A1',date(2013,9,6),0,47747634) )
+        self.failUnlessEqual( 5, len( self.query_all(['schembl_document_title']).fetchall() ) )
+
     def test_replace_titles(self):
 
         # Covers deletion of obsolete titles, insertion of new titles, and modification of existing records
@@ -273,6 +343,69 @@ class DataLoaderTests(unittest.TestCase):
 
         self.verify_chem_mappings(expected_data)
 
+    def test_adaptive_chunks(self):
+        # Chunk sizes that change from chunk to chunk load the same data
+        sizer = AdaptiveChunkSize('test', initial=1, minimum=1, maximum=16, max_seconds=0.0)
+        self.load(['data/biblio_typical.json','data/chem_typical.tsv'], chunk_parm=sizer)
+
+        expected = self.query_all(['schembl_document_chemistry']).fetchall()
+        self.failUnlessEqual( 1, sizer.size )
+
+        sizer = AdaptiveChunkSize('test', initial=1, minimum=1, maximum=16, max_seconds=3600.0, tolerance=-1)
+        other_db = create_engine('sqlite:///:memory:', echo=False)
+        self.metadata.create_all(other_db)
+        self.load(['data/biblio_typical.json','data/chem_typical.tsv'], chunk_parm=sizer, loader=DataLoader(other_db, self.test_classifications))
+
+        self.failUnlessEqual( 16, sizer.size )
+        self.failUnlessEqual( expected, other_db.execute( select([self.metadata.tables['schembl_document_chemistry']]) ).fetchall() )
+        self.failUnlessEqual( 144, len(expected) )
+
+    def test_async_writes(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            async_db = create_engine('sqlite:///' + os.path.join(work_dir, 'test.db'), echo=False)
+            self.metadata.create_all(async_db)
+
+            files = ['data/biblio_typical.json', 'data/chem_typical.tsv']
+            self.load(files)
+            self.load(files, loader=DataLoader(async_db, self.test_classifications, async_writes=True))
+
+            # Overwriting, with titles and classes from earlier chunks written first
+            self.load(['data/biblio_typical_update.json'], loader=DataLoader(self.db, self.test_classifications, overwrite=True))
+            self.load(['data/biblio_typical_update.json'], loader=DataLoader(async_db, self.test_classifications, overwrite=True, async_writes=True))
+
+            for table in self.metadata.sorted_tables:
+                query = select( [table] ).order_by( *table.primary_key.columns )
+                self.failUnlessEqual( self.db.execute(query).fetchall(), async_db.execute(query).fetchall() )
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_async_writes_need_second_connection(self):
+        self.failUnlessRaises( ValueError, DataLoader, self.db, async_writes=True )
+
+    def test_connection_reused(self):
+        checkouts = []
+        event.listen(self.db, 'checkout', lambda dbapi_conn, record, proxy: checkouts.append(dbapi_conn))
+
+        self.load(['data/biblio_typical.json', 'data/chem_typical.tsv', 'data/biblio_typical_update.json', 'data/chem_typical_update.tsv'])
+        self.failUnlessEqual( 1, len(checkouts) )
+
+        batchers = dict(self.loader.batchers)
+        self.failUnlessEqual( set(['title_insert', 'class_insert', 'chemical_insert', 'structure_insert', 'mapping_insert', 'mapping_delete']), set(batchers) )
+
+        # The same batchers (and cursors) are used for every file
+        self.load(['data/chem_dup_mappings.tsv'])
+        self.failUnless( all(self.loader.batchers[name] is batcher for name, batcher in batchers.items()) )
+
+        self.loader.close()
+        self.failUnlessEqual( {}, self.loader.batchers )
+        self.failUnless( self.loader.sql_alc_conn is None )
+
+        # Reopened on demand
+        self.load(['data/chem_single_row_alternative.tsv'])
+        self.failUnlessEqual( 2, len(checkouts) )
+        self.failIf( self.loader.batchers['chemical_insert'] is batchers['chemical_insert'] )
+
     def test_malformed_files(self):
         self.expect_runtime_error('data/chem_bad_header.tsv', "Malformed header detected in chemical data file")
         self.expect_runtime_error('data/chem_wrong_columns.tsv', "Incorrect number of columns detected in chemical data file")
@@ -290,8 +423,11 @@ class DataLoaderTests(unittest.TestCase):
         self.verify_chem_mappings(expected_data)
 
     def test_replacement_mappings(self):
-        
-        updating_loader = self.prepare_updatable_db(True)
+        self.verify_replacement_mappings()
+
+    def verify_replacement_mappings(self, wide=False):
+
+        updating_loader = self.prepare_updatable_db(True, wide=wide)
 
         self.load(['data/biblio_typical_update.json','data/chem_typical_update.tsv'], loader=updating_loader)        
         self.verify_chem_mappings([ (1,48,36,35,34,33,32,31),                       # New
@@ -306,8 +442,16 @@ class DataLoaderTests(unittest.TestCase):
                 u"USMLMJGLDDOVEI-PLYBKPSTSA-N") } )
 
     def test_update_mappings(self):
+        self.verify_update_mappings(True)
+
+    def test_update_mappings_without_merge(self):
+        # Delete and re-insert each mapping, for databases that don't support MERGE / ON CONFLICT DO UPDATE
+        self.verify_update_mappings(False)
+
+    def verify_update_mappings(self, merge, wide=False):
         
-        updating_loader = self.prepare_updatable_db(False)
+        updating_loader = self.prepare_updatable_db(False, wide=wide)
+        updating_loader.merge_mappings = merge
 
         self.load(['data/biblio_typical_update.json','data/chem_typical_update.tsv'], preload_docs=True, update_mappings=True, loader=updating_loader)        
         self.verify_chem_mappings([ (1,48,36,35,34,33,32,31),                       # New 
@@ -324,13 +468,188 @@ class DataLoaderTests(unittest.TestCase):
                 u"USMLMJGLDDOVEI-PLYBKPSTSA-N") } )
 
 
-    def prepare_updatable_db(self, overwrite_mode):
-        updating_loader = DataLoader( self.db, self.test_classifications, overwrite=overwrite_mode )
+    def prepare_updatable_db(self, overwrite_mode, sparse=False, wide=False):
+        if wide:
+            self.use_wide_mappings()
+        updating_loader = DataLoader( self.db, self.test_classifications, overwrite=overwrite_mode, sparse_mappings=sparse, wide_mappings=wide )
         self.load(['data/biblio_typical.json','data/chem_typical.tsv'], loader=updating_loader)
-        self.verify_chem_mappings([ (1,9724,0,0,0,1,0,0), (1,23780,0,0,0,11,0,0),(1,23781,0,0,0,11,0,0),(1,25640,0,0,2,4,0,0) ], doc=1)
+        self.verify_chem_mappings([ (1,9724,0,0,0,1,0,0), (1,23780,0,0,0,11,0,0),(1,23781,0,0,0,11,0,0),(1,25640,0,0,2,4,0,0) ], doc=1, sparse=sparse)
 
         return updating_loader
 
+    ###### Sparse mappings ######
+
+    def test_sparse_mappings(self):
+        self.prepare_updatable_db(False, sparse=True)
+        self.failUnlessEqual( 0, self.count_zero_mappings() )
+        self.failUnlessEqual( 37, len(self.query_all(['schembl_document_chemistry']).fetchall()) )
+
+    def test_sparse_update_mappings(self):
+        self.verify_sparse_update_mappings(True)
+
+    def test_sparse_update_mappings_without_merge(self):
+        self.verify_sparse_update_mappings(False)
+
+    def verify_sparse_update_mappings(self, merge):
+        updating_loader = self.prepare_updatable_db(False, sparse=True)
+        updating_loader.merge_mappings = merge
+
+        # Claims count for 25640 drops to zero, and its other counts change
+        work_dir = tempfile.mkdtemp()
+        try:
+            supp_file = os.path.join(work_dir, 'chem_supp.tsv')
+            row = [line for line in open('data/chem_typical.tsv', 'rb').read().splitlines() if '\t25640\t' in line][0].split('\t')
+            row[15:21] = ['1', '0', '0', '7', '0', '0']
+            open(supp_file, 'wb').write( '\t'.join(row) + '\n' )
+
+            self.load([supp_file], update_mappings=True, loader=updating_loader)
+        finally:
+            shutil.rmtree(work_dir)
+
+        self.verify_chem_mappings([ (1,9724,0,0,0,1,0,0), (1,23780,0,0,0,11,0,0),(1,23781,0,0,0,11,0,0),(1,25640,1,0,0,7,0,0) ], doc=1, sparse=True)
+        self.failUnlessEqual( 0, self.count_zero_mappings() )
+
+    def test_prune_zero_mappings(self):
+        self.prepare_updatable_db(False)
+        zero_count = self.count_zero_mappings()
+        self.failUnless( zero_count > 0 )
+
+        self.failUnlessEqual( zero_count, prune_zero_mappings(self.db, batch_docs=3) )
+        self.failUnlessEqual( 0, self.count_zero_mappings() )
+        self.verify_chem_mappings([ (1,9724,0,0,0,1,0,0), (1,23780,0,0,0,11,0,0),(1,23781,0,0,0,11,0,0),(1,25640,0,0,2,4,0,0) ], doc=1, sparse=True)
+        self.failUnlessEqual( 37, len(self.query_all(['schembl_document_chemistry']).fetchall()) )
+
+        # Pruning again finds nothing; an empty database is fine too
+        self.failUnlessEqual( 0, prune_zero_mappings(self.db, start_id=2, end_id=5) )
+        empty_db = create_engine('sqlite:///:memory:', echo=False)
+        self.metadata.create_all(empty_db)
+        self.failUnlessEqual( 0, prune_zero_mappings(empty_db) )
+
+    ###### Wide mappings ######
+
+    def use_wide_mappings(self):
+        """
+        Switch to a new database with the wide mapping table. The test metadata is kept, so that queries of
+        schembl_document_chemistry read the compatibility view.
+        """
+        self.db = create_engine('sqlite:///:memory:', echo=False)
+        self.loader = DataLoader( self.db, self.test_classifications, wide_mappings=True )
+        self.loader.db_metadata().create_all(self.db)
+
+    def test_wide_mappings(self):
+        # The view presents exactly the non-zero mappings that the narrow table holds, from a sixth of the rows
+        self.load(['data/biblio_typical.json','data/chem_typical.tsv','data/chem_dup_mappings.tsv'])
+        narrow_rows = self.query_mappings()
+
+        self.use_wide_mappings()
+        self.load(['data/biblio_typical.json','data/chem_typical.tsv','data/chem_dup_mappings.tsv'])
+        view_rows = self.query_mappings()
+        self.failUnlessEqual( [row for row in narrow_rows if row['frequency'] > 0], view_rows )
+        self.failUnless( len(view_rows) < len(narrow_rows) )
+
+        wide_rows = self.db.execute( select([self.loader.chem_mapping]) ).fetchall()
+        self.failUnlessEqual( len(narrow_rows) / 6, len(wide_rows) )
+
+    def test_wide_replacement_mappings(self):
+        self.verify_replacement_mappings(wide=True)
+
+    def test_wide_update_mappings(self):
+        self.verify_update_mappings(True, wide=True)
+
+    def test_wide_update_mappings_without_merge(self):
+        self.verify_update_mappings(False, wide=True)
+
+    def test_wide_update_mappings_after_narrow(self):
+        # A database migrated to wide mappings keeps the narrow merge staging table (in-memory SQLite reuses the
+        # connection, and so its temporary tables, as Oracle keeps global temporary tables)
+        self.verify_update_mappings(True)
+
+        wide_loader = DataLoader( self.db, self.test_classifications, wide_mappings=True )
+        self.loader.chem_mapping.drop(self.db)
+        wide_loader.chem_mapping.create(self.db)
+
+        self.load(['data/biblio_typical_update.json','data/chem_typical_update.tsv'], preload_docs=True, update_mappings=True, loader=wide_loader)
+        self.verify_chem_mappings([ (1,48,36,35,34,33,32,31),
+                                    (1,23780,901,902,903,904,905,906),
+                                    (1,10101010101,41,42,43,44,45,46) ], doc=1)
+
+    def test_wide_sparse_update_mappings(self):
+        for merge in (True, False):
+            updating_loader = self.prepare_updatable_db(False, sparse=True, wide=True)
+            updating_loader.merge_mappings = merge
+            self.failUnlessEqual( 0, self.count_zero_wide_mappings() )
+
+            # All counts for 25640 drop to zero, so its row is deleted
+            work_dir = tempfile.mkdtemp()
+            try:
+                supp_file = os.path.join(work_dir, 'chem_supp.tsv')
+                row = [line for line in open('data/chem_typical.tsv', 'rb').read().splitlines() if '\t25640\t' in line][0].split('\t')
+                row[15:21] = ['0'] * 6
+                open(supp_file, 'wb').write( '\t'.join(row) + '\n' )
+
+                self.load([supp_file], update_mappings=True, loader=updating_loader)
+            finally:
+                shutil.rmtree(work_dir)
+
+            self.verify_chem_mappings([ (1,9724,0,0,0,1,0,0), (1,23780,0,0,0,11,0,0),(1,23781,0,0,0,11,0,0) ], doc=1)
+            self.failUnlessEqual( 0, self.count_zero_wide_mappings() )
+
+    def test_prune_zero_wide_mappings(self):
+        self.prepare_updatable_db(False, wide=True)
+        self.db.execute( "update schembl_document_chemistry_wide set title_count = 0, abstract_count = 0, claims_count = 0, "
+                         "description_count = 0, image_count = 0, attachment_count = 0 where schembl_chem_id = 25640" )
+        zero_count = self.count_zero_wide_mappings()
+        self.failUnless( zero_count > 0 )
+
+        self.failUnlessEqual( zero_count, prune_zero_mappings(self.db, batch_docs=3, wide=True) )
+        self.failUnlessEqual( 0, self.count_zero_wide_mappings() )
+        self.verify_chem_mappings([ (1,9724,0,0,0,1,0,0), (1,23780,0,0,0,11,0,0),(1,23781,0,0,0,11,0,0) ], doc=1)
+
+    def query_mappings(self):
+        mapping_table = self.metadata.tables['schembl_document_chemistry']
+        return self.db.execute( select([mapping_table]).order_by(*mapping_table.primary_key.columns) ).fetchall()
+
+    def count_zero_wide_mappings(self):
+        mapping_table = self.loader.chem_mapping
+        counts = [mapping_table.c[column] for column in mapping_table.c.keys()[2:]]
+        return len( self.db.execute( select([mapping_table]).where(and_(*[count == 0 for count in counts])) ).fetchall() )
+
+    def count_zero_mappings(self):
+        mapping_table = self.metadata.tables['schembl_document_chemistry']
+        return len( self.db.execute( select([mapping_table]).where(mapping_table.c.frequency == 0) ).fetchall() )
+
+
+
+    ###### Compressed input files ######
+
+    def test_gzipped_files(self):
+        self.verify_gzipped_load(None)
+
+    def test_gzipped_files_pipe(self):
+        # gzip shares pigz's command line interface for decompression
+        self.verify_gzipped_load('gzip')
+
+    def verify_gzipped_load(self, pigz_path):
+        tmp_dir = tempfile.mkdtemp()
+        orig_pigz = data_loader.PIGZ_PATH
+        try:
+            data_loader.PIGZ_PATH = pigz_path
+            gz_files = []
+            for file_name in ('data/biblio_typical.json', 'data/chem_typical.tsv'):
+                gz_file = os.path.join(tmp_dir, os.path.basename(file_name) + '.gz')
+                with gzip.open(gz_file, 'wb') as f:
+                    f.write(open(file_name, 'rb').read())
+                gz_files.append(gz_file)
+
+            self.load(gz_files)
+        finally:
+            data_loader.PIGZ_PATH = orig_pigz
+            shutil.rmtree(tmp_dir, True)
+
+        self.failUnlessEqual( 25, len(self.query_all(['schembl_document']).fetchall()) )
+        self.failUnlessEqual( 62, len(self.query_all(['schembl_document_title']).fetchall()) )
+        self.failUnlessEqual( 19, len(self.query_all(['schembl_chemical']).fetchall()) )
+        self.failUnlessEqual( 144, len(self.query_all(['schembl_document_chemistry']).fetchall()) )
 
 
     ###### Various edge cases / bugs ######
@@ -445,14 +764,19 @@ class DataLoaderTests(unittest.TestCase):
             self.check_chem_row(   row, (found_key,) + expected_chems[found_key][0:9] )
             self.check_struct_row( row, (found_key,) + expected_chems[found_key][9:] )
 
-    def verify_chem_mappings(self, expected_mappings, doc=None):
+    def verify_chem_mappings(self, expected_mappings, doc=None, sparse=False):
 
         doc_fields = (DocumentField.TITLE,       DocumentField.ABSTRACT, DocumentField.CLAIMS,
                       DocumentField.DESCRIPTION, DocumentField.IMAGES, DocumentField.ATTACHMENTS)
 
+        # The wide mapping view leaves out counts of zero, as sparse mappings do
+        sparse = sparse or self.loader.wide_mappings
+
         exp_data = dict()
         for expected in expected_mappings:
             for doc_field, exp_freq in zip(doc_fields, expected[2:]):
+                if sparse and exp_freq == 0:
+                    continue
                 exp_data[ (expected[0], expected[1], doc_field) ] = exp_freq
 
         if doc == None:
@@ -476,6 +800,227 @@ class DataLoaderTests(unittest.TestCase):
             self.failUnlessEqual(expected_msg, e.message)
             pass
 
+class DBBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = create_engine('sqlite:///:memory:', echo=False).raw_connection()
+        self.conn.cursor().execute("create table test_table (id integer primary key, val integer)")
+        self.conn.cursor().execute("insert into test_table values (3, 33)")
+        self.conn.commit()
+
+    def test_integrity_errors_bisected(self):
+        batcher = DBBatcher(self.conn, "insert into test_table (id, val) values (?, ?)")
+        batcher.cursor = MagicMock(wraps=batcher.cursor)
+
+        batcher.execute( [(i, i) for i in xrange(1, 17)] )
+
+        rows = self.conn.cursor().execute("select id, val from test_table order by id").fetchall()
+        self.failUnlessEqual( [(i, 33 if i == 3 else i) for i in xrange(1, 17)], rows )
+
+        # One bad record in 16 is isolated with a handful of batches, rather than 16 single inserts
+        self.failUnlessEqual( 9, batcher.cursor.executemany.call_count )
+        self.failUnlessEqual( 1, batcher.cursor.execute.call_count )
+
+    def test_non_integrity_errors_raised(self):
+        batcher = DBBatcher(self.conn, "insert into missing_table (id, val) values (?, ?)")
+        self.assertRaises( Exception, batcher.execute, [(1, 1)] )
+
+    def test_oracle_batch_errors(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.getbatcherrors.return_value = [ MagicMock(code=1, offset=1, message="ORA-00001: unique constraint violated") ]
+
+        batcher = DBBatcher(conn, "insert into test_table (id, val) values (:1, :2)", batch_errors=True)
+        batcher.execute( [(1, 1), (3, 3), (4, 4)] )
+
+        cursor.executemany.assert_called_once_with( "insert into test_table (id, val) values (:1, :2)", [(1, 1), (3, 3), (4, 4)], batcherrors=True )
+        self.failUnlessEqual( 1, conn.commit.call_count )
+        self.failIf( conn.rollback.called )
+
+    def test_oracle_batch_errors_non_integrity(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.getbatcherrors.return_value = [ MagicMock(code=12899, offset=0, message="ORA-12899: value too large") ]
+
+        batcher = DBBatcher(conn, "insert into test_table (id, val) values (:1, :2)", batch_errors=True)
+        self.assertRaises( RuntimeError, batcher.execute, [(1, 1)] )
+        self.failUnless( conn.rollback.called )
+        self.failIf( conn.commit.called )
+
+    def test_direct_path(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+
+        batcher = DirectPathBatcher(conn, "insert into test_table (id, val) values (:1, :2)")
+        batcher.execute( [(1, 1), (2, 2)] )
+
+        # Committed straight away, with no batch errors (which direct path doesn't report)
+        cursor.executemany.assert_called_once_with( "insert /*+ APPEND_VALUES */ into test_table (id, val) values (:1, :2)", [(1, 1), (2, 2)] )
+        self.failUnlessEqual( 1, conn.commit.call_count )
+
+        self.assertRaises( ValueError, DirectPathBatcher, conn, "delete from test_table where id = :1" )
+
+    def test_direct_path_integrity_errors(self):
+        batcher = DirectPathBatcher(self.conn, "insert into test_table (id, val) values (?, ?)")
+        batcher.cursor = MagicMock(wraps=batcher.cursor)
+
+        batcher.execute( [(i, i) for i in xrange(1, 9)] )
+
+        rows = self.conn.cursor().execute("select id, val from test_table order by id").fetchall()
+        self.failUnlessEqual( [(i, 33 if i == 3 else i) for i in xrange(1, 9)], rows )
+
+        # Only the first attempt is by direct path
+        operations = [call[0][0] for call in batcher.cursor.executemany.call_args_list + batcher.cursor.execute.call_args_list]
+        self.failUnless( 'APPEND_VALUES' in operations[0] )
+        self.failIf( any('APPEND_VALUES' in operation for operation in operations[1:]) )
+
+    def test_direct_path_loader(self):
+        db = MagicMock()
+        db.dialect.name = 'oracle'
+        db.dialect.paramstyle = 'named'
+        batcher = DataLoader(db, direct_path=True)._insert_batcher(MagicMock(), 'schembl_chemical', ('id', 'mol_weight'), 'chemical_insert')
+        self.failUnless( isinstance(batcher, DirectPathBatcher) )
+        self.failUnlessEqual( "insert /*+ APPEND_VALUES */ into schembl_chemical (id, mol_weight) values (:1, :2)", batcher.operation )
+
+        self.assertRaises( ValueError, DataLoader, create_engine('sqlite://'), direct_path=True )
+
+    def test_lob_binds_for_oversized_values(self):
+        string_batcher = MagicMock()
+        lob_batcher = MagicMock()
+        batcher = LobBatcher(string_batcher, lob_batcher, (1, 2), limit=20)
+
+        # Multi-byte characters count towards the limit in bytes
+        records = [(1, "C" * 20, None, "KEY1"),
+                   (2, "CC", "C" * 21, "KEY2"),
+                   (3, u"É" * 10, None, "KEY3"),
+                   (4, u"É" * 11, "CO", "KEY4")]
+        batcher.execute(records)
+
+        string_batcher.execute.assert_called_once_with( [records[0], records[2]] )
+        lob_batcher.execute.assert_called_once_with( [records[1], (4, (u"É" * 11).encode('utf-8'), "CO", "KEY4")] )
+        self.failUnlessEqual( 2, batcher.metrics.summary()['counters'][0]['value'] )
+
+        # Batches without oversized values don't use LOB binds
+        lob_batcher.reset_mock()
+        batcher.execute( [(5, "C", "C", "KEY5")] )
+        self.failIf( lob_batcher.execute.called )
+
+    def test_direct_path_retry_input_sizes(self):
+
+        class IntegrityError(Exception):
+            pass
+
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.executemany.side_effect = [IntegrityError("ORA-00001"), None, None, None]
+
+        batcher = DirectPathBatcher(conn, "insert into test_table (id, val) values (:1, :2)", types=(None, 'CLOB'))
+        batcher.execute( [(1, "C"), (2, "CC")] )
+        batcher.execute( [(3, "CCC")] )
+
+        # Input sizes are set again whenever the statement changes, so LOB values keep their binds
+        calls = [(name, args[0]) for name, args, _ in cursor.method_calls if name in ('setinputsizes', 'executemany')]
+        direct = "insert /*+ APPEND_VALUES */ into test_table (id, val) values (:1, :2)"
+        conventional = "insert into test_table (id, val) values (:1, :2)"
+        self.failUnlessEqual( [('setinputsizes', None), ('setinputsizes', None), ('executemany', direct),
+                               ('setinputsizes', None), ('executemany', conventional),
+                               ('setinputsizes', None), ('executemany', conventional),
+                               ('setinputsizes', None), ('executemany', direct)], calls )
+        for name, args, _ in cursor.method_calls:
+            if name == 'setinputsizes':
+                self.failUnlessEqual( (None, 'CLOB'), args )
+
+    def test_lob_batcher_loader(self):
+        db = MagicMock()
+        db.dialect.name = 'oracle'
+        db.dialect.paramstyle = 'named'
+        loader = DataLoader(db)
+        conn = MagicMock()
+        self.failUnless( isinstance(loader._lob_insert_batcher(conn, 'schembl_document_title', ('schembl_doc_id', 'lang', 'text'), 'title_insert', (2,)), DBBatcher) )
+
+        loader.lob_type = 'CLOB'
+        batcher = loader._lob_insert_batcher(conn, 'schembl_document_title', ('schembl_doc_id', 'lang', 'text'), 'title_insert', (2,))
+        self.failUnless( isinstance(batcher, LobBatcher) )
+
+        # Only the LOB batcher's cursor has input sizes
+        conn.cursor.return_value.setinputsizes.assert_called_once_with( None, None, 'CLOB' )
+
+
+class CopyBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value
+        self.copied = []
+        self.cursor.copy_expert.side_effect = lambda sql, buf: self.copied.append( (sql, buf.read()) )
+
+    def test_copy_text_format(self):
+        self.failUnlessEqual( u"1\t2.5\t\\N\ta\\tb\\nc\\\\d\n", copy_text_row( (1, 2.5, None, u"a\tb\nc\\d") ) )
+        self.failUnlessEqual( u"ÉLÉ\t10101010101\n", copy_text_row( (u"ÉLÉ", 10101010101L) ) )
+
+    def test_copy_with_staging(self):
+        batcher = CopyBatcher(self.conn, 'schembl_document_class', ('schembl_doc_id', 'class', 'system'))
+        self.cursor.execute.assert_called_with( "create temporary table if not exists schembl_document_class_staging "\
+                                                "(like schembl_document_class including defaults) on commit delete rows" )
+
+        self.cursor.rowcount = 1
+        batcher.execute( [(1, u"B29C", 1), (1, u"B29C", 1)] )
+
+        self.failUnlessEqual( [("copy schembl_document_class_staging (schembl_doc_id, class, system) from stdin",
+                                "1\tB29C\t1\n1\tB29C\t1\n")], self.copied )
+        self.cursor.execute.assert_called_with( "insert into schembl_document_class (schembl_doc_id, class, system) "\
+                                                "select schembl_doc_id, class, system from schembl_document_class_staging on conflict do nothing" )
+        self.failUnlessEqual( 2, self.conn.commit.call_count )
+
+    def test_copy_direct(self):
+        batcher = CopyBatcher(self.conn, 'schembl_chemical_structure', ('schembl_chem_id', 'smiles'), staging=False)
+        batcher.execute( [] )
+        batcher.execute( [(48, u"OC1=CC=CC=C1")] )
+
+        self.failUnlessEqual( [("copy schembl_chemical_structure (schembl_chem_id, smiles) from stdin", "48\tOC1=CC=CC=C1\n")], self.copied )
+        self.failIf( self.cursor.execute.called )
+        self.failUnlessEqual( 1, self.conn.commit.call_count )
+
+    def test_copy_requires_postgres(self):
+        self.assertRaises( ValueError, DataLoader, create_engine('sqlite:///:memory:'), pg_copy=True )
+
+
+class MergeBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = create_engine('sqlite:///:memory:', echo=False).raw_connection()
+        self.conn.cursor().execute("create table test_table (id integer, field integer, val integer, primary key (id, field))")
+        self.conn.cursor().execute("insert into test_table values (1, 1, 11)")
+        self.conn.cursor().execute("insert into test_table values (2, 1, 21)")
+        self.conn.commit()
+
+    def test_merge(self):
+        batcher = MergeBatcher(self.conn, 'sqlite', 'test_table', ('id', 'field'), ('val',), 'test_staging', 'qmark')
+
+        batcher.execute( [(1, 1, 100), (3, 1, 300), (3, 1, 999)] )
+        batcher.execute( [(3, 2, 320)] )
+
+        rows = self.conn.cursor().execute("select id, field, val from test_table order by id, field").fetchall()
+        self.failUnlessEqual( [(1, 1, 100), (2, 1, 21), (3, 1, 300), (3, 2, 320)], rows )
+        self.failUnlessEqual( [], self.conn.cursor().execute("select * from test_staging").fetchall() )
+        self.failUnlessEqual( 1, batcher.metrics.summary()['counters'][0]['value'] )
+
+    def test_oracle_merge(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.fetchone.return_value = (0,)
+
+        batcher = MergeBatcher(conn, 'oracle', 'test_table', ('id', 'field'), ('val',), 'test_staging', 'numeric')
+        cursor.execute.assert_called_with( "create global temporary table test_staging on commit delete rows as select * from test_table where 1 = 0" )
+
+        batcher.execute( [(1, 1, 100)] )
+        cursor.executemany.assert_called_once_with( "insert into test_staging (id, field, val) values (:1, :2, :3)", [(1, 1, 100)] )
+        cursor.execute.assert_called_with( "merge into test_table t using test_staging s on (t.id = s.id and t.field = s.field) "\
+                                           "when matched then update set t.val = s.val "\
+                                           "when not matched then insert (id, field, val) values (s.id, s.field, s.val)" )
+        self.failUnlessEqual( 1, conn.commit.call_count )
+
+
 def main():
     unittest.main()
 
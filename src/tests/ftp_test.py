@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import os
 import logging
 import unittest
 import shutil
+import tempfile
+import threading
 import datetime
 import ftplib
 
@@ -12,6 +15,13 @@ from mock import call
 
 from src.scripts.new_file_reader import NewFileReader
 
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPServer = None
+
 logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.DEBUG)
 
 chunked_file_list = ['''\
@@ -45,6 +55,8 @@ class FTPTests(unittest.TestCase):
         self.ftp.cwd        = MagicMock(return_value=None)
         self.ftp.retrbinary = MagicMock(return_value=None)
         self.ftp.nlst       = MagicMock(return_value=[])
+        self.ftp.voidcmd    = MagicMock(return_value=None)
+        self.ftp.size       = MagicMock(return_value=len("".join(chunked_file_list)))
 
         prep_chunks(chunked_file_list)
         self.ftp.retrbinary.side_effect = chunk_writer
@@ -130,6 +142,21 @@ class FTPTests(unittest.TestCase):
         self.verify_dl_content("/tmp/schembl_ftp_test/bib.dat",  file_content)
         self.verify_dl_content("/tmp/schembl_ftp_test/chem.dat", file_content)
 
+    def test_read_files_size_mismatch(self):
+        self.ftp.size.return_value = 1000
+        self.assertRaises( IOError, self.reader.read_files, ['/path/one/bib.dat'], '/tmp/schembl_ftp_test', attempts=2, retry_secs=0 )
+        self.failUnlessEqual( 2, self.ftp.retrbinary.call_count )
+
+    def test_read_files_retry(self):
+        self.ftp.retrbinary.side_effect = [ftplib.error_temp("421 Timeout"), None, None]
+        self.ftp.size.side_effect = ftplib.error_perm("550 SIZE not allowed in ASCII mode")
+        self.reader.read_files( ['/path/one/bib.dat','/path/two/chem.dat'], '/tmp/schembl_ftp_test', attempts=2, retry_secs=0 )
+        calls = [call("RETR bib.dat", ANY),call("RETR bib.dat", ANY),call("RETR chem.dat", ANY)]
+        self.ftp.retrbinary.assert_has_calls(calls, any_order=False)
+
+    def test_concurrent_needs_factory(self):
+        self.assertRaises( ValueError, self.reader.read_files, ['/path/one/bib.dat'], '/tmp/schembl_ftp_test', workers=2 )
+
     def verify_dl_content(self, file_path, expected):
         content = open(file_path).read()
         self.failUnlessEqual(content, expected)
@@ -175,6 +202,79 @@ class FTPTests(unittest.TestCase):
 
 
 
+@unittest.skipIf(FTPServer is None, "pyftpdlib is not installed")
+class FTPDownloadTests(unittest.TestCase):
+    """Download tests against a local FTP server"""
+
+    def setUp(self):
+        self.server_dir = tempfile.mkdtemp()
+        self.target_dir = tempfile.mkdtemp()
+        os.makedirs( os.path.join(self.server_dir, "data", "2013") )
+
+        self.files = {}
+        for i in xrange(6):
+            name = "file{}.chemicals.tsv.gz".format(i)
+            self.files[name] = os.urandom(100000 + i)
+            with open(os.path.join(self.server_dir, "data", "2013", name), 'wb') as f:
+                f.write(self.files[name])
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("user", "pass", self.server_dir)
+        class TestFTPHandler(FTPHandler):
+            pass
+        TestFTPHandler.authorizer = authorizer
+
+        self.server = FTPServer(("127.0.0.1", 0), TestFTPHandler)
+        self.port = self.server.socket.getsockname()[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, kwargs={'timeout': 0.1})
+        self.server_thread.start()
+
+        self.connections = []
+        self.reader = NewFileReader(self.connect(), self.connect)
+
+    def tearDown(self):
+        self.server.close_all()
+        self.server_thread.join()
+        shutil.rmtree(self.server_dir, True)
+        shutil.rmtree(self.target_dir, True)
+
+    def connect(self):
+        ftp = ftplib.FTP()
+        ftp.connect("127.0.0.1", self.port)
+        ftp.login("user", "pass")
+        self.connections.append(ftp)
+        return ftp
+
+    def test_concurrent_download(self):
+        self.reader.read_files( ["/data/2013/" + name for name in sorted(self.files)], self.target_dir, workers=3 )
+
+        self.failUnlessEqual( sorted(self.files), sorted(os.listdir(self.target_dir)) )
+        for name, content in self.files.items():
+            self.failUnlessEqual( content, open(os.path.join(self.target_dir, name), 'rb').read() )
+
+        # One session for the reader, plus one per worker
+        self.failUnlessEqual( 4, len(self.connections) )
+
+    def test_resume_partial_download(self):
+        name = "file3.chemicals.tsv.gz"
+        with open(os.path.join(self.target_dir, name), 'wb') as f:
+            f.write(self.files[name][:5000])
+
+        self.reader.ftp.retrbinary = MagicMock(wraps=self.reader.ftp.retrbinary)
+        self.reader.read_files( ["/data/2013/" + name], self.target_dir )
+
+        self.reader.ftp.retrbinary.assert_called_with( "RETR " + name, ANY, rest=5000 )
+        self.failUnlessEqual( self.files[name], open(os.path.join(self.target_dir, name), 'rb').read() )
+
+    def test_missing_file_reported(self):
+        try:
+            self.reader.read_files( ["/data/2013/file0.chemicals.tsv.gz", "/data/2013/missing.tsv.gz"],
+                                    self.target_dir, workers=2, attempts=2, retry_secs=0 )
+            self.fail("Exception expected")
+        except RuntimeError, e:
+            self.assertEqual( "Failed to download 1 files: /data/2013/missing.tsv.gz", e.message )
+
+
 def main():
     unittest.main()
 
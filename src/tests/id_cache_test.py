@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+
+from src.scripts.data_loader import DataLoader
+from src.scripts.id_cache import IdCache
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+class IdCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.work_dir, 'schembl_id_cache')
+
+        self.db = create_engine('sqlite:///' + os.path.join(self.work_dir, 'test.db'), echo=False)
+        self.loader = self._new_loader()
+        self.loader.db_metadata().create_all(self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _new_loader(self):
+        loader = DataLoader( self.db )
+        loader.id_cache = IdCache(self.cache_path, self.db)
+        return loader
+
+    def test_empty_cache_created(self):
+        self.failIf( self.loader.id_cache.load(self.loader) )
+        self.failUnless( os.path.exists(self.cache_path) )
+
+    def test_ids_cached_between_runs(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+        self.loader.load_chems('data/chem_typical.tsv', False)
+
+        # New IDs are journalled as they're committed
+        self.failUnless( os.path.getsize(self.cache_path + '.docs.journal') > 0 )
+        self.failUnless( os.path.getsize(self.cache_path + '.chems.journal') > 0 )
+
+        self.loader.id_cache.save(self.loader)
+        self.failIf( os.path.exists(self.cache_path + '.docs.journal') )
+
+        loader = self._new_loader()
+        self.failUnless( loader.id_cache.load(loader) )
+        self.failUnlessEqual( 25, len(loader.doc_id_map) )
+        self.failUnlessEqual( 19, len(loader.existing_chemicals) )
+        self.failUnlessEqual( self.loader.doc_id_map['WO-2013127697-A1'], loader.doc_id_map['WO-2013127697-A1'] )
+        self.failUnless( 9724 in loader.existing_chemicals )
+
+    def test_cached_documents_known(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+        self.loader.id_cache.save(self.loader)
+
+        # Cached documents are skipped as known, rather than inserted as (disallowed) duplicates
+        loader = DataLoader( self.db, allow_doc_dups=False )
+        loader.id_cache = IdCache(self.cache_path, self.db)
+        self.failUnless( loader.id_cache.load(loader) )
+        loader.load_biblio('data/biblio_typical.json')
+        self.failUnlessEqual( 25, self.db.execute("select count(*) from schembl_document").scalar() )
+
+    def test_journal_replayed_without_save(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+
+        # e.g. the previous run failed part way through
+        loader = self._new_loader()
+        self.failUnless( loader.id_cache.load(loader) )
+        self.failUnlessEqual( 25, len(loader.doc_id_map) )
+
+    def test_cache_discarded_when_db_changes(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+        self.loader.id_cache.save(self.loader)
+
+        # Rebuild the database with different IDs
+        self.loader.db_metadata().drop_all(self.db)
+        self.loader.db_metadata().create_all(self.db)
+
+        loader = self._new_loader()
+        self.failIf( loader.id_cache.load(loader) )
+        self.failUnlessEqual( 0, len(loader.doc_id_map) )
+        self.failIf( os.path.exists(self.cache_path + '.docs.journal') )
+
+
+    def test_cache_discarded_when_records_deleted(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+        self.loader.load_chems('data/chem_typical.tsv', False)
+        self.loader.id_cache.save(self.loader)
+
+        # The highest IDs are unchanged, and a new document is added above them, but others were deleted
+        self.db.execute("delete from schembl_document where id in (3, 4)")
+        self.db.execute("insert into schembl_document (id, scpn) values (1000, 'WO-2099000001-A1')")
+
+        loader = self._new_loader()
+        self.failIf( loader.id_cache.load(loader) )
+
+        # Chemicals are checked too
+        self.loader.id_cache.load(self.loader)
+        self.loader.id_cache.save(self.loader)
+        self.db.execute("delete from schembl_chemical where id = 9724")
+
+        loader = self._new_loader()
+        self.failIf( loader.id_cache.load(loader) )
+
+    def test_discard(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+
+        self.loader.id_cache.discard()
+        self.failIf( os.path.exists(self.cache_path) )
+        self.failIf( os.path.exists(self.cache_path + '.docs.journal') )
+
+        loader = self._new_loader()
+        self.failIf( loader.id_cache.load(loader) )
+
+    def test_damaged_cache_discarded(self):
+        self.loader.id_cache.load(self.loader)
+        self.loader.load_biblio('data/biblio_typical.json')
+        self.loader.id_cache.save(self.loader)
+        snapshot = open(self.cache_path, 'rb').read()
+
+        # A data section cut short, with a consistent header
+        header_offset = IdCache.TRAILER.unpack(snapshot[-8:])[0]
+        short_section = snapshot[:header_offset - 8] + snapshot[header_offset:-8] + IdCache.TRAILER.pack(header_offset - 8)
+
+        # Empty, truncated (e.g. by a full disk) and garbled snapshots are replaced by a new one
+        for damaged in ['', snapshot[:len(snapshot) // 2], snapshot[:-9] + snapshot[-8:], 'x' * len(snapshot), short_section]:
+            open(self.cache_path, 'wb').write(damaged)
+
+            loader = self._new_loader()
+            self.failIf( loader.id_cache.load(loader) )
+            self.failUnlessEqual( 0, len(loader.doc_id_map) )
+
+            loader = self._new_loader()
+            self.failUnless( loader.id_cache.load(loader) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import unittest
+
+from src.scripts.id_store import ChemicalIdSet, DocumentIdMap, dict_memory_bytes
+
+class ChemicalIdSetTests(unittest.TestCase):
+
+    def test_membership(self):
+        chem_ids = ChemicalIdSet([9724, 10101010101, 0])
+        chem_ids.add(9725)
+        chem_ids.update([9724, 524288])
+
+        for chem_id in [0, 9724, 9725, 524288, 10101010101]:
+            self.failUnless( chem_id in chem_ids )
+        for chem_id in [1, 9723, 9726, 524287, 10101010100, -1]:
+            self.failIf( chem_id in chem_ids )
+
+        self.failUnlessEqual( 5, len(chem_ids) )
+        self.failUnlessEqual( [0, 9724, 9725, 524288, 10101010101], list(chem_ids) )
+
+    def test_negative_id(self):
+        self.failUnlessRaises( ValueError, ChemicalIdSet().add, -5 )
+
+
+class DocumentIdMapTests(unittest.TestCase):
+
+    def test_lookup(self):
+        doc_ids = DocumentIdMap( {'WO-2013127697-A1': 5, 'US-D654321-S': 6, u'XX-\u00e9-A1': 9} )
+        doc_ids['EP-0123456-A1'] = 7
+        doc_ids['WO-2013127697-A1'] = 8
+
+        self.failUnlessEqual( 4, len(doc_ids) )
+        self.failUnlessEqual( 9, doc_ids[u'XX-\u00e9-A1'] )
+        self.failUnlessEqual( 8, doc_ids['WO-2013127697-A1'] )
+        self.failUnlessEqual( 6, doc_ids['US-D654321-S'] )
+        self.failUnlessEqual( 7, doc_ids.get(u'EP-0123456-A1') )
+        self.failUnless( 'EP-0123456-A1' in doc_ids )
+        self.failIf( 'EP-123456-A1' in doc_ids )
+        self.failUnlessEqual( None, doc_ids.get('US-D654322-S') )
+        self.failUnlessRaises( KeyError, doc_ids.__getitem__, 'WO-2013127697-A2' )
+
+    def test_resize(self):
+        doc_ids = DocumentIdMap()
+        for i in xrange(20000):
+            doc_ids['US-{}-A1'.format(20130000000 + i * 7)] = i
+
+        self.failUnlessEqual( 20000, len(doc_ids) )
+        for i in xrange(20000):
+            self.failUnlessEqual( i, doc_ids['US-{}-A1'.format(20130000000 + i * 7)] )
+        self.failIf( 'US-20130000001-A1' in doc_ids )
+
+    def test_memory(self):
+        mapping = dict( ('US-{}-A1'.format(20130000000 + i * 7), 1000000 + i) for i in xrange(20000) )
+        doc_ids = DocumentIdMap(mapping)
+
+        # 16 bytes per slot, for 32768 slots
+        self.failUnlessEqual( 16 * 32768 + dict_memory_bytes({}), doc_ids.memory_bytes() )
+        self.failUnless( dict_memory_bytes(mapping) > 3 * doc_ids.memory_bytes() )
+
+
+if __name__ == '__main__':
+    unittest.main()
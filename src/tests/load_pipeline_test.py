@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import unittest
+
+from src.scripts.load_pipeline import pipeline_order, load_in_order, unit_key
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.DEBUG)
+
+class LoadPipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loaded = []
+
+    def load_biblio(self, file_name):
+        self.loaded.append( ('bib', file_name) )
+
+    def load_chems(self, file_name):
+        self.loaded.append( ('chem', file_name) )
+
+    def test_unit_key(self):
+        self.failUnlessEqual( 'docs_20141127_1', unit_key('/data/docs_20141127_1.biblio.json.gz') )
+        self.failUnlessEqual( 'docs_20141127_1', unit_key('/tmp/docs_20141127_1.chemicals.tsv') )
+        self.failUnlessEqual( 'docs_20141127_1', unit_key('docs_20141127_1_supp3.chemicals.tsv.gz') )
+
+    def test_pipeline_order(self):
+        self.failUnlessEqual(
+            ['/p/a.biblio.json.gz', '/p/a.chemicals.tsv.gz', '/p/a_supp1.chemicals.tsv.gz', '/p/b.biblio.json.gz', '/p/b.chemicals.tsv.gz'],
+            pipeline_order(['/p/a.biblio.json.gz', '/p/b.biblio.json.gz', '/p/a_supp1.chemicals.tsv.gz',
+                            '/p/a.chemicals.tsv.gz', '/p/b.chemicals.tsv.gz', '/p/newfiles.txt']) )
+
+    def test_load_in_arrival_order(self):
+        files = ['a.biblio.json', 'a.chemicals.tsv', 'b.biblio.json', 'b.chemicals.tsv']
+        self.failUnlessEqual( 4, load_in_order(files, files, self.load_biblio, self.load_chems) )
+        self.failUnlessEqual( [('bib', 'a.biblio.json'), ('chem', 'a.chemicals.tsv'),
+                               ('bib', 'b.biblio.json'), ('chem', 'b.chemicals.tsv')], self.loaded )
+
+    def test_chems_wait_for_biblio(self):
+        expected = ['a.biblio.json', 'a.chemicals.tsv', 'a_supp1.chemicals.tsv', 'b_supp1.chemicals.tsv']
+        arrivals = ['a_supp1.chemicals.tsv', 'b_supp1.chemicals.tsv', 'a.chemicals.tsv', 'a.biblio.json']
+        load_in_order(arrivals, expected, self.load_biblio, self.load_chems)
+
+        # b has no biblio file in the list, so it's loaded straight away; a's main file precedes its supp file
+        self.failUnlessEqual( [('chem', 'b_supp1.chemicals.tsv'), ('bib', 'a.biblio.json'),
+                               ('chem', 'a.chemicals.tsv'), ('chem', 'a_supp1.chemicals.tsv')], self.loaded )
+
+    def test_supp_files_wait_for_main_file(self):
+        expected = ['a.biblio.json', 'a.chemicals.tsv', 'a_supp1.chemicals.tsv', 'a_supp2.chemicals.tsv', 'a_supp10.chemicals.tsv']
+        arrivals = ['a.biblio.json', 'a_supp10.chemicals.tsv', 'a_supp2.chemicals.tsv', 'a.chemicals.tsv', 'a_supp1.chemicals.tsv']
+        self.failUnlessEqual( 5, load_in_order(arrivals, expected, self.load_biblio, self.load_chems) )
+        self.failUnlessEqual( [('bib', 'a.biblio.json'), ('chem', 'a.chemicals.tsv'), ('chem', 'a_supp1.chemicals.tsv'),
+                               ('chem', 'a_supp2.chemicals.tsv'), ('chem', 'a_supp10.chemicals.tsv')], self.loaded )
+
+    def test_leftover_files_in_group_order(self):
+        # The main file never arrives
+        expected = ['a.biblio.json', 'a.chemicals.tsv', 'a_supp1.chemicals.tsv', 'a_supp2.chemicals.tsv']
+        arrivals = ['/w/a.biblio.json', '/w/a_supp2.chemicals.tsv', '/w/a_supp1.chemicals.tsv']
+        self.failUnlessEqual( 3, load_in_order(arrivals, expected, self.load_biblio, self.load_chems) )
+        self.failUnlessEqual( [('bib', '/w/a.biblio.json'), ('chem', '/w/a_supp1.chemicals.tsv'), ('chem', '/w/a_supp2.chemicals.tsv')], self.loaded )
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from sqlalchemy import create_engine
+
+from src.scripts.data_loader import DataLoader
+from src.scripts.metrics import Metrics
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(buckets=(1, 10))
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def entry(self, summary, kind, name, **labels):
+        for entry in summary[kind]:
+            if entry['name'] == name and entry['labels'] == labels:
+                return entry
+        return None
+
+    def test_counters_and_histograms(self):
+        self.metrics.incr('rows_total', 5, phase='a')
+        self.metrics.incr('rows_total', phase='a')
+        self.metrics.incr('rows_total', 2, phase='b')
+        self.metrics.observe('phase_seconds', 0.5, phase='a')
+        self.metrics.observe('phase_seconds', 5, phase='a')
+        self.metrics.observe('phase_seconds', 50, phase='a')
+        self.metrics.set('run_success', 1)
+
+        summary = self.metrics.summary()
+        self.failUnlessEqual( 6, self.entry(summary, 'counters', 'rows_total', phase='a')['value'] )
+        self.failUnlessEqual( 2, self.entry(summary, 'counters', 'rows_total', phase='b')['value'] )
+        self.failUnlessEqual( 1, self.entry(summary, 'gauges', 'run_success')['value'] )
+
+        histogram = self.entry(summary, 'histograms', 'phase_seconds', phase='a')
+        self.failUnlessEqual( 3, histogram['count'] )
+        self.failUnlessEqual( 55.5, histogram['sum'] )
+        self.failUnlessEqual( [1, 1, 1], histogram['buckets'] )
+        self.failUnlessEqual( (0.5, 50), (histogram['min'], histogram['max']) )
+
+    def test_timed_iter(self):
+        items = list( self.metrics.timed_iter(xrange(7), 'phase_seconds', batch=3, phase='parse') )
+        self.failUnlessEqual( range(7), items )
+        self.failUnlessEqual( 3, self.entry(self.metrics.summary(), 'histograms', 'phase_seconds', phase='parse')['count'] )
+
+    def test_timed_iter_exclude(self):
+        reader = MagicMock(elapsed=0.0)
+
+        def read_items():
+            for item in xrange(3):
+                start = time.time()
+                time.sleep(0.02)
+                reader.elapsed += time.time() - start
+                yield item
+
+        # Time recorded by the reader isn't counted again
+        list( self.metrics.timed_iter(read_items(), 'phase_seconds', exclude=reader, phase='parse') )
+        list( self.metrics.timed_iter(read_items(), 'phase_seconds', phase='read_and_parse') )
+        summary = self.metrics.summary()
+        self.failUnless( self.entry(summary, 'histograms', 'phase_seconds', phase='parse')['sum'] < 0.01 )
+        self.failUnless( self.entry(summary, 'histograms', 'phase_seconds', phase='read_and_parse')['sum'] >= 0.05 )
+
+    def test_merge(self):
+        other = Metrics(buckets=(1, 10))
+        other.incr('rows_total', 3, phase='a')
+        other.observe('phase_seconds', 2, phase='a')
+        self.metrics.incr('rows_total', 1, phase='a')
+        self.metrics.observe('phase_seconds', 0.1, phase='a')
+
+        self.metrics.merge( json.loads(json.dumps(other.summary())) )
+
+        summary = self.metrics.summary()
+        self.failUnlessEqual( 4, self.entry(summary, 'counters', 'rows_total', phase='a')['value'] )
+        self.failUnlessEqual( [1, 1, 0], self.entry(summary, 'histograms', 'phase_seconds', phase='a')['buckets'] )
+
+    def test_write_prometheus(self):
+        self.metrics.incr('rows_total', 2, phase='a')
+        self.metrics.observe('phase_seconds', 5, phase='a')
+        prom_file = os.path.join(self.work_dir, 'load.prom')
+
+        self.metrics.write_prometheus(prom_file)
+
+        lines = open(prom_file).read().splitlines()
+        self.failUnless( '# TYPE schembl_load_rows_total counter' in lines )
+        self.failUnless( 'schembl_load_rows_total{phase="a"} 2.0' in lines )
+        self.failUnless( '# TYPE schembl_load_phase_seconds histogram' in lines )
+        self.failUnless( 'schembl_load_phase_seconds_bucket{le="1",phase="a"} 0' in lines )
+        self.failUnless( 'schembl_load_phase_seconds_bucket{le="10",phase="a"} 1' in lines )
+        self.failUnless( 'schembl_load_phase_seconds_bucket{le="+Inf",phase="a"} 1' in lines )
+        self.failUnless( 'schembl_load_phase_seconds_count{phase="a"} 1' in lines )
+
+    def test_loader_phases(self):
+        db = create_engine('sqlite://', echo=False)
+        loader = DataLoader(db, metrics=self.metrics)
+        loader.db_metadata().create_all(db)
+
+        loader.load_biblio('data/biblio_typical.json')
+        loader.load_chems('data/chem_typical.tsv', False)
+
+        summary = self.metrics.summary()
+        for phase in ('read', 'parse', 'document_insert', 'title_insert', 'class_insert', 'id_lookup',
+                      'chemical_insert', 'structure_insert', 'mapping_insert'):
+            self.failIfEqual( None, self.entry(summary, 'histograms', 'phase_seconds', phase=phase), phase )
+
+        self.failUnlessEqual( 25, self.entry(summary, 'counters', 'documents_total', status='new')['value'] )
+        self.failUnlessEqual( 19, self.entry(summary, 'counters', 'rows_total', phase='chemical_insert')['value'] )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import unittest
+from sqlalchemy import create_engine
+
+from mock import MagicMock
+
+from src.scripts.data_loader import DataLoader
+from src.scripts.partition_swap import PartitionSwap, year_id_range, staging_suffix, YEAR_ID_BASE, YEAR_ID_BLOCK, LAST_YEAR
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+PG_FOREIGN_KEYS = [('schembl_document_title_stage_2013', 'schembl_document_title_stage_2013_schembl_doc_id_fkey'),
+                   ('schembl_document_title', 'fk_doctitle_to_doc')]
+
+PG_INDEXES = [('schembl_document_stage_2013', 'schembl_document_stage_2013_pkey'),
+              ('schembl_document_stage_2013', 'schembl_document_stage_2013_scpn_key'),
+              ('schembl_document_y2013', 'schembl_document_y2013_pkey')]
+
+PG_TABLES = [('schembl_document_y2013',), ('schembl_document_title_y2013',)]
+
+ORA_FOREIGN_KEYS = [('SCHEMBL_DOCUMENT_TITLE_STAGE_2013', 'SYS_C0012345'),
+                    ('SCHEMBL_DOCUMENT_TITLE', 'FK_DOCTITLE_TO_DOC')]
+
+class PartitionSwapTests(unittest.TestCase):
+
+    def setUp(self):
+        self.statements = []
+        self.duplicates = 0
+        self.columns = []
+
+    def new_swap(self, dialect, foreign_keys, indexes=[], tables=[]):
+
+        def execute(clause, **params):
+            statement = str(clause)
+            result = MagicMock()
+            if 'pg_constraint' in statement or 'user_constraints' in statement:
+                result.fetchall.return_value = foreign_keys
+            elif 'pg_indexes' in statement:
+                result.fetchall.return_value = indexes
+            elif 'information_schema.columns' in statement or 'user_tab_columns' in statement:
+                result.fetchall.return_value = self.columns
+            elif 'pg_tables' in statement:
+                result.__iter__.return_value = iter(tables)
+            elif 'COUNT(*)' in statement:
+                self.failUnlessEqual( year_id_range(2013), (params['low'], params['high']) )
+                result.scalar.return_value = self.duplicates
+            else:
+                self.statements.append(statement)
+            return result
+
+        db = MagicMock()
+        db.dialect.name = dialect
+        db.dialect.paramstyle = 'named'
+        db.connect.return_value.execute.side_effect = execute
+
+        loader = DataLoader(db, table_suffix=staging_suffix(2013))
+        return PartitionSwap(loader, 2013)
+
+    def test_year_id_range(self):
+        self.failUnlessEqual( (YEAR_ID_BASE, YEAR_ID_BASE + YEAR_ID_BLOCK), year_id_range(1960) )
+        self.failUnlessEqual( (630000000, 640000000), year_id_range(2013) )
+        self.failUnless( year_id_range(LAST_YEAR)[1] <= 2 ** 31 - 1 )
+        self.failUnlessRaises( ValueError, year_id_range, 1959 )
+        self.failUnlessRaises( ValueError, year_id_range, LAST_YEAR + 1 )
+
+    def staged_columns(self, staged, target, table=None):
+        """Column definitions for a staging table and its partitioned table, as found in the catalog"""
+        definitions = [('id', 'integer', None, 32, 'NO'), ('scpn', 'character varying', 50, None, 'NO'),
+                       ('assign_applic', 'character varying', 4000, None, 'YES')]
+        self.columns = [(target,) + definition for definition in definitions]
+        self.columns += [(table or staged,) + definition for definition in definitions]
+
+    def test_prepare(self):
+        swap = self.new_swap('postgresql', [])
+        self.staged_columns('schembl_document_stage_2013', 'schembl_document')
+        swap.prepare()
+        self.failUnlessEqual( ['CREATE SEQUENCE schembl_document_id_stage_2013 START WITH 630000000 MAXVALUE 639999999',
+                               'CREATE TABLE schembl_document_stage_2013 (LIKE schembl_document INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                               'ALTER TABLE schembl_document_stage_2013 ADD PRIMARY KEY (id)',
+                               'ALTER TABLE schembl_document_stage_2013 ADD UNIQUE (scpn)',
+                               'CREATE TABLE schembl_document_title_stage_2013 (LIKE schembl_document_title INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                               'ALTER TABLE schembl_document_title_stage_2013 ADD PRIMARY KEY (schembl_doc_id, lang)',
+                               'ALTER TABLE schembl_document_title_stage_2013 ADD FOREIGN KEY (schembl_doc_id) REFERENCES schembl_document_stage_2013 (id)'],
+                              self.statements[:7] )
+        self.failUnlessEqual( ['CREATE TABLE schembl_document_chemistry_stage_2013 (LIKE schembl_document_chemistry INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                               'ALTER TABLE schembl_document_chemistry_stage_2013 ADD PRIMARY KEY (schembl_doc_id, schembl_chem_id, field)',
+                               'ALTER TABLE schembl_document_chemistry_stage_2013 ADD FOREIGN KEY (schembl_chem_id) REFERENCES schembl_chemical (id)',
+                               'ALTER TABLE schembl_document_chemistry_stage_2013 ADD FOREIGN KEY (schembl_doc_id) REFERENCES schembl_document_stage_2013 (id)'],
+                              self.statements[-4:] )
+
+    def test_prepare_oracle(self):
+        swap = self.new_swap('oracle', [])
+        self.staged_columns('SCHEMBL_DOCUMENT_STAGE_2013', 'SCHEMBL_DOCUMENT')
+        swap.prepare()
+        self.failUnlessEqual( ['CREATE TABLE schembl_document_stage_2013 AS SELECT * FROM schembl_document WHERE 1 = 0',
+                               'ALTER TABLE schembl_document_stage_2013 ADD PRIMARY KEY (id)',
+                               'ALTER TABLE schembl_document_stage_2013 ADD UNIQUE (scpn)'], self.statements[1:4] )
+
+    def test_staging_columns_differ(self):
+        # e.g. staging tables created from the loader's model, rather than the partitioned tables
+        swap = self.new_swap('postgresql', [])
+        self.staged_columns('schembl_document_stage_2013', 'schembl_document')
+        self.columns[-1] = ('schembl_document_stage_2013', 'assign_applic', 'character varying', 1000, None, 'YES')
+        self.columns[-2] = ('schembl_document_stage_2013', 'scpn', 'character varying', 50, None, 'YES')
+        try:
+            swap.prepare()
+            self.fail("A runtime error should have been thrown")
+        except RuntimeError as e:
+            self.failUnlessEqual( "The columns of staging table schembl_document_stage_2013 don't match those of schembl_document: assign_applic, scpn", e.message )
+
+        # Missing columns differ too
+        self.staged_columns('schembl_document_stage_2013', 'schembl_document', table='schembl_document_other')
+        self.failUnlessRaises( RuntimeError, swap.prepare )
+
+    def test_postgres(self):
+        swap = self.new_swap('postgresql', PG_FOREIGN_KEYS, PG_INDEXES, PG_TABLES)
+        swap.swap()
+        self.failUnlessEqual( ['ALTER TABLE schembl_document_title_stage_2013 DROP CONSTRAINT schembl_document_title_stage_2013_schembl_doc_id_fkey',
+                               'ALTER TABLE schembl_document_title DETACH PARTITION schembl_document_title_y2013',
+                               'DROP TABLE schembl_document_title_y2013',
+                               'ALTER TABLE schembl_document DETACH PARTITION schembl_document_y2013',
+                               'DROP TABLE schembl_document_y2013',
+                               'ALTER TABLE schembl_document_stage_2013 RENAME TO schembl_document_y2013',
+                               'ALTER INDEX schembl_document_stage_2013_pkey RENAME TO schembl_document_y2013_pkey',
+                               'ALTER INDEX schembl_document_stage_2013_scpn_key RENAME TO schembl_document_y2013_scpn_key',
+                               'ALTER TABLE schembl_document ATTACH PARTITION schembl_document_y2013 FOR VALUES FROM (630000000) TO (640000000)',
+                               'ALTER TABLE schembl_document_title_stage_2013 RENAME TO schembl_document_title_y2013',
+                               'ALTER TABLE schembl_document_title ATTACH PARTITION schembl_document_title_y2013 FOR VALUES FROM (630000000) TO (640000000)',
+                               'ALTER TABLE schembl_document_class_stage_2013 RENAME TO schembl_document_class_y2013',
+                               'ALTER TABLE schembl_document_class ATTACH PARTITION schembl_document_class_y2013 FOR VALUES FROM (630000000) TO (640000000)',
+                               'ALTER TABLE schembl_document_chemistry_stage_2013 RENAME TO schembl_document_chemistry_y2013',
+                               'ALTER TABLE schembl_document_chemistry ATTACH PARTITION schembl_document_chemistry_y2013 FOR VALUES FROM (630000000) TO (640000000)',
+                               'DROP SEQUENCE schembl_document_id_stage_2013'], self.statements )
+
+        # All in one transaction
+        swap.db.connect.return_value.begin.return_value.commit.assert_called_once_with()
+
+    def test_oracle(self):
+        swap = self.new_swap('oracle', ORA_FOREIGN_KEYS)
+        swap.swap()
+        self.failUnlessEqual( ['ALTER TABLE SCHEMBL_DOCUMENT_TITLE_STAGE_2013 DROP CONSTRAINT SYS_C0012345',
+                               'ALTER TABLE SCHEMBL_DOCUMENT_TITLE DISABLE CONSTRAINT FK_DOCTITLE_TO_DOC'], self.statements[:2] )
+        self.failUnlessEqual( ['LOCK TABLE schembl_document PARTITION FOR (630000000) IN SHARE MODE',
+                               'ALTER TABLE schembl_document EXCHANGE PARTITION FOR (630000000) WITH TABLE schembl_document_stage_2013 '
+                               'EXCLUDING INDEXES WITHOUT VALIDATION UPDATE GLOBAL INDEXES',
+                               'ALTER TABLE schembl_document MODIFY PARTITION FOR (630000000) REBUILD UNUSABLE LOCAL INDEXES'], self.statements[2:5] )
+        self.failUnlessEqual( ['ALTER TABLE SCHEMBL_DOCUMENT_TITLE ENABLE NOVALIDATE CONSTRAINT FK_DOCTITLE_TO_DOC',
+                               'DROP TABLE schembl_document_chemistry_stage_2013 PURGE',
+                               'DROP TABLE schembl_document_class_stage_2013 PURGE',
+                               'DROP TABLE schembl_document_title_stage_2013 PURGE',
+                               'DROP TABLE schembl_document_stage_2013 PURGE',
+                               'DROP SEQUENCE schembl_document_id_stage_2013'], self.statements[14:] )
+
+    def test_wide_mappings(self):
+        db = MagicMock()
+        db.dialect.name = 'postgresql'
+        swap = PartitionSwap( DataLoader(db, wide_mappings=True, table_suffix=staging_suffix(2013)), 2013 )
+        self.failUnlessEqual( ('schembl_document_chemistry_wide_stage_2013', 'schembl_document_chemistry_wide'), swap.targets[3] )
+
+    def test_documents_in_other_partitions(self):
+        swap = self.new_swap('postgresql', PG_FOREIGN_KEYS, PG_INDEXES, PG_TABLES)
+        self.duplicates = 3
+        try:
+            swap.swap()
+            self.fail("A runtime error should have been thrown")
+        except RuntimeError as e:
+            self.failUnlessEqual( "3 of the documents staged for 2013 already exist in other partitions", e.message )
+        self.failUnlessEqual( [], self.statements )
+
+    def test_checks(self):
+        self.failUnlessRaises( ValueError, PartitionSwap, DataLoader(create_engine('sqlite://'), table_suffix=staging_suffix(2013)), 2013 )
+        db = MagicMock()
+        db.dialect.name = 'oracle'
+        self.failUnlessRaises( ValueError, PartitionSwap, DataLoader(db), 2013 )
+
+    def test_staging_tables_loaded(self):
+        # The loader writes documents and mappings to the staging tables only
+        db = create_engine('sqlite://')
+        DataLoader(db).db_metadata().create_all(db)
+        loader = DataLoader(db, table_suffix=staging_suffix(2013))
+        loader.db_metadata().create_all(db)
+
+        loader.load_biblio('data/biblio_typical.json')
+        loader.load_chems('data/chem_typical.tsv', False)
+        loader.close()
+
+        for staged, target in [('schembl_document_stage_2013', 'schembl_document'),
+                               ('schembl_document_title_stage_2013', 'schembl_document_title'),
+                               ('schembl_document_chemistry_stage_2013', 'schembl_document_chemistry')]:
+            self.failUnless( db.execute("select count(*) from {}".format(staged)).scalar() > 0 )
+            self.failUnlessEqual( 0, db.execute("select count(*) from {}".format(target)).scalar() )
+        self.failUnlessEqual( 19, db.execute("select count(*) from schembl_chemical").scalar() )
+
+
+if __name__ == '__main__':
+    unittest.main()
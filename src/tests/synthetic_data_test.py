@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from sqlalchemy import create_engine, select, func
+
+from src.scripts.data_loader import DataLoader
+from src.benchmarks.synthetic_data import write_biblio, write_chemicals
+
+logging.basicConfig( format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.INFO)
+
+class SyntheticDataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db = create_engine('sqlite://', echo=False)
+        self.loader = DataLoader( self.db )
+        self.metadata = self.loader.db_metadata()
+        self.metadata.create_all(self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def count(self, table_name):
+        return self.db.execute( select([func.count()]).select_from(self.metadata.tables[table_name]) ).scalar()
+
+    def test_generated_files_load(self):
+        biblio_file = os.path.join(self.work_dir, 'a.biblio.json.gz')
+        chem_file = os.path.join(self.work_dir, 'a.chemicals.tsv.gz')
+
+        scpns = write_biblio(biblio_file, 50, first_doc=10)
+        rows = write_chemicals(chem_file, scpns, chems_per_doc=4, chem_pool=30)
+
+        self.loader.load_biblio(biblio_file, chunksize=7)
+        self.loader.load_chems(chem_file, False, chunksize=7)
+
+        self.failUnlessEqual( 50, self.count('schembl_document') )
+        self.failUnlessEqual( rows * 6, self.count('schembl_document_chemistry') )
+        self.failUnless( 0 < self.count('schembl_chemical') <= 30 )
+        self.failUnless( self.count('schembl_document_title') >= 50 )
+
+    def test_deterministic(self):
+        for name in ('x', 'y'):
+            write_chemicals(os.path.join(self.work_dir, name), ['WO-2013000001-A1', 'WO-2013000002-A1'], seed=5)
+
+        self.failUnlessEqual( open(os.path.join(self.work_dir, 'x')).read(), open(os.path.join(self.work_dir, 'y')).read() )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import unittest
+from sqlalchemy import create_engine, event, Column, Integer, String, select
+from sqlalchemy.sql import table, column
+from sqlalchemy.dialects import oracle, postgresql
+
+from mock import MagicMock
+
+from src.scripts.temp_tables import TempTable
+
+class TempTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = create_engine('sqlite:///:memory:', echo=False)
+        self.db.execute("create table test_table (id integer primary key, val varchar(10))")
+        self.db.execute("insert into test_table values (1, 'a'), (2, 'b'), (3, 'c')")
+
+    def new_table(self, db):
+        return TempTable(db, 'tmp_ids', Column('id', Integer, primary_key=True), Column('label', String(10)))
+
+    def test_loaded_for_transaction(self):
+        temp = self.new_table(self.db)
+        conn = self.db.connect()
+
+        with temp.loaded(conn, [{'id': 1, 'label': 'x'}, {'id': 3, 'label': 'y'}]) as table:
+            rows = conn.execute( "select t.val, k.label from test_table t join tmp_ids k on k.id = t.id order by t.id" ).fetchall()
+            self.failUnlessEqual( [('a', 'x'), ('c', 'y')], rows )
+
+        self.failUnlessEqual( [], conn.execute( select([temp.table]) ).fetchall() )
+
+        # Can be loaded again on the same connection
+        with temp.loaded(conn, [{'id': 2, 'label': 'z'}]) as table:
+            self.failUnlessEqual( [(2, 'z')], conn.execute( select([table]) ).fetchall() )
+
+    def test_rolled_back_on_error(self):
+        temp = self.new_table(self.db)
+        conn = self.db.connect()
+
+        try:
+            with temp.loaded(conn, [{'id': 1}]):
+                conn.execute("delete from test_table")
+                raise ValueError("test")
+        except ValueError:
+            pass
+
+        self.failUnlessEqual( 3, len(conn.execute("select * from test_table").fetchall()) )
+        self.failUnlessEqual( [], conn.execute( select([temp.table]) ).fetchall() )
+
+    def test_lookup(self):
+        temp = TempTable(self.db, 'tmp_lookup', Column('id', Integer, primary_key=True))
+        conn = self.db.connect()
+        test_table = table('test_table', column('id'), column('val'))
+
+        statements = []
+        event.listen(self.db, 'before_cursor_execute',
+                     lambda conn, cursor, statement, params, context, executemany: statements.append(statement))
+
+        self.failUnlessEqual( [(1, 'a'), (3, 'c')],
+                              sorted(temp.lookup(conn, [1, 3, 5], test_table.c.id, [test_table.c.id, test_table.c.val])) )
+        first_statements = list(statements)
+
+        # Many more keys than an IN list could take, with the same SQL
+        del statements[:]
+        self.failUnlessEqual( [(1, 'a'), (2, 'b'), (3, 'c')],
+                              sorted(temp.lookup(conn, range(1, 5001), test_table.c.id, [test_table.c.id, test_table.c.val])) )
+        self.failUnlessEqual( [statement for statement in first_statements if not statement.startswith('CREATE')], statements )
+        self.failIf( any(' IN ' in statement.upper() for statement in statements) )
+
+        self.failUnlessEqual( [], temp.lookup(conn, [], test_table.c.id, [test_table.c.id]) )
+
+    def test_created_once_per_connection(self):
+        temp = self.new_table(self.db)
+        conn = self.db.connect()
+
+        statements = []
+        event.listen(self.db, 'before_cursor_execute',
+                     lambda conn, cursor, statement, params, context, executemany: statements.append(statement))
+        creates = lambda: len([statement for statement in statements if statement.startswith('CREATE')])
+
+        for label in ('x', 'y'):
+            with temp.loaded(conn, [{'id': 1, 'label': label}]) as table:
+                self.failUnlessEqual( [(1, label)], conn.execute( select([table]) ).fetchall() )
+        self.failUnlessEqual( 1, creates() )
+
+        # A new DB-API connection needs its own table
+        conn.invalidate()
+        with temp.loaded(conn, [{'id': 2, 'label': 'z'}]) as table:
+            self.failUnlessEqual( [(2, 'z')], conn.execute( select([table]) ).fetchall() )
+        self.failUnlessEqual( 2, creates() )
+
+    def test_ddl(self):
+        pg_db = MagicMock()
+        pg_db.dialect = postgresql.dialect()
+        self.failUnlessEqual( "CREATE TEMPORARY TABLE IF NOT EXISTS tmp_ids (\n\tid INTEGER NOT NULL, \n\tlabel VARCHAR(10), \n\tPRIMARY KEY (id)\n) ON COMMIT DELETE ROWS",
+                              self.new_table(pg_db).create_ddl )
+
+        ora_db = MagicMock()
+        ora_db.dialect = oracle.dialect()
+        self.failUnlessEqual( "CREATE GLOBAL TEMPORARY TABLE tmp_ids (\n\tid INTEGER NOT NULL, \n\tlabel VARCHAR2(10 CHAR), \n\tPRIMARY KEY (id)\n) ON COMMIT DELETE ROWS",
+                              self.new_table(ora_db).create_ddl )
+
+
+if __name__ == '__main__':
+    unittest.main()
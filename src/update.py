@@ -2,6 +2,7 @@
 # -*- coding: UTF-8 -*-
 
 import sys
+import time
 import logging
 import argparse
 from datetime import date
@@ -9,10 +10,17 @@ from datetime import datetime
 import os
 import ftplib
 from subprocess import call, check_call
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from scripts.new_file_reader import NewFileReader
 from scripts.data_loader import DataLoader
+from scripts.chem_workers import ChemLoaderPool
+from scripts.id_cache import IdCache
+from scripts.bulk_mode import BulkLoadMode
+from scripts.partition_swap import PartitionSwap, staging_suffix
+from scripts.chunk_sizing import AdaptiveChunkSize
+from scripts.metrics import Metrics
 from scripts.helper_funcs import retry
+from scripts.load_pipeline import pipeline_order, load_in_order
 try:
     import cx_Oracle
 except ImportError:
@@ -43,7 +51,12 @@ def main():
     parser.add_argument('--db_host',     metavar='dh', type=str,  help='Host where the database can be found',     default="127.0.0.1")
     parser.add_argument('--db_port',     metavar='do', type=str,  help='Port over which the database is accessed', default="1521")
     parser.add_argument('--db_name',     metavar='dn', type=str,  help='Database name (for connection string)',    default="XE")
+    parser.add_argument('--pool_size',   metavar='ps', type=int,  help='Number of database connections kept open by the connection pool', default=5)
+    parser.add_argument('--stmt_cache_size', metavar='sc', type=int, help='Number of prepared statements cached per connection (Oracle only)', default=50)
     parser.add_argument('--working_dir', metavar='w',  type=str,  help='Working directory for downloaded files',   default="/tmp/schembl_ftp_data")
+    parser.add_argument('--ftp_workers', metavar='fw', type=int,  help='Number of concurrent FTP download sessions', default=1)
+    parser.add_argument('--ftp_attempts',metavar='fa', type=int,  help='Maximum download attempts for each file',   default=3)
+    parser.add_argument('--pipeline_depth', metavar='pd', type=int, help='Number of data files that may be downloaded ahead of loading', default=4)
 
     # Options that determine what is loaded
     group = parser.add_mutually_exclusive_group()
@@ -57,12 +70,58 @@ def main():
     parser.add_argument('--preload_bib_ids', help='Try to find IDs for documents, instead of waiting for Integrity Errors',     action="store_true")
     parser.add_argument('--skip_titles',  help='Ignore titles when loading document metadata',                               action="store_true")
     parser.add_argument('--skip_classes', help='Ignore classifications when loading document metadata',                      action="store_true")
+    parser.add_argument('--sparse_mappings', help='Only write document/chemical mappings with a non-zero frequency (see prune_mappings.py)', action="store_true")
+    parser.add_argument('--wide_mappings', help='Write document/chemical mappings to schembl_document_chemistry_wide, one row per pair (see schema/sc_data_wide.sql)', action="store_true")
+
+    # Flags that determine how data is written to the database
+    parser.add_argument('--pg_copy',      help='Use COPY FROM STDIN for bulk inserts (PostgreSQL only)',                      action="store_true")
+    parser.add_argument('--columnar',     help='Parse chemical files into columnar batches with pandas/NumPy (must be installed)', action="store_true")
+    parser.add_argument('--async_writes', help='Write records from a background thread, on a second connection, while the next chunk is parsed', action="store_true")
+    parser.add_argument('--workers',      metavar='n', type=int, help='Number of worker processes for loading chemical files',  default=1)
+    parser.add_argument('--bulk_mode', '--bulk-mode', dest='bulk_mode', help='Set aside secondary indexes and foreign keys while loading, then rebuild them and check integrity (Oracle/PostgreSQL; for cold loads into an empty schema)', action="store_true")
+    parser.add_argument('--direct_path',  help='Insert chemicals, structures, mappings, titles and classifications by direct path (Oracle only; best with --bulk_mode)', action="store_true")
+    parser.add_argument('--nologging',    help='Switch the bulk loaded tables to NOLOGGING while loading (Oracle only, with --bulk_mode); back up the database afterwards', action="store_true")
+    parser.add_argument('--partition_swap', help='Load the --year into staging tables, then swap them in as the partitions for that year (partitioned schema only; see schema/sc_data_partitioned.sql)', action="store_true")
+    parser.add_argument('--id_cache',     help='Keep a cache of known document and chemical IDs in the working directory, between runs', action="store_true")
+    parser.add_argument('--chunksize',    metavar='c', type=int, help='Number of input records processed (and written) per chunk; the initial size, if adaptive', default=1000)
+    parser.add_argument('--adaptive_chunks', help='Adjust the chunk size to the database throughput, within the limits below', action="store_true")
+    parser.add_argument('--max_chunksize',     metavar='x', type=int,   help='Largest chunk size to use with --adaptive_chunks', default=50000)
+    parser.add_argument('--max_chunk_seconds', metavar='s', type=float, help='Processing time per chunk above which --adaptive_chunks reduces the size', default=30.0)
+    parser.add_argument('--max_chunk_mb',      metavar='b', type=int,   help='Estimated memory per chunk that --adaptive_chunks caps the size to', default=256)
+
+    # Where run metrics are written
+    parser.add_argument('--metrics_file',    metavar='m', type=str, help='JSON file for the run metrics summary; defaults to load_metrics.json in the working directory')
+    parser.add_argument('--prometheus_file', metavar='p', type=str, help='Optional Prometheus textfile-collector file for the run metrics (name must end with .prom)')
+
 
     args = parser.parse_args()
 
-    input_files = _prepare_files(args)
+    if args.partition_swap and (args.year is None or args.overwrite or args.bulk_mode or args.id_cache):
+        parser.error("--partition_swap needs --year, and can't be combined with --overwrite, --bulk_mode or --id_cache")
+
+    if args.nologging and not args.bulk_mode:
+        parser.error("--nologging needs --bulk_mode")
+
+    metrics = Metrics()
+    start = time.time()
+    succeeded = False
+
+    try:
+        _load(args, metrics)
+        succeeded = True
+    except SystemExit, exc:
+        succeeded = exc.code in (None, 0)
+        raise
+    finally:
+        _write_metrics(args, metrics, start, succeeded)
+
+
+def _load(args, metrics):
+    """Download (or copy) and load the data files selected by the command line arguments"""
+
+    input_files, expected_files = _prepare_files(args, metrics)
 
-    logger.info("Loading data files into DB")
+    logger.info("Loading data files into DB, as they become available")
 
     if args.db_type == 'oracle':
         db_pkg = cx_Oracle
@@ -75,16 +134,92 @@ def main():
                     load_titles=not args.skip_titles,
                     load_classifications=not args.skip_classes,
                     overwrite=args.overwrite,
-                    allow_doc_dups=True)
+                    allow_doc_dups=True,
+                    pg_copy=args.pg_copy,
+                    metrics=metrics,
+                    columnar_chems=args.columnar,
+                    async_writes=args.async_writes,
+                    sparse_mappings=args.sparse_mappings,
+                    wide_mappings=args.wide_mappings,
+                    table_suffix=staging_suffix(int(args.year)) if args.partition_swap else '',
+                    direct_path=args.direct_path)
+
+        id_cache_path = os.path.join(args.working_dir, 'schembl_id_cache')
+
+        id_cache = None
+        if args.id_cache:
+            id_cache = IdCache( id_cache_path, db )
+            id_cache.load(loader)
+            loader.id_cache = id_cache
+
+        partition_swap = None
+        if args.partition_swap:
+            partition_swap = PartitionSwap( loader, int(args.year) )
+            partition_swap.prepare()
+
+        bulk_mode = None
+        if args.bulk_mode:
+            if args.overwrite:
+                logger.warn("Bulk mode is intended for loading into an empty schema; overwriting documents will be slow without the secondary indexes")
+            bulk_mode = BulkLoadMode( db, os.path.join(args.working_dir, 'bulk_mode_state.json'), nologging=args.nologging )
+            bulk_mode.disable()
+        elif args.direct_path:
+            logger.warn("Without bulk mode, Oracle uses conventional-path inserts for tables with foreign keys; only chemicals are inserted by direct path")
+
+        if args.adaptive_chunks:
+            limits = dict( initial=args.chunksize, minimum=min(100, args.chunksize), maximum=max(args.max_chunksize, args.chunksize),
+                           max_seconds=args.max_chunk_seconds, max_bytes=args.max_chunk_mb * 1024 * 1024, metrics=metrics )
+            biblio_chunks = AdaptiveChunkSize('biblio', **limits)
+            chem_chunks = AdaptiveChunkSize('chemicals', **limits)
+        else:
+            biblio_chunks = chem_chunks = args.chunksize
+
+        def load_biblio(bib_file):
+            loader.load_biblio( bib_file, preload_ids=args.preload_bib_ids, chunksize=biblio_chunks )
 
-        for bib_file in filter( lambda f: f.endswith("biblio.json"), input_files):
-            loader.load_biblio( "{}/{}".format( args.working_dir,bib_file ), preload_ids=args.preload_bib_ids )
+        chem_pool = ChemLoaderPool(loader, args.workers, chunksize=chem_chunks) if args.workers > 1 else None
 
-        for chem_file in filter( lambda f: f.endswith("chemicals.tsv"), input_files):
-            update = "supp" in chem_file
+        def load_chems(chem_file):
+            update = "supp" in os.path.basename(chem_file)
             if update: logger.info("Supplementary chemical file detected - setting parameters to handle duplicate records")
 
-            loader.load_chems( "{}/{}".format( args.working_dir,chem_file ), update )
+            if chem_pool is not None:
+                chem_pool.submit( chem_file, update )
+            else:
+                loader.load_chems( chem_file, update, chunksize=chem_chunks )
+
+        try:
+            loaded_count = load_in_order(input_files, expected_files, load_biblio, load_chems)
+
+            if chem_pool is not None:
+                chem_pool.join()
+
+            loader.close()
+        except Exception:
+            if bulk_mode is not None:
+                logger.error( "Loading failed; indexes and foreign keys stay set aside until a bulk mode run completes (see [{}])".format(bulk_mode.state_file) )
+            if partition_swap is not None:
+                logger.error( "Loading failed; the partitions for {} are unchanged".format(args.year) )
+            raise
+
+        if id_cache is not None:
+            id_cache.save(loader)
+
+        if bulk_mode is not None:
+            with metrics.timer('phase_seconds', phase='index_rebuild'):
+                bulk_mode.restore()
+
+        if loaded_count == 0:
+            logger.error("Data files were expected, but none were loaded")
+            raise RuntimeError( "No data files were loaded from working directory [{}]".format(args.working_dir) )
+
+        # Only swapped in once the whole year has been loaded
+        if partition_swap is not None:
+            with metrics.timer('phase_seconds', phase='partition_swap'):
+                partition_swap.swap()
+
+            # The year's documents may have new IDs, which an ID cache can't detect
+            IdCache( id_cache_path, db ).discard()
 
         logger.info("Processing complete, exiting")
 
@@ -93,7 +228,28 @@ def main():
         logger.error( "Database exception detected: {}".format( exc ) )
         raise
 
-def _prepare_files(args):
+def _write_metrics(args, metrics, start, succeeded):
+    """Record run-level metrics, log the time spent in each phase, and write the metrics files"""
+
+    metrics.set('run_seconds', time.time() - start)
+    metrics.set('run_success', 1 if succeeded else 0)
+    metrics.set('run_end_timestamp', time.time())
+
+    metrics.log_phases()
+
+    try:
+        metrics.write_summary( args.metrics_file or os.path.join(args.working_dir, 'load_metrics.json') )
+        if args.prometheus_file:
+            metrics.write_prometheus( args.prometheus_file )
+    except (IOError, OSError), exc:
+        logger.error( "Unable to write metrics: {}".format(exc) )
+
+def _prepare_files(args, metrics):
+    """
+    Start making data files available in the working directory, either by downloading them or by copying them
+    from the input directory. Gzipped files are left compressed; the loaders decompress them on the fly.
+    :return: Tuple of (iterator over local paths of data files, as they become ready; list of expected file names)
+    """
 
     logger.info("Preparing working directory")
 
@@ -106,20 +262,18 @@ def _prepare_files(args):
 
         logger.info("Discovering and downloading data files")
 
-        ftp = ftplib.FTP('ftp-private.ebi.ac.uk', args.ftp_user, args.ftp_pass)
-        reader = NewFileReader(ftp)
+        ftp_factory = lambda: ftplib.FTP('ftp-private.ebi.ac.uk', args.ftp_user, args.ftp_pass)
+        reader = NewFileReader(ftp_factory(), ftp_factory, metrics)
 
-        download_list = _get_files_retry(args, reader)
+        download_list = pipeline_order( _get_files_retry(args, reader) )
 
         if len( download_list ) == 0:
             logger.info("No files detected for download, exiting")
             sys.exit(0)
 
-        reader.read_files( download_list, args.working_dir )
-
-        if len( os.listdir(args.working_dir) ) == 0:
-            logger.error("Files were downloaded, but working directory is empty")
-            raise RuntimeError( "Working directory [{}] is empty".format(args.working_dir) )
+        arrivals = reader.iter_files( download_list, args.working_dir,
+                                      workers=args.ftp_workers, attempts=args.ftp_attempts, queue_size=args.pipeline_depth )
+        expected_files = [os.path.basename(f) for f in download_list]
 
     else:
 
@@ -134,12 +288,10 @@ def _prepare_files(args):
             logger.warn("Empty working directory detected, exiting")
             sys.exit(0)
 
-    logger.info("Unzipping contents of working directory")
-
-    check_call("gunzip {}/*.gz".format(args.working_dir), shell=True)
-
-    return os.listdir(args.working_dir)
+        expected_files = pipeline_order( sorted(os.listdir(args.working_dir)) )
+        arrivals = ["{}/{}".format(args.working_dir, f) for f in expected_files]
 
+    return arrivals, expected_files
 
 
 def _get_files_retry(args, reader):
@@ -198,7 +350,16 @@ def _get_db_engine(args):
 
     logger.info("DB connection string: [{}]".format(connection_str))
 
-    db = create_engine(connection_str, echo=False)
+    db = create_engine(connection_str, echo=False, pool_size=args.pool_size)
+
+    # Statements are prepared once per connection and cursor; the statement cache also keeps those of closed cursors
+    if args.db_type == 'oracle':
+        logger.info("Oracle statement cache size: {}".format(args.stmt_cache_size))
+
+        def set_stmt_cache_size(dbapi_conn, connection_record):
+            dbapi_conn.stmtcachesize = args.stmt_cache_size
+
+        event.listen(db, 'connect', set_stmt_cache_size)
 
     return db
 